@@ -0,0 +1,163 @@
+# coding=utf-8
+# Copyright 2014 Timothy Zhang(zt@live.cn).
+#
+# This file is part of Structer.
+#
+# Structer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Structer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Structer.  If not, see <http://www.gnu.org/licenses/>.
+
+import gc
+import json
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from ccc import Project
+
+
+def create_node(index, name, parent, children, components):
+    return {
+        '__type__': 'cc.Node', '_name': name, '_objFlags': 0, '_opacity': 255,
+        '_color': {'__type__': 'cc.Color', 'r': 255, 'g': 255, 'b': 255, 'a': 255},
+        '_cascadeOpacityEnabled': True,
+        '_parent': {'__id__': parent} if parent is not None else None,
+        '_anchorPoint': {'__type__': 'cc.Vec2', 'x': 0.5, 'y': 0.5},
+        '_contentSize': {'__type__': 'cc.Size', 'width': 100, 'height': 40},
+        '_children': [{'__id__': i} for i in children],
+        '_rotationX': 0, '_rotationY': 0, '_scaleX': 1, '_scaleY': 1,
+        '_position': {'__type__': 'cc.Vec2', 'x': index % 100, 'y': index % 37},
+        '_skewX': 0, '_skewY': 0, '_localZOrder': 0, '_globalZOrder': 0, '_tag': -1,
+        '_opacityModifyRGB': False, '_reorderChildDirty': False,
+        '_id': 'node%08d' % index,
+        '_components': [{'__id__': i} for i in components],
+    }
+
+
+def create_sprite(node):
+    return {'__type__': 'cc.Sprite', '_name': '', '_objFlags': 0, 'node': {'__id__': node}, '_enabled': True,
+            '_spriteFrame': None, '_type': 0, '_sizeMode': 1, '_fillType': 0, '_fillCenter': {
+                '__type__': 'cc.Vec2', 'x': 0, 'y': 0}, '_fillStart': 0, '_fillRange': 0, '_isTrimmedMode': True}
+
+
+def generate_scene(nodes, branching):
+    """
+    生成包含nodes个Node的场景，每个Node有一个cc.Sprite。与ccc一致，element按照先序排列：Node，子节点，组件
+    :param int nodes:
+    :param int branching: 每个Node的子节点数
+    :rtype: list[dict]
+    """
+    elements = [{'__type__': 'cc.SceneAsset', '_name': '', '_objFlags': 0, '_rawFiles': None, 'scene': {'__id__': 1}}]
+    counter = [0]
+
+    def add_node(name, parent, remaining):
+        """
+        :return: 子树中Node的数量
+        """
+        index = len(elements)
+        elements.append(None)
+        counter[0] += 1
+        children, count = [], 1
+        if remaining > 1:
+            per_child = max(1, (remaining - 1) / branching)
+            while count < remaining:
+                size = min(per_child, remaining - count)
+                children.append(len(elements))
+                count += add_node('n%s' % counter[0], index, size)
+
+        component = len(elements)
+        elements.append(create_sprite(index))
+        elements[index] = create_node(counter[0], name, parent, children, [component])
+        return count
+
+    add_node('scene', None, nodes)
+    elements[1]['__type__'] = 'cc.Scene'
+    return elements
+
+
+def create_project(path, nodes, branching):
+    os.makedirs(os.path.join(path, 'assets'))
+    os.makedirs(os.path.join(path, 'library'))
+    open(os.path.join(path, 'library', 'bundle.project.js'), 'w').close()
+    open(os.path.join(path, 'ccc_helper.yaml'), 'w').write('ignore_components: []\n')
+    json.dump(generate_scene(nodes, branching), open(os.path.join(path, 'assets', 'big.fire'), 'w'), indent=2)
+    json.dump({'ver': '1.0.0', 'uuid': '00000000-0000-0000-0000-000000000001', 'subMetas': {}},
+              open(os.path.join(path, 'assets', 'big.fire.meta'), 'w'))
+
+
+def deep_sizeof(root, shared):
+    """
+    root引用到的所有对象占用的内存(sys.getsizeof)，不包括shared中的对象和类型
+    :param root:
+    :param list shared:
+    :rtype: int
+    """
+    seen = {id(x) for x in shared}
+    stack, size = [root], 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return size
+
+
+def get_rss():
+    """
+    :return: 当前进程的常驻内存(字节)
+    :rtype: int
+    """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def main():
+    parser = optparse.OptionParser(usage='python benchmark.py [options]')
+    parser.add_option('-n', '--nodes', dest='nodes', type='int', default=100000, help='number of nodes')
+    parser.add_option('-b', '--branching', dest='branching', type='int', default=8, help='children per node')
+    option, args = parser.parse_args()
+
+    path = tempfile.mkdtemp(prefix='ccc_benchmark_')
+    try:
+        create_project(path, option.nodes, option.branching)
+        print 'scene: %s nodes, %.1f MB' % (option.nodes, os.path.getsize(os.path.join(path, 'assets', 'big.fire')) /
+                                            1024.0 / 1024)
+
+        gc.collect()
+        rss = get_rss()
+        start = time.time()
+        project = Project(path)
+        project.load()
+        elapsed = time.time() - start
+        gc.collect()
+        rss = get_rss() - rss
+
+        asset = project.get_asset_by_path('big.fire')
+        nodes = sum(1 for _ in asset.root.walk())
+        assert nodes == option.nodes
+        # Project及其配置、模块级的常量等，不属于模型
+        size = deep_sizeof(asset, [project, project.__dict__] + project.__dict__.values() + [
+            sys.modules['ccc'].__dict__])
+
+        print 'load: %.2fs' % elapsed
+        print 'model: %.1f MB, %d bytes/node (node + component)' % (size / 1024.0 / 1024, size / nodes)
+        print 'rss: %.1f MB, %d bytes/node' % (rss / 1024.0 / 1024, rss / nodes)
+    finally:
+        shutil.rmtree(path, True)
+
+
+if __name__ == '__main__':
+    main()
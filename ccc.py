@@ -16,30 +16,80 @@
 # You should have received a copy of the GNU General Public License
 # along with Structer.  If not, see <http://www.gnu.org/licenses/>.
 import base64
+import codecs
 import copy
+import cPickle as pickle
+import hashlib
+import multiprocessing
 import optparse
 import os
+import Queue
 import json
 import yaml
 import re
 import shutil
+import socket
+import SocketServer
+import sqlite3
+import subprocess
+import time
 import traceback
 import uuid
 from collections import OrderedDict
+from cStringIO import StringIO
 import datetime
 import sys
 
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
 ASSETS_PATH = 'assets'
 INDENT = '  '
+# ccc_helper自己的缓存目录(library由ccc生成，且已被忽略)
+CACHE_PATH = os.path.join('library', 'ccc_helper')
+# 修改了模型的结构时，需要增加版本号，使旧的缓存失效
+CACHE_VERSION = 9
+# 修改了ProjectIndex的表结构(或components.json的格式，见ComponentRegistry)时，需要增加版本号
+INDEX_VERSION = 1
+# 超过该大小(字节)的Prefab/Scene，逐个element解析，不一次性读入整个文件(见iter_json_array)
+STREAMING_THRESHOLD = 8 << 20
+# 常驻进程的Unix domain socket(见ProjectDaemon)
+DAEMON_SOCKET_PATH = os.path.join(CACHE_PATH, 'daemon.sock')
+
+# 脚本的扩展名，自定义组件的名字就是脚本的文件名(见ComponentRegistry)
+SCRIPT_EXTENSIONS = ('.js', '.coffee')
+BASE64_KEYS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+
+# 换行和之后的缩进(见FileOutput.save)
+JSON_INDENT_PATTERN = re.compile(r'\n *')
+# 共享的空集合，避免每个Element都创建一个空的set
+EMPTY_SET = frozenset()
+# 只读的值(见is_leaf)
+LEAF_TYPES = frozenset(['cc.Vec2', 'cc.Color', 'cc.Size'])
+# 所有Asset共享的property名和__type__(见intern_string)
+_interned_strings = {}
 
 NODE_IGNORE_PROPERTIES = {'_active', '_reorderChildDirty'}
 INSTANCE_ROOT_IGNORE_PROPERTIES = {'_position', '_rotationX', '_rotationY', '_scaleX', '_scaleY', '_anchorPoint',
                                    '_skewX', '_skewY', '_name', '_localZOrder', '_globalZOrder',
                                    '_tag', '_active'}
+# 同步时一定会被忽略的属性，计算哈希时只考虑是否存在(见Node.get_fingerprint)
+FINGERPRINT_NODE_IGNORES = frozenset(NODE_IGNORE_PROPERTIES)
+FINGERPRINT_INSTANCE_ROOT_IGNORES = frozenset(INSTANCE_ROOT_IGNORE_PROPERTIES)
+FINGERPRINT_PREFAB_INFO_IGNORES = frozenset(['asset', 'fileId'])
 
 IGNORE_COMPONENT_PROPERTIES = {
     'cc.Layout': ['_layoutSize']
 }
+# SS8: KdText,忽略KdLabel.string, Sprite.spriteFrame(不要忽略_atlas，因为KdText有可能不修改_atlas)
+KD_TEXT_IGNORE_PROPERTIES = {
+    'cc.Label': frozenset(['_N$string']),
+    'cc.Sprite': frozenset(['_spriteFrame']),
+}
+# SS9: KdLabel,忽略font, fontSize, lineHeight
+KD_LABEL_IGNORE_PROPERTIES = frozenset(['_isSystemFontUsed', '_N$file', '_lineHeight', '_fontSize', '_actualFontSize'])
 
 
 class LabelOverflow(object):
@@ -92,29 +142,73 @@ class File(object):
 
 
 class FileInput(File):
-    def __init__(self, project, relative_path):
+    def __init__(self, project, relative_path, uuid_=None):
+        """
+        :param Project project:
+        :param str relative_path: relative to assets
+        :param str uuid_: 已知uuid时(比如从ProjectIndex中)，不需要读取.meta
+        """
         File.__init__(self, project, relative_path)
-        self.meta = json.load(open(self.path + '.meta'), object_pairs_hook=OrderedDict)
-        self.data = json.load(open(self.path), object_pairs_hook=OrderedDict)
+        self._uuid = uuid_
+        self._meta = None
+        if uuid_ is None:
+            self._meta = json.load(open(self.path + '.meta'), object_pairs_hook=OrderedDict)
+            self._uuid = self._meta['uuid']
+        # 在load()中解析。加载时，Element会直接拿走其中的dict(置为None，见take)，加载完成后释放
+        self.data = None
         """:type: list[dict[str, *]]"""
-        self.elements = [[] for _ in xrange(len(self.data))]
+        self.elements = None
         """:type: list[list[Element]]"""
+        # 大文件逐个解析element，data中只有已经解析出来的部分
+        self._reader = None
+        """:type: Iterator[dict]"""
+
+    @property
+    def meta(self):
+        """
+        :rtype: dict
+        """
+        if self._meta is None:
+            self._meta = json.load(open(self.path + '.meta'), object_pairs_hook=OrderedDict)
+        return self._meta
 
     @property
     def uuid(self):
-        return self.meta['uuid']
+        return self._uuid
 
     def __str__(self):
-        return '<%s name=%s uuid=%s path=%s/>' % (self.__class__.__name__, self.name, self.meta['uuid'], self.path)
+        return '<%s name=%s uuid=%s path=%s/>' % (self.__class__.__name__, self.name, self.uuid, self.path)
 
-    def load(self, root_class):
+    def __getstate__(self):
+        # data/elements只在加载时使用，不需要缓存
+        state = self.__dict__.copy()
+        state.pop('data', None)
+        state.pop('elements', None)
+        state.pop('_reader', None)
+        return state
+
+    def load(self, root_class, root=None):
         """
         :param class root_class:
+        :param Asset root: 加载到已有的Asset中(lazy加载时，见Project.materialize)
         :rtype Element:
         """
-        root = root_class(self.project)
-        """:type: Element"""
-        root.load(self, 0)
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size >= STREAMING_THRESHOLD:
+                # element被取走后就归Element所有，内存峰值基本等于最终模型的大小
+                self._reader = iter_json_array(f, object_pairs_hook=self._create_object)
+                self.data, self.elements = [], []
+            else:
+                self.data = json.load(f, object_pairs_hook=self._create_object)
+                self.elements = [[] for _ in xrange(len(self.data))]
+
+            if root is None:
+                root = root_class(self.project)
+                """:type: Element"""
+            root.load(self, 0)
+
+            # post_load时还会加载Argument，剩下的element都要解析出来
+            self._read_until(sys.maxint)
 
         # fix node references
         for i, elements in enumerate(self.elements):
@@ -125,8 +219,50 @@ class FileInput(File):
             if len(elements) <= 0:
                 raise Exception('Element %s not loaded in "%s"' % (i, self.path))
 
+        self.data = None
         return root
 
+    def _create_object(self, pairs):
+        """
+        object_pairs_hook：property名和__type__共享同一个字符串，相同的只读值共享同一个对象
+        :param list[(unicode, *)] pairs:
+        :rtype: OrderedDict
+        """
+        data = OrderedDict()
+        for k, v in pairs:
+            data[intern_string(k)] = v
+        type_ = data.get('__type__')
+        if type_ is not None:
+            data['__type__'] = intern_string(type_)
+        if is_leaf(data):
+            return self.project.share_leaf(data)
+        return data
+
+    def take(self, index):
+        """
+        取走第index个element的数据(不复制)
+        :param int index:
+        :return: 已经被取走时，返回None
+        :rtype: dict|None
+        """
+        self._read_until(index)
+        data = self.data[index]
+        self.data[index] = None
+        return data
+
+    def _read_until(self, index):
+        """
+        :param int index: 确保第index个element已经被解析
+        """
+        while self._reader is not None and len(self.data) <= index:
+            try:
+                data = next(self._reader)
+            except StopIteration:
+                self._reader = None
+                break
+            self.data.append(data)
+            self.elements.append([])
+
     def dump_elements(self, indent=0):
         for i, elements in enumerate(self.elements):
             for element in elements:
@@ -142,27 +278,45 @@ class FileOutput(File):
 
     def save(self, asset):
         """
+        没有修改的element直接写回原文件中的内容(见split_json_array)，只重新编码修改过的，结果与全部重新编码一致。
+        结构没有变化时，每个element的序号不变；否则序号变化的element引用的__id__不同，也会重新编码。
+        和cocos creator一样，非ASCII字符直接以utf-8保存；原文件中转义(\\uXXXX)的element没有修改时也保持不变。
         :param Asset asset:
         """
         asset.save(self)
-        content = json.dumps(self.elements, indent=2)
-        content = '\n'.join(line.rstrip() for line in content.split('\n'))  # 去掉行尾的空格，和ccc保持一致
+        spans = []
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                spans = split_json_array(f.read()) or []
+
+        parts = []
+        for i, element in enumerate(self.elements):
+            # 紧凑的编码(C实现)比indent的快很多，去掉缩进后与原来的内容相同时，element没有修改
+            if i < len(spans):
+                compact = '{%s}' % JSON_INDENT_PATTERN.sub('', '\n%s\n' % spans[i])
+                if json.dumps(element, separators=(',', ': '), ensure_ascii=False).encode('utf-8') == compact or \
+                        ('\\u' in compact and json.dumps(element, separators=(',', ': ')) == compact):
+                    parts.append('  {\n%s\n  }' % spans[i])
+                    continue
+            parts.append(encode_element(element))
+        content = '[\n%s\n]' % ',\n'.join(parts) if parts else '[]'
         open(self.path, 'wb').write(content)
 
 
 class Element(object):
+    # 大场景中Node和Component的数量很多，不使用__dict__(Asset除外)
+    __slots__ = ('project', '_data', '_loaded_index', '_saved_index', '_ignore_properties')
+
     def __init__(self, project):
         self.project = project
-        self._keys = None
-        """:type list[str]"""
         self._data = OrderedDict()
         """:type: dict[str, *]"""
         # the index in original file
         self._loaded_index = -1
         # todo: 如果需要多次保存，要先清空
         self._saved_index = -1
-        # 同步时，需要忽略的属性
-        self._ignore_properties = set()
+        # 同步时，需要忽略的属性(见ignore)
+        self._ignore_properties = EMPTY_SET
         """:type: set[str]"""
 
     @property
@@ -204,14 +358,15 @@ class Element(object):
         :param FileInput file_:
         :param int index:
         """
-        self._data = copy.deepcopy(file_.data[index])
-        self._keys = self._data.keys()
-        self._loaded_index = index
-        assert self.type == self._data['__type__'], '%s %s' % (self.type, self._data['__type__'])
-        if len(file_.elements[index]):
-            # Components might be reused
+        # 直接使用解析出来的dict，不再复制
+        self._data = file_.take(index)
+        if self._data is None:
+            # Components might be reused. 数据已经被第一个Component拿走了，只能复制一份
             assert isinstance(self, Component)
             assert isinstance(file_.elements[index][0], Component)
+            self._data = copy.deepcopy(file_.elements[index][0]._data)
+        self._loaded_index = index
+        assert self.type == self._data['__type__'], '%s %s' % (self.type, self._data['__type__'])
 
         file_.elements[index].append(self)
 
@@ -260,11 +415,12 @@ class Element(object):
         :param set[str] ignore_properties:
         """
         # CR4: 忽略特定的prefab中的特定Node的特定组件的特定属性
-        ignore_properties = ignore_properties.union(other._ignore_properties)
+        if other._ignore_properties:
+            ignore_properties = ignore_properties.union(other._ignore_properties)
         synchronize_dict(self, other, self._data, other._data, ctx, ignores=ignore_properties)
 
     def ignore(self, properties):
-        self._ignore_properties = set(properties)
+        self._ignore_properties = frozenset(properties)
 
     def __str__(self):
         return '<%s type=%s/>' % (self.__class__.__name__, self.type)
@@ -276,18 +432,23 @@ class Asset(Element):
     """
 
     file = None
-    """:type: File"""
-    root = None
-    """:type: Node"""
+    """:type: FileInput"""
 
     # 是否需要同步（可能是部分文件需要同步）
     need_synchronize = False
     # 是否同步过了（仅用于校验）
     synchronized = False
 
+    # 依赖关系、同步相关的属性，不属于Asset的内容，不需要缓存(见dump_asset)
+    GRAPH_ATTRIBUTES = ('referents', 'referers', 'depth', 'need_synchronize', 'synchronized', '_referent_uuids',
+                        '_template')
+
     def __init__(self, project):
         Element.__init__(self, project)
 
+        self._root = None
+        """:type: Node"""
+
         # 用于解析Asset之间的依赖关系
         # 我引用到的
         self.referents = set()
@@ -297,6 +458,76 @@ class Asset(Element):
         """:type: set[Asset]"""
         # 在森林中的深度(从根开始的最长路径)
         self.depth = None
+        # lazy加载时，扫描文件得到的被引用Prefab的uuid(见Project.create_asset_stub)
+        self._referent_uuids = None
+        """:type: list[str]"""
+        # 见instance_roots
+        self._instance_roots = None
+        """:type: list[Node]"""
+        # 见template
+        self._template = None
+        """:type: NodeTemplate"""
+
+    @property
+    def root(self):
+        """
+        lazy加载的Asset，第一次访问时才构建Node树
+        :rtype: Node
+        """
+        if self._root is None and self._referent_uuids is not None:
+            self.project.materialize(self)
+        return self._root
+
+    @root.setter
+    def root(self, val):
+        self._root = val
+        self._instance_roots = None
+        self._template = None
+
+    @property
+    def instance_roots(self):
+        """
+        所有的Prefab实例(不包括嵌套在实例中的，见Node.iterate_instance_roots)，第一次用到时计算。
+        同步只修改实例的内部，不会增删这些实例。
+        :rtype: list[Node]
+        """
+        if self._instance_roots is None:
+            self._instance_roots = list(self.root.iterate_instance_roots(False))
+        return self._instance_roots
+
+    @property
+    def template(self):
+        """
+        作为同步来源时编译的root(见NodeTemplate)，所有Instance共用。自己同步时会修改Node树，需要重新编译。
+        :rtype: NodeTemplate
+        """
+        if self._template is None:
+            self._template = NodeTemplate(self.root)
+        return self._template
+
+    @property
+    def materialized(self):
+        """
+        Node树是否已经构建
+        :rtype: bool
+        """
+        return self._root is not None
+
+    def unload(self):
+        """
+        释放Node树(如dry run同步之后)，下次访问root时重新加载。只对lazy加载的Asset有效。
+        """
+        assert self._referent_uuids is not None
+        self.root = None
+
+    def get_referent_uuids(self):
+        """
+        直接引用到的Prefab的uuid(可能重复)
+        :rtype: list[str]
+        """
+        if self._referent_uuids is not None:
+            return self._referent_uuids
+        return [node.get_prefab_uuid() for node in self.instance_roots]
 
     @property
     def path(self):
@@ -314,6 +545,12 @@ class Asset(Element):
         Element.load(self, file_, index)
         self.file = file_
 
+    def save(self, file_):
+        # lazy加载的Asset，_data在构建Node树时才读取，不能在保存的过程中才构建
+        if not self.materialized and self._referent_uuids is not None:
+            self.project.materialize(self)
+        return Element.save(self, file_)
+
     # def compare_all_instances(self, ctx):
     #     """
     #     :param CompareResult ctx:
@@ -333,8 +570,9 @@ class Asset(Element):
         """
         print 'synchronize', self.relative_path
         assert not self.synchronized
+        self._template = None
 
-        for node in self.root.iterate_instance_roots(False):
+        for node in self.instance_roots:
             uuid_ = node.get_prefab_uuid()
             asset = self.project.get_asset_by_uuid(uuid_)
             if not asset:
@@ -348,7 +586,12 @@ class Asset(Element):
 
             assert asset.synchronized
 
-            node.synchronize(asset.root, ctx, True)
+            node.synchronize(asset.root, ctx, True, asset.template)
+            # Instance可能已经修改，包含它的子树的哈希都需要重新计算
+            parent = node.parent
+            while parent:
+                parent._fingerprint = None
+                parent = parent.parent
 
         self.synchronized = True
 
@@ -371,15 +614,15 @@ class Asset(Element):
         查找引用到prefab的所有asset(prefab/scene)，包含直接/间接引用的。按照依赖关系排序(前面的不依赖后面的)。
         :rtype: list[Asset]
         """
-        assets, result = {self}, set()
-        while assets:
-            referers = set(sum([list(asset.referers) for asset in assets], []))
-            result.update(referers)
-            assets = referers
+        return self.project.reachability.get_referers(self)
 
-        result = list(result)
-        result.sort(key=lambda x: x.depth, reverse=True)  # depth大的在前
-        return result
+    def depends_on(self, other):
+        """
+        :param Asset other:
+        :return: 是否直接/间接引用到other
+        :rtype: bool
+        """
+        return self.project.reachability.depends_on(self, other)
 
 
 class Prefab(Asset):
@@ -401,9 +644,6 @@ class Prefab(Asset):
 
 
 class SceneAsset(Asset):
-    root = None
-    """:type: Scene"""
-
     def load(self, file_, index):
         Asset.load(self, file_, index)
 
@@ -419,21 +659,15 @@ class SceneAsset(Asset):
         查找所有被引用asset(prefab/scene)，包含直接/间接引用的。按照依赖关系排序(前面的不依赖后面的)。
         :rtype: list[Asset]
         """
-        assets, result = {self}, set()
-        while assets:
-            refs = set(sum([list(asset.referents) for asset in assets], []))
-            result.update(refs)
-            assets = refs
-
-        result = list(result)
-        result.sort(key=lambda x: x.depth, reverse=True)  # depth大的在前
-        return result
+        return self.project.reachability.get_referents(self)
 
     def __str__(self):
         return '<SceneAsset path=%s/>' % self.relative_path
 
 
 class Node(Element):
+    __slots__ = ('root_element', 'parent', 'children', 'components', 'prefab_info', '_id', 'position', 'size',
+                 '_child_index', '_component_index', '_root_node', '_path_in_root', '_instance_root', '_fingerprint')
 
     def __init__(self, project, parent, root_element=None):
         """
@@ -444,10 +678,28 @@ class Node(Element):
         Element.__init__(self, project)
         self.root_element = root_element
         self.parent = parent
-        self.children = []
+        # parent不会改变，root也不会
+        self._root_node = parent.root if parent else self
+        # 以下在第一次用到时计算，名字或KdPrefab改变时清空(见_invalidate_ancestry)
+        # 相对于root的路径，root为''
+        self._path_in_root = None
+        """:type: str"""
+        # 还没有计算时为False
+        self._instance_root = False
+        """:type: Node"""
+        # 见get_fingerprint，同步之后清空
+        self._fingerprint = None
+        """:type: (str, (str, str))"""
+        # 为空时是共享的tuple，添加时才创建list(见add_child, add_component)
+        self.children = ()
         """:type: list[Node]"""
-        self.components = []
+        self.components = ()
         """:type: list[Component]"""
+        # name -> child/component，第一次查找时才创建(见get_child_by_name, get_component)
+        self._child_index = None
+        """:type: dict[str, Node]"""
+        self._component_index = None
+        """:type: dict[str, Component]"""
         self.prefab_info = None
         """:type: PrefabInfo"""
         self._id = ""   # Scene中的"_id"
@@ -462,9 +714,7 @@ class Node(Element):
         """
         :rtype: Node
         """
-        if self.parent:
-            return self.parent.root
-        return self
+        return self._root_node
 
     @property
     def name(self):
@@ -475,31 +725,57 @@ class Node(Element):
         if not self.parent:
             assert self.root_element
             return self.root_element.path
-        return '%s/%s' % (self.parent.path, self.name)
+        return '%s/%s' % (self._root_node.root_element.path, self._get_path_in_root())
 
     @property
     def relative_path(self):
         if not self.parent:
             assert self.root_element
             return self.root_element.relative_path
-        return '%s/%s' % (self.parent.relative_path, self.name)
+        return '%s/%s' % (self._root_node.root_element.relative_path, self._get_path_in_root())
 
     @property
     def relative_path_to_asset(self):
-        return os.path.relpath(self.relative_path, self.root.relative_path).replace('\\', '/')
+        return self._get_path_in_root() or '.'
+
+    def _get_path_in_root(self):
+        """
+        :return: 相对于root的路径，由parent的路径拼接而成
+        :rtype: str
+        """
+        if self._path_in_root is None:
+            if not self.parent:
+                self._path_in_root = ''
+            elif not self.parent.parent:
+                self._path_in_root = '%s' % self.name
+            else:
+                self._path_in_root = '%s/%s' % (self.parent._get_path_in_root(), self.name)
+        return self._path_in_root
 
     @property
     def instance_root(self):
         """
+        最外层的Instance Root(不包括root)
         :rtype: Node
         """
-        node = self
-        root = None
-        while node:
-            if node.get_prefab_uuid() is not None and node.parent is not None:
-                root = node
-            node = node.parent
-        return root
+        if self._instance_root is False:
+            instance_root = self.parent.instance_root if self.parent else None
+            if instance_root is None and self.parent and self.get_prefab_uuid() is not None:
+                instance_root = self
+            self._instance_root = instance_root
+        return self._instance_root
+
+    def _invalidate_ancestry(self, paths, instance_roots):
+        """
+        名字或KdPrefab改变之后，清空子树中缓存的路径和Instance Root
+        :param bool paths:
+        :param bool instance_roots:
+        """
+        for node in self.walk():
+            if paths:
+                node._path_in_root = None
+            if instance_roots:
+                node._instance_root = False
 
     def is_prefab_root(self):
         return self.root_element and isinstance(self.root_element, Prefab)
@@ -513,8 +789,16 @@ class Node(Element):
         :param Node node:
         :rtype: str
         """
-        rel_path = os.path.relpath(self.path, node.path)
-        return rel_path.replace('\\', '/')
+        if self._root_node is not node._root_node:
+            return os.path.relpath(self.path, node.path).replace('\\', '/')
+
+        # 同os.path.relpath
+        mine = self._get_path_in_root().split('/') if self.parent else []
+        theirs = node._get_path_in_root().split('/') if node.parent else []
+        i = 0
+        while i < len(mine) and i < len(theirs) and mine[i] == theirs[i]:
+            i += 1
+        return '/'.join(['..'] * (len(theirs) - i) + mine[i:]) or '.'
 
     def get_relative_node(self, relative_path):
         """
@@ -545,32 +829,96 @@ class Node(Element):
         :param str name:
         :rtype: Node
         """
-        for child in self.children:
-            if child.name == name:
-                return child
+        if not self.children:
+            return None
+        if self._child_index is None:
+            self._child_index = {}
+            for child in self.children:
+                self._child_index.setdefault(child.name, child)
+        return self._child_index.get(name)
 
     def get_component(self, name):
         """
         :param str name:
         :rtype: Component
         """
-        for component in self.components:
-            if component.name == name:
-                return component
+        if not self.components:
+            return None
+        if self._component_index is None:
+            self._component_index = {}
+            for component in self.components:
+                self._component_index.setdefault(component.name, component)
+        return self._component_index.get(name)
 
     def get_components(self, name):
         """
         :param str name:
-        :rtype: Component
+        :rtype: list[Component]
         """
-        return [c for c in self.components if c.name == name]
+        # R2: 每一个Node的Component不可重复
+        component = self.get_component(name)
+        return [component] if component else []
 
-    def walk(self):
-        yield self
+    def add_child(self, child):
+        """
+        :param Node child: 已经有名字
+        """
+        if not self.children:
+            self.children = []
+        self.children.append(child)
+        if self._child_index is not None:
+            self._child_index.setdefault(child.name, child)
 
-        for child in self.children:
-            for x in child.walk():
-                yield x
+    def remove_child(self, index):
+        """
+        :param int index:
+        """
+        child = self.children.pop(index)
+        if self._child_index is not None and self._child_index.get(child.name) is child:
+            del self._child_index[child.name]
+
+    def add_component(self, component):
+        """
+        :param Component component: 已经有__type__
+        """
+        if not self.components:
+            self.components = []
+        self.components.append(component)
+        if self._component_index is not None:
+            self._component_index.setdefault(component.name, component)
+
+    def remove_component(self, index):
+        """
+        :param int index:
+        """
+        component = self.components.pop(index)
+        if self._component_index is not None and self._component_index.get(component.name) is component:
+            del self._component_index[component.name]
+
+    def walk(self, post_order=False, prune=None):
+        """
+        遍历子树(包括自己)，使用显式的栈，不受递归深度的限制
+        :param bool post_order: 后序遍历(子节点在前)，默认先序
+        :param prune: prune(node)为True时，不遍历node的子节点(node本身仍然会返回)
+        :rtype: Iterator[Node]
+        """
+        if post_order:
+            stack = [(self, False)]
+            while stack:
+                node, expanded = stack.pop()
+                if expanded or (prune and prune(node)):
+                    yield node
+                    continue
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(node.children))
+            return
+
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            if not (prune and prune(node)):
+                stack.extend(reversed(node.children))
 
     def iterate_instance_roots(self, including_self):
         """
@@ -578,13 +926,23 @@ class Node(Element):
         :param bool including_self:
         :rtype: Iterator[Node]
         """
-        if including_self and self.get_prefab_uuid() is not None:
-            yield self
-            return
+        stack = [self] if including_self else list(reversed(self.children))
+        while stack:
+            node = stack.pop()
+            if node.get_prefab_uuid() is not None:
+                yield node
+                continue
+            stack.extend(reversed(node.children))
 
-        for child in self.children:
-            for x in child.iterate_instance_roots(True):
-                yield x
+    def iterate_nodes_with_component(self, name):
+        """
+        先序遍历子树(包括自己)中有某个组件的Node
+        :param str name: 组件的名字(见Component.name)
+        :rtype: Iterator[Node]
+        """
+        for node in self.walk():
+            if node.get_component(name) is not None:
+                yield node
 
     def load(self, file_, index, might_be_instance_root=None):
         Element.load(self, file_, index)
@@ -601,7 +959,6 @@ class Node(Element):
         for component_ref in self.pop_data('_components', {}):
             component = Component(self.project, self)
             component.load(file_, component_ref['__id__'])
-            self.components.append(component)
 
             # Component名字
             try:
@@ -613,6 +970,7 @@ class Node(Element):
             if component.name in names:
                 raise Exception('duplicated component type "%s" in "%s"' % (component.name, self.path))
             names.add(component.name)
+            self.add_component(component)
 
         prefab_ref = self.pop_data('_prefab', None)
         """:type: dict[str, int]"""
@@ -658,7 +1016,7 @@ class Node(Element):
         for child_ref in self.pop_data('_children'):
             child = Node(self.project, self)
             child.load(file_, child_ref['__id__'], might_be_instance_root and not is_instance_root)
-            self.children.append(child)
+            self.add_child(child)
 
             # R1: 每一个Node的Children不可重名
             if child.name in names:
@@ -695,6 +1053,10 @@ class Node(Element):
         data['_position'] = self.position
         data['_contentSize'] = self.size
 
+    def _get_kd_prefab_property(self):
+        kd_prefab = self.get_component('KdPrefab')
+        return kd_prefab.get_property('prefab') if kd_prefab else None
+
     def get_prefab_uuid(self):
         kd_prefab = self.get_component('KdPrefab')
         if kd_prefab:
@@ -703,81 +1065,157 @@ class Node(Element):
                 raise Exception('KdPrefab.prefab is None: %s' % self.relative_path)
             return prefab['__uuid__']
 
-    def synchronize(self, other, ctx, is_instance_root=False):
+    def synchronize(self, other, ctx, is_instance_root=False, template=None):
         """
         :param Node other:
         :param CompareContext ctx:
         :param bool is_instance_root:
+        :param NodeTemplate template: other编译后的模板(见Asset.template)，为None时临时编译
         """
         assert self is not other
 
         if is_instance_root:
             # SS1: 只有当prefab root和instance root的KdPrefab.strategy都为DEFAULT(0)，才会同步
-            my_kd_prefab, other_kd_prefab = self.get_component('KdPrefab'), other.get_component('KdPrefab')
-            my_strategy = my_kd_prefab.get_property('strategy')
-            other_strategy = other_kd_prefab.get_property('strategy')
+            my_strategy = self.get_component('KdPrefab').get_property('strategy')
+            other_strategy = template.strategy if template else other.get_component('KdPrefab').get_property('strategy')
             if my_strategy == KdPrefabStrategy.NEVER or other_strategy == KdPrefabStrategy.NEVER:
                 ctx.ignore(self.name)
                 return
 
+        # 已经一致的子树，不需要逐个比较
+        if self._is_synchronized_with(other, is_instance_root):
+            return
+
+        if template is None:
+            template = NodeTemplate(other)
+        assert template.node is other
+
         if is_instance_root:
             ctx.push(self.relative_path_to_asset, '-> %s' % other.relative_path)
         else:
             ctx.push(self.name)
 
-        self._synchronize_without_children(other, ctx, is_instance_root)
+        name, prefab = self.name, self._get_kd_prefab_property()
+        self._synchronize_without_children(other, ctx, is_instance_root, template)
+        if name != self.name or prefab != self._get_kd_prefab_property():
+            self._invalidate_ancestry(name != self.name, prefab != self._get_kd_prefab_property())
 
         to_remove = []
         for i, my_child in enumerate(self.children):
-            other_child = other.get_child_by_name(my_child.name)
-            if other_child:  # 修改
-                my_child.synchronize(other_child, ctx, False)
+            child_template = template.get_child(my_child.name)
+            if child_template:  # 修改
+                my_child.synchronize(child_template.node, ctx, False, child_template)
             else:  # 删掉多余的子节点
                 # todo: 小心误删
                 to_remove.append(i)
                 ctx.remove(my_child.name)
 
         for i in reversed(to_remove):
-            self.children.pop(i)
+            self.remove_child(i)
 
         # 新增
-        for other_child in other.children:
+        for child_template in template.children:
+            other_child = child_template.node
             my_child = self.get_child_by_name(other_child.name)
             if not my_child:
                 ctx.add(other_child.name)
                 new_child = Node(self.project, self)
-                self.children.append(new_child)
-                new_child.synchronize(other_child, CompareContext(), False)  # 不需要diff
+                new_child.synchronize(other_child, CompareContext(), False, child_template)  # 不需要diff
+                self.add_child(new_child)
 
         # 确保顺序一致
         my_order = {child.name: i for i, child in enumerate(self.children)}
-        other_order = {child.name: i for i, child in enumerate(other.children)}
+        other_order = template.child_order
         if my_order != other_order:
             self.children.sort(cmp=lambda x, y: cmp(other_order[x.name], other_order[y.name]))
             ctx.change('(children order)', my_order, other_order)
         ctx.pop()
 
-    def _synchronize_without_children(self, other, ctx, is_instance_root):
+        # 子树可能已经修改，需要重新计算哈希(子节点同步时已经清空；Instance Root的祖先见Asset.synchronize_all_instances)
+        self._fingerprint = None
+
+    def get_fingerprint(self, is_instance_root=False):
+        """
+        子树的结构哈希(Merkle)，使用和同步相同的忽略规则：两个Node的哈希相同时，同步不会修改任何东西。
+        只有一定会被忽略的属性(NODE_IGNORE_PROPERTIES, SS2, SS3, CR1)只比较是否存在；
+        有条件的忽略(SS5, SS7-SS10, CR2-CR4)不影响哈希，这些属性不同时，仍然需要完整地同步。
+        :param bool is_instance_root: 作为instance root同步时的哈希(不缓存)
+        :return: (哈希, 子树中所有PrefabInfo相同的(fileId, uuid))。子节点或组件重名时哈希为None，
+                 PrefabInfo不一致时(fileId, uuid)为None，都不能跳过同步。
+        :rtype: (str, (str, str))
+        """
+        if is_instance_root:
+            return self._compute_fingerprint(True)
+        if self._fingerprint is None:
+            self._fingerprint = self._compute_fingerprint(False)
+        return self._fingerprint
+
+    def _compute_fingerprint(self, is_instance_root):
+        prefab_info = None
+        if self.prefab_info:
+            prefab_info = (self.prefab_info.file_id, self.prefab_info.uuid)
+            if None in prefab_info:  # 同步时会增加
+                prefab_info = None
+
+        children = []
+        names = set()
+        for child in self.children:
+            digest, child_prefab_info = child.get_fingerprint()
+            if digest is None or child.name in names:
+                return None, None
+            names.add(child.name)
+            children.append(digest)
+            if child_prefab_info != prefab_info:
+                prefab_info = None
+
+        components = []
+        names = set()
+        ignore_components = self.project.ignore_rules.ignore_components
+        for component in self.components:
+            if component.name in names:
+                return None, None
+            names.add(component.name)
+            # SS3: instance root忽略: Widget; CR1: 完全忽略组件(ignore_components)
+            if (is_instance_root and component.name == 'cc.Widget') or component.name in ignore_components:
+                components.append(component.name)
+            else:
+                components.append((component.name, fingerprint_dict(component._data)))
+
+        ignores = FINGERPRINT_INSTANCE_ROOT_IGNORES if is_instance_root else FINGERPRINT_NODE_IGNORES
+        data = (fingerprint_dict(self._data, ignores),
+                self.position is None if '_position' in ignores else fingerprint_value(self.position),
+                self.size is None if '_contentSize' in ignores else fingerprint_value(self.size),
+                self.prefab_info and fingerprint_dict(self.prefab_info._data, FINGERPRINT_PREFAB_INFO_IGNORES),
+                components, children)
+        return hashlib.sha1(repr(data)).digest(), prefab_info
+
+    def _is_synchronized_with(self, other, is_instance_root):
         """
+        哈希相同，且所有PrefabInfo已经是同步之后的值(见PrefabInfo.synchronize)时，同步不会修改任何东西
         :param Node other:
-        :param CompareContext ctx:
         :param bool is_instance_root:
+        :rtype: bool
         """
-        if is_instance_root:
-            ignores = INSTANCE_ROOT_IGNORE_PROPERTIES
-        else:
-            ignores = NODE_IGNORE_PROPERTIES
+        digest, prefab_info = self.get_fingerprint(is_instance_root)
+        other_digest, other_prefab_info = other.get_fingerprint(is_instance_root)
+        if digest is None or digest != other_digest or prefab_info is None or other_prefab_info is None:
+            return False
 
-        # CR4: 忽略特定的prefab中的特定Node的特定组件的特定属性
-        if other._ignore_properties:
-            ignores = ignores.union(other._ignore_properties)
+        if isinstance(self.root.root_element, Prefab):
+            return prefab_info == (self.root.prefab_info.file_id, self.root.root_element.file.uuid)
+        return prefab_info == (other_prefab_info[0], other.root.root_element.file.uuid)
 
-        # SS9: KdLabel,忽略color, font, fontSize, lineHeight
-        kd_label = self.get_component('KdLabel')
-        if kd_label:
-            ignores.add('_color')
+    def _synchronize_without_children(self, other, ctx, is_instance_root, template):
+        """
+        :param Node other:
+        :param CompareContext ctx:
+        :param bool is_instance_root:
+        :param NodeTemplate template:
+        """
+        # SS2, SS9, CR4
+        kd_label = self.get_component('KdLabel') is not None
+        ignores = self.project.ignore_rules.get_node_ignores(is_instance_root, kd_label, other._ignore_properties)
 
-        # SS2: instance root忽略: position, rotation, scale, anchor, size, skew, name
         # synchronize_dict(self, other, self._data, other._data, ctx, ignores)
         Element.synchronize(self, other, ctx, ignores)
 
@@ -790,28 +1228,25 @@ class Node(Element):
         self.prefab_info.synchronize(other.prefab_info, ctx)
 
         # components
-        self._synchronize_components(other, ctx, is_instance_root)
+        self._synchronize_components(other, ctx, is_instance_root, template)
 
         # SS5: Node的size/position受Layout/Widget影响时，不同步相应的x/y/w/h(包括KdLayout/KdWidget)
         # 必须在组件同步完之后处理!
         self._synchronize_position_and_size(other, ctx, is_instance_root, ignores)
 
-    def _synchronize_components(self, other, ctx, is_instance_root):
+    def _synchronize_components(self, other, ctx, is_instance_root, template):
         """
         :param Node other:
         :param CompareContext ctx:
         :param bool is_instance_root:
+        :param NodeTemplate template:
         """
-        ignore_components = self.project.ignore_components
+        rules = self.project.ignore_rules
 
-        # SS9: KdLabel,忽略color, font, fontSize, lineHeight
+        # CR1; SS9: KdLabel,忽略color, font, fontSize, lineHeight
         self_kd_label = self.get_component('KdLabel') is not None
-        other_kd_label = other.get_component('KdLabel') is not None
-        ignore_kd_label = 'KdLabel' in self.project.ignore_components
-
-        if (self_kd_label and other_kd_label) or (self_kd_label and ignore_kd_label) \
-                or (other_kd_label and not ignore_kd_label):
-            ignore_components = ignore_components.union({'cc.LabelOutline', 'KdLabelShadow'})
+        other_kd_label = template.get_component('KdLabel') is not None
+        ignore_components = rules.get_ignore_components(self_kd_label, other_kd_label)
 
         ctx.push('(components)')
         to_remove = []
@@ -824,21 +1259,22 @@ class Node(Element):
             if component.name in ignore_components:
                 continue
 
-            other_component = other.get_component(component.name)
+            other_component = template.get_component(component.name)
             if other_component:
-                component.synchronize(other_component, ctx)
+                other_ignores = template.get_component_ignores(other_component)
+                component.synchronize(other_component, ctx, other_ignores=other_ignores)
             else:
                 # todo: 防止误删
                 to_remove.append(i)
                 ctx.remove(component.name)
 
         for i in reversed(to_remove):
-            self.components.pop(i)
+            self.remove_component(i)
 
         # 新增
         for other_component in other.components:
             # CR1: 完全忽略组件(ignore_components)
-            if other_component.name in self.project.ignore_components:
+            if other_component.name in rules.ignore_components:
                 continue
 
             my_component = self.get_component(other_component.name)
@@ -846,12 +1282,13 @@ class Node(Element):
                 # print '+ component', other_component.name
                 ctx.add(other_component.name)
                 new_component = Component(self.project, self)
-                self.components.append(new_component)
-                new_component.synchronize(other_component, CompareContext())  # 不需要diff
+                new_component.synchronize(other_component, CompareContext(),
+                                          other_ignores=template.get_component_ignores(other_component))  # 不需要diff
+                self.add_component(new_component)
 
         # 确保顺序一致。组件数量可能不一样，比children稍微复杂
         my_names = [component.name for component in self.components]
-        other_names = [component.name for component in other.components]
+        other_names = list(template.component_names)
         if my_names != other_names:
             intersection = set(my_names).intersection(set(other_names))
             for i in xrange(len(other_names)-1, -1, -1):
@@ -955,22 +1392,23 @@ class Node(Element):
             elif overflow == LabelOverflow.RESIZE_HEIGHT:
                 size_ignores.add('height')
 
+        # position和size是共享的只读值(见is_leaf)，只能替换
         if self.position is None:
             assert self.loaded_index == -1
-            self.position = copy.deepcopy(other.position)
+            self.position = other.position
         else:
             if '_position' not in ignores:
                 ctx.push('_position')
-                synchronize_dict(self, other, self.position, other.position, ctx, position_ignores)
+                self.position = synchronize_leaf(self, other, self.position, other.position, ctx, position_ignores)
                 ctx.pop()
 
         if self.size is None:
             assert self.loaded_index == -1
-            self.size = copy.deepcopy(other.size)
+            self.size = other.size
         else:
             if '_contentSize' not in ignores:
                 ctx.push('_contentSize')
-                synchronize_dict(self, other, self.size, other.size, ctx, size_ignores)
+                self.size = synchronize_leaf(self, other, self.size, other.size, ctx, size_ignores)
                 ctx.pop()
 
     def __str__(self):
@@ -978,6 +1416,8 @@ class Node(Element):
 
 
 class Scene(Node):
+    __slots__ = ()
+
     # def clone(self):
     #     raise Exception('could not clone a scene')
     def _save(self, file_, data):
@@ -992,7 +1432,64 @@ class Scene(Node):
         # data.pop('_parent', None)
 
 
+class NodeTemplate(object):
+    """
+    Prefab中的Node作为同步来源时，只和它自己有关的信息：子节点和组件的索引、顺序，组件忽略的属性(CR2-CR4, SS10)等。
+    Prefab同步完之后才会作为来源，所以同一次同步中这些信息不会再变，编译一次，所有Instance共用(见Asset.template)。
+    嵌套的Prefab已经先同步到了这个Prefab里，Node树本身就是展开后的内容。
+    """
+    __slots__ = ('node', 'children', 'child_order', 'component_names', 'strategy', '_child_by_name',
+                 '_component_by_name', '_component_ignores')
+
+    def __init__(self, node):
+        """
+        :param Node node:
+        """
+        rules = node.project.ignore_rules
+        self.node = node
+        self.children = tuple(NodeTemplate(child) for child in node.children)
+        """:type: tuple[NodeTemplate]"""
+        self._child_by_name = {}
+        for child in self.children:
+            self._child_by_name.setdefault(child.node.name, child)
+        self.child_order = {child.name: i for i, child in enumerate(node.children)}
+
+        self.component_names = tuple(component.name for component in node.components)
+        self._component_by_name = {}
+        self._component_ignores = {}
+        for component in node.components:
+            self._component_by_name.setdefault(component.name, component)
+            self._component_ignores[component] = rules.get_source_ignores(component)
+
+        # SS1
+        kd_prefab = node.get_component('KdPrefab')
+        self.strategy = kd_prefab.get_property('strategy') if kd_prefab else None
+
+    def get_child(self, name):
+        """
+        :param str name:
+        :rtype: NodeTemplate
+        """
+        return self._child_by_name.get(name)
+
+    def get_component(self, name):
+        """
+        :param str name:
+        :rtype: Component
+        """
+        return self._component_by_name.get(name)
+
+    def get_component_ignores(self, component):
+        """
+        :param Component component: node的组件
+        :rtype: frozenset[str]
+        """
+        return self._component_ignores[component]
+
+
 class Component(Element):
+    __slots__ = ('node', '_name')
+
     def __init__(self, project, node):
         """
         :param Project project:
@@ -1000,6 +1497,9 @@ class Component(Element):
         """
         Element.__init__(self, project)
         self.node = node
+        # 脚本名(见name)
+        self._name = None
+        """:type: str"""
 
     def root(self):
         """
@@ -1019,14 +1519,22 @@ class Component(Element):
 
     @property
     def name(self):
-        return self.project.get_component_name(self.type)
+        """
+        cc.xxx或者脚本名，只解析一次(加载时)
+        :rtype: str
+        """
+        if self._name is None:
+            self._name = self.project.get_component_name(self.type)
+        return self._name
 
     def load(self, file_, index):
         Element.load(self, file_, index)
 
         node_ref = self.pop_data('node', None)
-        _ = node_ref
-        if node_ref is not None:
+        if len(file_.elements[index]) > 1:
+            # 复制的数据中没有node(已被第一个Component pop掉)
+            print 'Reused component:', self.path
+        elif node_ref is not None:
             if node_ref['__id__'] != self.node.loaded_index:
                 # A component could be shared by multiple Node
                 print 'Reused component:', self.path
@@ -1064,39 +1572,27 @@ class Component(Element):
     def _save(self, file_, data):
         data['node'] = create_element_ref(self.node.saved_index)
 
-    def synchronize(self, other, ctx, ignore_properties=set()):
+    def synchronize(self, other, ctx, ignore_properties=set(), other_ignores=None):
         """
         :param Component other:
         :param CompareContext ctx:
         :param set[str] ignore_properties:
+        :param frozenset[str] other_ignores: 见IgnoreRules.get_source_ignores，已经编译过时(见NodeTemplate)不必重新计算
         """
         assert isinstance(other, Component)
         # 否则没有self.name
         self._data['__type__'] = other._data['__type__']
+        self._name = other.name
 
-        # CR2: 忽略组件的指定属性(ignore_component_properties)
-        ignores = self.project.ignore_component_properties.get(self.name, set())
-        """:type: set[str]"""
-
-        # CR3: 忽略组件的空属性(ignore_component_properties_if_empty)，空指0, "", [], null等，或不存在
-        for property_name in self.project.ignore_component_properties_if_empty.get(self.name, set()):
-            if not other._data.get(property_name):
-                ignores = ignores.union([property_name])
-
-        # CR4: 忽略特定的prefab中的特定Node的特定组件的特定属性
-        if other._ignore_properties:
-            ignores = ignores.union(other._ignore_properties)
+        rules = self.project.ignore_rules
+        # CR2-CR4, SS10: 只和other有关
+        if other_ignores is None:
+            other_ignores = rules.get_source_ignores(other)
 
         # SS8: KdText,忽略KdLabel.string, Sprite.spriteFrame
-        ignores = ignores.union(self.ignore_by_kd_text(other))
-
         # SS9: KdLabel,忽略color, font, fontSize, lineHeight
-        ignores = ignores.union(self.ignore_by_kd_label(other))
-
-        # SS10: KdText的i18nKey和args都为空时，不同步
-        if self.name == 'KdText':
-            if not other.get_property('_N$i18nKey') and not other.get_property('args'):
-                ignores = ignores.union(['_N$i18nKey', 'args'])
+        ignores = rules.get_component_ignores(other_ignores, self.ignore_by_kd_text(other),
+                                              self.ignore_by_kd_label(other))
 
         ctx.push(self.name)
         # synchronize_dict(self, other, self._data, other._data, ctx, ignores=ignores)
@@ -1106,42 +1602,32 @@ class Component(Element):
     def ignore_by_kd_text(self, other):
         """
         :param Component other:
-        :rtype: set[str]
+        :rtype: frozenset[str]
         """
-        if self.name not in {'cc.Label', 'cc.Sprite'}:
-            return set()
+        if self.name not in KD_TEXT_IGNORE_PROPERTIES:
+            return EMPTY_SET
 
         self_kd_text = self.node.get_component('KdText') is not None
         other_kd_text = other.node.get_component('KdText') is not None
-        ignore_kd_text = 'KdText' in self.project.ignore_components
-        if (self_kd_text and other_kd_text) or (self_kd_text and ignore_kd_text) \
-                or (other_kd_text and not ignore_kd_text):
-            if self.name == 'cc.Label':
-                return {'_N$string'}
-            elif self.name == 'cc.Sprite':
-                # 不要忽略_atlas，因为KdText有可能不修改_atlas
-                return {'_spriteFrame'}
+        if self.project.ignore_rules.is_kd_text_applied(self_kd_text, other_kd_text):
+            return KD_TEXT_IGNORE_PROPERTIES[self.name]
 
-        return set()
+        return EMPTY_SET
 
     def ignore_by_kd_label(self, other):
         """
         :param Component other:
-        :rtype: set[str]
+        :rtype: frozenset[str]
         """
         if self.name != 'cc.Label':
-            return set()
+            return EMPTY_SET
 
         self_kd_label = self.node.get_component('KdLabel') is not None
         other_kd_label = other.node.get_component('KdLabel') is not None
-        ignore_kd_label = 'KdLabel' in self.project.ignore_components
-
-        if (self_kd_label and other_kd_label) or (self_kd_label and ignore_kd_label) \
-                or (other_kd_label and not ignore_kd_label):
-            if self.name == 'cc.Label':
-                return {'_isSystemFontUsed', '_N$file', '_lineHeight', '_fontSize', '_actualFontSize'}
+        if self.project.ignore_rules.is_kd_label_applied(self_kd_label, other_kd_label):
+            return KD_LABEL_IGNORE_PROPERTIES
 
-        return set()
+        return EMPTY_SET
 
     def __str__(self):
         return '<%s name=%s node=%s/>' % (self.__class__.__name__, self.name, self.node.relative_path)
@@ -1154,17 +1640,39 @@ def check_value(val):
     if val is None:
         return
 
-    if isinstance(val, (dict, OrderedDict)):
-        if len(val) == 1 and '__uuid__' in val:
-            return
+    if isinstance(val, (dict, OrderedDict)) and is_leaf(val):
+        return
 
-        if len(val) == 1 and 'uuid' in val:  # "_N$horizontalScrollBar": { "uuid": null },
-            return
+    raise Exception('invalid value: %s' % val)
 
-        if val.get('__type__') in {'cc.Vec2', 'cc.Color', 'cc.Size'}:
-            return
 
-    raise Exception('invalid value: %s' % val)
+def is_leaf(val):
+    """
+    只读的dict：cc.Vec2, cc.Color, cc.Size, {"__uuid__": ...}, {"uuid": ...}，其中只有primitive。
+    加载时，相同的值共享同一个对象(见Project.share_leaf)，所以同步时只能替换，不能修改(见synchronize_leaf)
+    :param dict val:
+    :rtype: bool
+    """
+    if len(val) == 1:
+        # "_N$horizontalScrollBar": { "uuid": null },
+        if '__uuid__' not in val and 'uuid' not in val:
+            return False
+    elif val.get('__type__') not in LEAF_TYPES:
+        return False
+
+    for v in val.itervalues():
+        if v is not None and not is_primitive(v):
+            return False
+    return True
+
+
+def intern_string(s):
+    """
+    :param unicode s:
+    :return: 与s相等的共享字符串(unicode不能用intern)
+    :rtype: unicode
+    """
+    return _interned_strings.setdefault(s, s)
 
 
 # class Button(Component):
@@ -1204,6 +1712,8 @@ def check_value(val):
 
 
 class Value(object):
+    __slots__ = ()
+
     def save(self, file_):
         """
         :param FileOutput file_:
@@ -1230,6 +1740,8 @@ class Value(object):
 
 
 class NodeReference(Value):
+    __slots__ = ('_node', '_relative_path')
+
     def __init__(self, node, referenced_node=None):
         """
         :param Node node:
@@ -1279,6 +1791,8 @@ class NodeReference(Value):
 
 
 class ComponentReference(Value):
+    __slots__ = ('_node', '_relative_path', '_component_name')
+
     def __init__(self, node, referenced_component=None):
         """
         :param Node node:
@@ -1369,6 +1883,8 @@ class ComponentReference(Value):
 
 
 class Argument(Element):
+    __slots__ = ('component',)
+
     def __init__(self, project, component):
         Element.__init__(self, project)
         self.component = component
@@ -1383,6 +1899,8 @@ class Argument(Element):
 
 
 class PrefabInfo(Element):
+    __slots__ = ('node',)
+
     def __init__(self, project, node):
         """
         :param Project project:
@@ -1423,7 +1941,7 @@ class PrefabInfo(Element):
 
     @uuid.setter
     def uuid(self, val):
-        self._data['asset'] = {'__uuid__': val} if val else None
+        self._data['asset'] = self.project.share_leaf({'__uuid__': val}) if val else None
 
     def _save(self, file_, data):
         if isinstance(self.node.root.root_element, Prefab):
@@ -1447,67 +1965,405 @@ class PrefabInfo(Element):
         ctx.pop()
 
 
-class Project(object):
-    def __init__(self, path):
-        self.ignore_components = set()
-        """:type: set[str]"""
-        self.ignore_component_properties = {}
-        """:type: dict[str, set[str]]"""
-        self.ignore_component_properties_if_empty = {}
-        """:type: dict[str, set[str]]"""
-        self.ignore_prefabs = {}
-        """:type: dict[str, dict[str, list[str]]]"""
+class IgnoreRules(object):
+    """
+    同步时忽略的组件和属性(SS2, SS8-SS10, CR1-CR4)，由ccc_helper.yaml和内置的规则编译而成(见Project.ignore_rules)。
+    每种规则只和少数几个条件有关，按这些条件(签名)缓存计算结果，所有Node和组件共用同一个只读的frozenset。
+    """
 
-        self.path = os.path.realpath(path)
-        self.name = os.path.split(self.path)[-1]
+    def __init__(self, project):
+        """
+        :param Project project:
+        """
+        # CR1: 完全忽略组件(ignore_components)
+        self.ignore_components = frozenset(project.ignore_components)
+        # SS9: 有KdLabel时还要忽略的组件
+        self._label_ignore_components = self.ignore_components.union({'cc.LabelOutline', 'KdLabelShadow'})
+        # CR2: 忽略组件的指定属性(ignore_component_properties)
+        self._component_properties = {k: frozenset(v) for k, v in project.ignore_component_properties.iteritems()}
+        # CR3: 忽略组件的空属性(ignore_component_properties_if_empty)
+        self._component_properties_if_empty = {k: tuple(sorted(v)) for k, v in
+                                               project.ignore_component_properties_if_empty.iteritems()}
+        self._kd_text_ignored = 'KdText' in self.ignore_components
+        self._kd_label_ignored = 'KdLabel' in self.ignore_components
+
+        self._node_ignores = {}
+        """:type: dict[tuple, frozenset[str]]"""
+        self._source_ignores = {}
+        """:type: dict[tuple, frozenset[str]]"""
+        self._component_ignores = {}
+        """:type: dict[tuple, frozenset[str]]"""
+
+    def is_kd_text_applied(self, my_kd_text, other_kd_text):
+        """
+        SS8: 同步之后Node会有KdText(或者忽略了KdText，保留Instance中的)
+        :param bool my_kd_text:
+        :param bool other_kd_text:
+        :rtype: bool
+        """
+        return (my_kd_text and other_kd_text) or (my_kd_text and self._kd_text_ignored) \
+            or (other_kd_text and not self._kd_text_ignored)
 
-        self._uuid_to_assets = {}
-        """:type: dict[str, Asset]"""
-        
-        self._path_to_assets = {}
-        """:type: dict[str, Asset]"""
-        
-        self._component_id_to_names = {}
-        """:type: dict[str, str]"""
+    def is_kd_label_applied(self, my_kd_label, other_kd_label):
+        """
+        SS9: 同SS8
+        :param bool my_kd_label:
+        :param bool other_kd_label:
+        :rtype: bool
+        """
+        return (my_kd_label and other_kd_label) or (my_kd_label and self._kd_label_ignored) \
+            or (other_kd_label and not self._kd_label_ignored)
 
-    def load(self):
-        self._load_setting()
+    def get_node_ignores(self, is_instance_root, kd_label, other_ignores):
+        """
+        :param bool is_instance_root: SS2
+        :param bool kd_label: Instance中的Node有KdLabel(SS9)
+        :param frozenset[str] other_ignores: Prefab中的Node忽略的属性(CR4)
+        :rtype: frozenset[str]
+        """
+        key = is_instance_root, kd_label, other_ignores
+        ignores = self._node_ignores.get(key)
+        if ignores is None:
+            # SS2: instance root忽略: position, rotation, scale, anchor, size, skew, name
+            ignores = set(INSTANCE_ROOT_IGNORE_PROPERTIES if is_instance_root else NODE_IGNORE_PROPERTIES)
+            # CR4: 忽略特定的prefab中的特定Node的特定组件的特定属性
+            ignores.update(other_ignores)
+            # SS9: KdLabel,忽略color, font, fontSize, lineHeight
+            if kd_label:
+                ignores.add('_color')
+            ignores = self._node_ignores[key] = frozenset(ignores)
+        return ignores
+
+    def get_ignore_components(self, my_kd_label, other_kd_label):
+        """
+        :param bool my_kd_label:
+        :param bool other_kd_label:
+        :rtype: frozenset[str]
+        """
+        if self.is_kd_label_applied(my_kd_label, other_kd_label):
+            return self._label_ignore_components
+        return self.ignore_components
 
-        cwd = os.getcwd()
-        os.chdir(self.path)
-        errors = 0
-        try:
-            self._load_component_names()
-            errors += self._load_assets()
-            if not errors:
-                self._sort_assets()
-        finally:
-            os.chdir(cwd)
+    def get_source_ignores(self, component):
+        """
+        作为同步来源时，只由组件自己决定的忽略的属性(CR2-CR4, SS10)
+        :param Component component:
+        :rtype: frozenset[str]
+        """
+        name = component.name
+        # CR3: 空指0, "", [], null等，或不存在
+        empty = tuple(property_name for property_name in self._component_properties_if_empty.get(name, ())
+                      if not component._data.get(property_name))
+        # SS10: KdText的i18nKey和args都为空时，不同步
+        kd_text_empty = name == 'KdText' and not component.get_property('_N$i18nKey') \
+            and not component.get_property('args')
+
+        key = name, empty, component._ignore_properties, kd_text_empty
+        ignores = self._source_ignores.get(key)
+        if ignores is None:
+            ignores = set(self._component_properties.get(name, ()))
+            ignores.update(empty)
+            ignores.update(component._ignore_properties)
+            if kd_text_empty:
+                ignores.update(['_N$i18nKey', 'args'])
+            ignores = self._source_ignores[key] = frozenset(ignores)
+        return ignores
+
+    def get_component_ignores(self, source_ignores, kd_text_ignores, kd_label_ignores):
+        """
+        :param frozenset[str] source_ignores: 见get_source_ignores
+        :param frozenset[str] kd_text_ignores: SS8(见Component.ignore_by_kd_text)
+        :param frozenset[str] kd_label_ignores: SS9(见Component.ignore_by_kd_label)
+        :rtype: frozenset[str]
+        """
+        if not kd_text_ignores and not kd_label_ignores:
+            return source_ignores
+
+        key = source_ignores, kd_text_ignores, kd_label_ignores
+        ignores = self._component_ignores.get(key)
+        if ignores is None:
+            ignores = self._component_ignores[key] = source_ignores.union(kd_text_ignores, kd_label_ignores)
+        return ignores
+
+
+class AssetRegistry(object):
+    """
+    Project中所有Asset的索引: uuid, path(relative to assets), Prefab的fileId(Prefab Root的PrefabInfo.fileId)。
+    增加/删除Asset时同时更新所有索引。lazy加载的Prefab，在构建Node树之后才有fileId(见Project.materialize)。
+    复制的Prefab文件fileId相同，按照加入的顺序返回第一个。
+    """
+
+    def __init__(self):
+        self._by_uuid = {}
+        """:type: dict[str, Asset]"""
+        self._by_path = {}
+        """:type: dict[str, Asset]"""
+        self._by_file_id = {}
+        """:type: dict[str, list[Prefab]]"""
+        # 已经加入_by_file_id的Prefab(unload之后fileId仍然有效)
+        self._file_ids = {}
+        """:type: dict[Prefab, str]"""
+
+    def __len__(self):
+        return len(self._by_uuid)
+
+    def __iter__(self):
+        return self._by_uuid.itervalues()
+
+    def add(self, asset):
+        """
+        增加Asset，或者在Asset的Node树构建之后更新它的fileId
+        :param Asset asset:
+        """
+        self._by_uuid[asset.file.uuid] = asset
+        self._by_path[asset.file.relative_path] = asset
+        if isinstance(asset, Prefab) and asset.materialized and asset not in self._file_ids:
+            self._file_ids[asset] = asset.get_file_id()
+            self._by_file_id.setdefault(self._file_ids[asset], []).append(asset)
+
+    def remove(self, asset):
+        """
+        :param Asset asset:
+        """
+        for key, index in ((asset.file.uuid, self._by_uuid), (asset.file.relative_path, self._by_path)):
+            if index.get(key) is asset:
+                del index[key]
+        if asset in self._file_ids:
+            file_id = self._file_ids.pop(asset)
+            self._by_file_id[file_id].remove(asset)
+            if not self._by_file_id[file_id]:
+                del self._by_file_id[file_id]
+
+    def has_file_id(self, asset):
+        """
+        :param Prefab asset:
+        :return: asset的fileId是否已经加入索引
+        :rtype: bool
+        """
+        return asset in self._file_ids
+
+    def get_by_uuid(self, uuid_):
+        """
+        :param str uuid_:
+        :rtype: Asset|None
+        """
+        return self._by_uuid.get(uuid_)
+
+    def get_by_path(self, path):
+        """
+        :param str path: relative to assets
+        :rtype: Asset|None
+        """
+        return self._by_path.get(path.replace('\\', '/'))
+
+    def get_by_file_id(self, file_id):
+        """
+        :param str file_id:
+        :rtype: Prefab|None
+        """
+        prefabs = self._by_file_id.get(file_id)
+        return prefabs[0] if prefabs else None
+
+
+class Reachability(object):
+    """
+    Asset之间的传递依赖关系。每个Asset直接/间接的referers和referents各用一个位集(int)表示，
+    第i位对应排好序的第i个Asset(见Project.sorted_assets)，所以按位遍历的结果就是依赖顺序。
+    构建需要O(V+E)次位运算，之后的查询不需要遍历依赖图。
+    引用关系改变(如watch/daemon中reload_assets)之后不做增量更新，而是在下次查询时整个重建：
+    重新排序(Project._compute_depths)本身就是O(V+E)，而且位的序号跟随排序，任何Asset的位置改变时，所有位集都要重新编号。
+    """
+
+    def __init__(self, sorted_assets):
+        """
+        :param list[Asset] sorted_assets: 被引用的在前
+        """
+        self._assets = list(sorted_assets)
+        self._positions = {asset: i for i, asset in enumerate(self._assets)}
+
+        self._referents = {}
+        """:type: dict[Asset, int]"""
+        for asset in self._assets:
+            bits = 0
+            for referent in asset.referents:
+                bits |= self._referents[referent] | 1 << self._positions[referent]
+            self._referents[asset] = bits
+
+        self._referers = {}
+        """:type: dict[Asset, int]"""
+        for asset in reversed(self._assets):
+            bits = 0
+            for referer in asset.referers:
+                bits |= self._referers[referer] | 1 << self._positions[referer]
+            self._referers[asset] = bits
+
+    def get_position(self, asset):
+        """
+        :param Asset asset:
+        :return: 在依赖顺序中的位置
+        :rtype: int
+        """
+        return self._positions[asset]
+
+    def depends_on(self, asset, other):
+        """
+        :param Asset asset:
+        :param Asset other:
+        :return: asset是否直接/间接引用到other
+        :rtype: bool
+        """
+        return bool(self._referents[asset] >> self._positions[other] & 1)
+
+    def get_referers(self, asset):
+        """
+        :param Asset asset:
+        :return: 直接/间接引用到asset的，按照依赖顺序
+        :rtype: list[Asset]
+        """
+        return self._to_assets(self._referers[asset])
 
+    def get_referents(self, asset):
+        """
+        :param Asset asset:
+        :return: asset直接/间接引用到的，按照依赖顺序
+        :rtype: list[Asset]
+        """
+        return self._to_assets(self._referents[asset])
+
+    def _to_assets(self, bits):
+        result = []
+        while bits:
+            lowest = bits & -bits
+            result.append(self._assets[lowest.bit_length() - 1])
+            bits ^= lowest
+        return result
+
+
+class Project(object):
+    def __init__(self, path, use_cache=False):
+        """
+        :param str path:
+        :param bool use_cache: 是否使用AssetCache
+        """
+        self.ignore_components = set()
+        """:type: set[str]"""
+        self.ignore_component_properties = {}
+        """:type: dict[str, set[str]]"""
+        self.ignore_component_properties_if_empty = {}
+        """:type: dict[str, set[str]]"""
+        self.ignore_prefabs = {}
+        """:type: dict[str, dict[str, list[str]]]"""
+        # 见ignore_rules
+        self._ignore_rules = None
+        """:type: IgnoreRules"""
+
+        self.path = os.path.realpath(path)
+        self.name = os.path.split(self.path)[-1]
+
+        self.registry = AssetRegistry()
+        """:type: AssetRegistry"""
+        # 按照依赖关系排序，被引用的在前(见_compute_depths)
+        self.sorted_assets = []
+        """:type: list[Asset]"""
+        # 见reachability
+        self._reachability = None
+        """:type: Reachability"""
+
+        self._component_id_to_names = {}
+        """:type: dict[str, str]"""
+        # 相同的只读值共享同一个对象(见share_leaf)
+        self._leaves = {}
+        """:type: dict[tuple, dict]"""
+        # KdPrefab的__type__(一般只有一个)
+        self._kd_prefab_types = set()
+        """:type: set[str]"""
+
+        # 自定义组件的名字
+        self.components = ComponentRegistry(self, use_cache)
+        """:type: ComponentRegistry"""
+
+        self.cache = AssetCache(self) if use_cache else None
+        """:type: AssetCache"""
+        # lazy加载/scan时，从索引中创建Asset的stub
+        self.index = ProjectIndex(self) if use_cache else None
+        """:type: ProjectIndex"""
+
+    def load(self, jobs=1, lazy=False):
+        """
+        :param int jobs: 解析Asset的进程数
+        :param bool lazy: 只扫描Asset之间的引用关系，Node树在第一次用到时才构建(见Asset.root)。
+                          只处理部分Prefab时(如sync a.prefab)，不会加载无关的Asset。
+        """
+        errors = self._load_and_sort_assets(jobs, lazy)
         errors += self._check_ignore_prefabs()
 
         if errors > 0:
             raise Exception('Load failed.')
 
+    def scan(self):
+        """
+        只扫描Asset之间的引用关系(referents, referers, depth)，不构建任何Node。
+        Asset的Node树在第一次用到时才构建(同load(lazy=True))，但是不会检查ignore_prefabs。
+        """
+        if self._load_and_sort_assets(1, True) > 0:
+            raise Exception('Scan failed.')
+
+    def _load_and_sort_assets(self, jobs, lazy):
+        """
+        :param int jobs:
+        :param bool lazy:
+        :return: 错误数
+        :rtype: int
+        """
+        self._load_setting()
+
+        cwd = os.getcwd()
+        os.chdir(self.path)
+        errors = 0
+        try:
+            self._load_component_names()
+            if lazy and self.index:
+                errors += self._load_asset_stubs_from_index()
+            else:
+                errors += self._load_assets(jobs, lazy)
+            if not errors:
+                self._sort_assets()
+                if lazy and self.index:
+                    self.index.update_depths(self.iterate_assets())
+        finally:
+            os.chdir(cwd)
+        return errors
+
     def _check_ignore_prefabs(self):
         errors = 0
 
-        for path, elements in self.ignore_prefabs.iteritems():
+        for path in self.ignore_prefabs:
             asset = self.get_asset_by_path(path)
             if not asset:
                 print 'Asset not found: ', path
                 errors += 1
                 continue
 
-            for element_path, properties in elements.iteritems():
-                element = asset.get_element_by_path(element_path)
-                if not element:
-                    print 'Element not found:', element_path
-                    errors += 1
-                    continue
-                element.ignore(properties)
+            for element_path in self._apply_ignore_prefabs(asset):
+                print 'Element not found:', element_path
+                errors += 1
         return errors
 
+    def _apply_ignore_prefabs(self, asset):
+        """
+        :param Asset asset:
+        :return: 找不到的Element
+        :rtype: list[str]
+        """
+        not_found = []
+        for element_path, properties in self.ignore_prefabs.get(asset.relative_path, {}).iteritems():
+            element = asset.get_element_by_path(element_path)
+            if not element:
+                not_found.append(element_path)
+                continue
+            element.ignore(properties)
+        return not_found
+
     def _load_setting(self):
         yaml_path = os.path.join(self.path, 'ccc_helper.yaml')
         if not os.path.exists(yaml_path):
@@ -1526,33 +2382,80 @@ class Project(object):
         for k, v in self.ignore_component_properties_if_empty.iteritems():
             self.ignore_component_properties_if_empty[k] = set(v)
 
-        self.ignore_prefabs = setting.get('ignore_prefabs', {})
+        self.ignore_prefabs = {k.replace('\\', '/'): v for k, v in setting.get('ignore_prefabs', {}).iteritems()}
+        self._ignore_rules = None
 
-    # noinspection SpellCheckingInspection
     def _load_component_names(self):
-        # Custom components names are stored in bundle.project.js
-        bundle_js = os.path.join('library', 'bundle.project.js')
-        bundle = open(bundle_js).read()
-        # cc._RFpush(module, '4c3c5p1IVNIn7SN0Moet2KO', 'KdPrefab');
-        pairs = re.findall('cc\._RFpush\(\s*module\s*,\s*\'(.+?)\'\s*,\s*\'(.+?)\'\s*\);', bundle, re.M)
-        # noinspection PyTypeChecker
-        self._component_id_to_names = dict(pairs)
+        self._component_id_to_names = self.components.load()
+        self._kd_prefab_types = {id_ for id_, name in self._component_id_to_names.iteritems() if name == 'KdPrefab'}
 
-    def _load_assets(self):
-        errors = 0
+    def _load_assets(self, jobs=1, lazy=False):
+        """
+        :param int jobs: 解析Asset的进程数
+        :param bool lazy: 只创建Asset的stub
+        :return: 错误数
+        :rtype: int
+        """
+        paths = []
         for p, ds, fs in os.walk('assets'):
             for f in fs:
                 if f.endswith('.meta'):
                     continue
                 fp = os.path.join(p, f)
                 assert fp.startswith('assets/') or fp.startswith('assets\\')
-                fp = fp[7:]  # remove 'assets/'
-                try:
+                paths.append(fp[7:])  # remove 'assets/'
+
+        if jobs > 1 and not lazy:
+            return self._load_assets_in_parallel(paths, jobs)
+
+        errors = 0
+        for fp in paths:
+            try:
+                if lazy:
+                    self.create_asset_stub(fp)
+                else:
                     self.load_one_asset(fp)
-                except Exception, e:
-                    traceback.print_exc()
-                    print 'Load Error:', fp, str(e)
+            except Exception, e:
+                traceback.print_exc()
+                print 'Load Error:', fp, str(e)
+                errors += 1
+        return errors
+
+    def _load_assets_in_parallel(self, paths, jobs):
+        """
+        在子进程中解析和校验Asset，结果pickle后传回主进程。命中缓存的Asset直接在主进程中加载。
+        :param list[str] paths: relative to assets
+        :param int jobs:
+        :rtype: int
+        """
+        errors = 0
+        to_parse = []
+        for fp in paths:
+            if get_asset_class(fp) is None:
+                continue
+            asset = self.cache.load(fp) if self.cache else None
+            if asset:
+                self._add_asset(asset)
+            else:
+                to_parse.append(fp)
+
+        if not to_parse:
+            return errors
+
+        pool = multiprocessing.Pool(min(jobs, len(to_parse)), _init_load_worker, (self.path, self.cache is not None))
+        try:
+            for fp, data, error in pool.imap(_load_asset_in_worker, to_parse):
+                if error:
+                    trace, message = error
+                    sys.stderr.write(trace)
+                    print 'Load Error:', fp, message
                     errors += 1
+                    continue
+                self._add_asset(loads_asset(self, data))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
         return errors
 
     def load_one_asset(self, relative_path):
@@ -1560,23 +2463,95 @@ class Project(object):
         :param str relative_path: relative to assets
         :rtype: Asset|None
         """
-        _, fullname = os.path.split(relative_path)
-        name, ext = os.path.splitext(fullname)
+        root_class = get_asset_class(relative_path)
         asset = None
         """:type: Asset"""
 
-        if ext == '.prefab':
-            print 'loading', relative_path
-            asset = FileInput(self, relative_path).load(Prefab)
-        elif ext == '.fire':
-            print 'loading', relative_path
-            asset = FileInput(self, relative_path).load(SceneAsset)
+        if root_class:
+            asset = self._read_asset(relative_path, root_class)
+            self._add_asset(asset)
+        return asset
 
-        if asset:
-            self._uuid_to_assets[asset.file.uuid] = asset
-            self._path_to_assets[asset.file.relative_path] = asset
+    def _load_asset_stubs_from_index(self):
+        """
+        增量更新ProjectIndex，然后根据索引创建所有Asset的stub(不需要读取没有修改过的文件)
+        :return: 错误数
+        :rtype: int
+        """
+        _, errors = self.index.update()
+        for relative_path, uuid_, instances in self.index.iterate_assets():
+            asset = get_asset_class(relative_path)(self)
+            asset.file = FileInput(self, relative_path, uuid_)
+            asset._referent_uuids = [prefab_uuid for _, prefab_uuid in instances]
+            self._add_asset(asset)
+        return errors
+
+    def create_asset_stub(self, relative_path):
+        """
+        只读取.meta和引用到的Prefab，不构建Node树
+        :param str relative_path: relative to assets
+        :rtype: Asset|None
+        """
+        root_class = get_asset_class(relative_path)
+        if root_class is None:
+            return None
+
+        asset = root_class(self)
+        asset.file = FileInput(self, relative_path)
+        asset._referent_uuids = [uuid_ for _, uuid_ in scan_asset_file(asset.path, self._kd_prefab_types)]
+        self._add_asset(asset)
+        return asset
+
+    def materialize(self, asset):
+        """
+        构建lazy加载的Asset的Node树
+        :param Asset asset:
+        """
+        try:
+            self._read_asset(asset.relative_path, asset.__class__, asset)
+        except:
+            asset.root = None  # 加载失败，下次访问时重试
+            print 'Load Error:', asset.relative_path
+            raise
+        # unload之后重新加载时，也需要忽略(找不到的Element见_check_ignore_prefabs)
+        self._apply_ignore_prefabs(asset)
+        # 构建Node树之后才知道fileId
+        self.registry.add(asset)
+
+    def _add_asset(self, asset):
+        """
+        :param Asset asset:
+        """
+        self.registry.add(asset)
+
+    def _read_asset(self, relative_path, root_class, asset=None):
+        """
+        优先从缓存中读取，缓存失效时才解析文件
+        :param str relative_path: relative to assets
+        :param class root_class:
+        :param Asset asset: 加载到已有的Asset(stub)中
+        :rtype: Asset
+        """
+        if self.cache:
+            cached = self.cache.load(relative_path, asset)
+            if cached:
+                return cached
+
+        print 'loading', relative_path
+        asset = FileInput(self, relative_path).load(root_class, asset)
+        if self.cache:
+            self.cache.save(asset)
         return asset
 
+    def share_leaf(self, leaf):
+        """
+        :param dict leaf: 只读的值，见is_leaf
+        :return: 与leaf相同(包括key的顺序和值的类型)的共享对象
+        :rtype: dict
+        """
+        key = tuple((k, type(v), v) for k, v in leaf.iteritems())
+        return self._leaves.setdefault(key, leaf)
+
     def get_component_name(self, id_):
         if id_.startswith('cc.'):
             return id_
@@ -1590,155 +2565,1451 @@ class Project(object):
         """
         :rtype: collections.Iterable[Asset]
         """
-        return self._uuid_to_assets.itervalues()
+        return iter(self.registry)
 
-    def synchronize_all_instances(self, dry_run):
-        # 按照依赖关系排序
-        assets = self._uuid_to_assets.values()
-        assets.sort(key=lambda x: x.depth, reverse=True)
-        self._synchronized_assets(assets, dry_run, 'synchronize_all_instances')
+    def synchronize_all_instances(self, dry_run, jobs=1):
+        """
+        :param bool dry_run:
+        :param int jobs: 同步Asset的进程数
+        :return: 需要同步(或已同步)的Asset
+        :rtype: list[Asset]
+        """
+        # 已经按照依赖关系排好序
+        assets = list(self.sorted_assets)
+        return self._synchronized_assets(assets, dry_run, 'synchronize_all_instances', jobs)
 
-    def synchronize_prefab(self, prefab, dry_run):
+    def synchronize_prefab(self, prefab, dry_run, jobs=1):
         """
         将prefab递归同步到引用到它的scene/prefab中
         :param Prefab prefab:
         :param bool dry_run:
-        :return:
+        :param int jobs: 同步Asset的进程数
+        :return: 需要同步(或已同步)的Asset
+        :rtype: list[Asset]
+        """
+        assets = prefab.search_referers()
+        assets.insert(0, prefab)
+        return self._synchronized_assets(assets, dry_run, 'synchronize %s' % prefab.relative_path, jobs)
+
+    def synchronize_changed_assets(self, relative_paths, dry_run, jobs=1):
+        """
+        同步修改过的Prefab/Scene，以及引用到它们的Asset(见get_changed_paths)。它们引用到的其他Prefab只作为同步的来源。
+        :param list[str] relative_paths: relative to assets，找不到的(已删除)忽略
+        :param bool dry_run:
+        :param int jobs: 同步Asset的进程数
+        :return: 需要同步(或已同步)的Asset
+        :rtype: list[Asset]
+        """
+        assets = self.search_changed_assets(relative_paths)
+        if not assets:
+            print 'No prefab/scene changed'
+            return []
+        sources = set().union(*(asset.referents for asset in assets))
+        message = 'synchronize %s' % ' '.join(asset.relative_path for asset in assets)
+        return self._synchronized_assets(assets, dry_run, message, jobs, sources)
+
+    def search_changed_assets(self, relative_paths):
+        """
+        :param list[str] relative_paths: relative to assets
+        :return: relative_paths中的Asset以及引用到它们的Asset，按照同步的顺序
+        :rtype: list[Asset]
+        """
+        targets = set()
+        for relative_path in relative_paths:
+            asset = self.get_asset_by_path(relative_path)
+            if asset:
+                targets.add(asset)
+                targets.update(asset.search_referers())
+        return sorted(targets, key=self.reachability.get_position)
+
+    def _synchronized_assets(self, assets, dry_run, message, jobs=1, sources=()):
+        """
+        :param list[Asset] assets: 必须排好序
+        :param bool dry_run:
+        :param int jobs:
+        :param collections.Iterable[Asset] sources: 见_synchronize
+        :return: 需要同步(或已同步)的Asset
+        :rtype: list[Asset]
+        """
+        # 备份
+        backup = Backup(self)
+        backup.log.write('%s\n' % message)
+
+        changed = []
+        for asset, ctx in self._synchronize(assets, sources, jobs):
+            ctx.dump(backup.log)
+
+            if ctx.has_changed():
+                changed.append(asset)
+                if not dry_run:
+                    backup.backup_asset(asset)
+                    FileOutput(self, asset.file.relative_path).save(asset)
+
+        files = 0 if dry_run else len(changed)
+        print 'Modified %s files. For more information, check "%s"' % (files, backup.path)
+        return changed
+
+    def verify_changed_assets(self, relative_paths):
+        """
+        lazy加载之后，重新加载修改过的Asset，检查它们以及引用到它们的Asset中的Instance是否需要同步(不会修改文件)
+        :param collections.Iterable[str] relative_paths: 新增/修改/删除的文件(见ProjectIndex.update)
+        :return: 需要同步的Asset
+        :rtype: list[Asset]
+        """
+        relative_paths = list(relative_paths)
+        # 被删除的Prefab，引用到它的Asset也需要检查
+        referers = set()
+        for relative_path in relative_paths:
+            asset = self.get_asset_by_path(relative_path)
+            if asset:
+                referers.update(asset.search_referers())
+
+        reloaded = self.reload_assets(relative_paths)
+        targets = set(reloaded)
+        for asset in reloaded:
+            targets.update(asset.search_referers())
+        targets.update(asset for asset in referers if self.get_asset_by_path(asset.relative_path) is asset)
+        assets = sorted(targets, key=self.reachability.get_position)
+        # 修改过的Asset引用到的Prefab也要作为同步的来源
+        sources = set().union(*(asset.referents for asset in assets))
+
+        result = []
+        try:
+            for asset, ctx in self._synchronize(assets, sources):
+                if ctx.has_changed():
+                    ctx.dump()
+                    result.append(asset)
+        finally:
+            # dry run时同步修改过的Node树，需要丢弃
+            for asset in assets:
+                if asset.materialized:
+                    asset.unload()
+        return result
+
+    def check_instances(self, assets, max_differences=1, sources=()):
+        """
+        只检查是否一致(verify --check)：不修改Node树，不备份，也不记录修改的内容，找到max_differences个不一致的Instance就停止。
+        哈希(见Node.get_fingerprint)相同的Instance一定是一致的；不同时(可能只是有条件忽略的属性不同)，
+        在这个Instance子树的副本(见copy_node)上同步，看是否有修改。
+        Prefab都一致时，结果和完整的同步相同；Prefab不一致时，引用到它的Asset仍然和文件中的Prefab比较。
+        和_synchronize一样，Prefab不在assets和sources中的Instance不检查。
+        :param list[Asset] assets: 必须排好序
+        :param int max_differences:
+        :param collections.Iterable[Asset] sources: 作为同步的来源，但是自己不需要同步的Prefab
+        :return: [(asset, instance root的路径)]，按照assets的顺序
+        :rtype: list[(Asset, str)]
+        """
+        targets = set(assets)
+        targets.update(sources)
+        differences = []
+        for asset in assets:
+            for node in asset.instance_roots:
+                prefab = self.get_asset_by_uuid(node.get_prefab_uuid())
+                if prefab:
+                    assert isinstance(prefab, Prefab)
+                    if prefab not in targets or node._is_synchronized_with(prefab.root, True):
+                        continue
+
+                    ctx = CompareContext()
+                    copy_node(self, node).synchronize(prefab.root, ctx, True, prefab.template)
+                    if not ctx.has_changed():
+                        continue
+
+                path = node.relative_path_to_asset
+                print 'out of sync: %s (%s)' % (asset.relative_path, path)
+                differences.append((asset, path))
+                if len(differences) >= max_differences:
+                    return differences
+        return differences
+
+    def _synchronize(self, assets, sources=(), jobs=1):
+        """
+        依次同步assets中的所有Instance
+        :param list[Asset] assets: 必须排好序
+        :param collections.Iterable[Asset] sources: 作为同步的来源，但是自己不需要同步的Prefab
+        :param int jobs: 大于1时在子进程中同步(见_synchronize_in_parallel)
+        :return: [(asset, ctx)]，按照assets的顺序
+        :rtype: collections.Iterable[(Asset, CompareContext)]
+        """
+        for asset in self.iterate_assets():
+            asset.synchronized = asset.need_synchronize = False
+        for asset in sources:
+            asset.synchronized = asset.need_synchronize = True
+        for asset in assets:
+            asset.need_synchronize = True
+            asset.synchronized = False
+
+        if jobs > 1 and len(assets) > 1:
+            for result in self._synchronize_in_parallel(assets, jobs):
+                yield result
+            return
+
+        for asset in assets:
+            ctx = CompareContext()
+            ctx.push(asset.relative_path)
+            asset.synchronize_all_instances(ctx)
+            ctx.pop()
+            yield asset, ctx
+
+    def _synchronize_in_parallel(self, assets, jobs):
+        """
+        只有引用关系需要保证顺序：一个Asset引用到的(需要同步的)Prefab都同步完之后，就可以在子进程中同步它。
+        子进程同步之后的Asset pickle后传回主进程，替换主进程中的Node树，再传给引用到它的Asset。
+        每个子进程有自己的任务队列，并保留收到的Prefab，所以每个Prefab最多发给每个子进程一次。
+        子进程的输出和结果都按照assets的顺序返回，与依次同步完全一致。
+        :param list[Asset] assets: 必须排好序
+        :param int jobs:
+        :rtype: collections.Iterable[(Asset, CompareContext)]
+        """
+        indexes = {asset: i for i, asset in enumerate(assets)}
+        waiting = [{x for x in asset.referents if x in indexes} for asset in assets]
+        ready = [i for i in xrange(len(assets)) if not waiting[i]]
+        # pickle后的Asset，同步之后的直接使用子进程传回的
+        dumped = {}
+        results = {}
+        next_ = 0
+
+        def dump(asset):
+            if asset not in dumped:
+                if not asset.materialized:  # lazy加载的Asset，先构建Node树
+                    self.materialize(asset)
+                dumped[asset] = dumps_asset(self, asset)
+            return dumped[asset]
+
+        finished = multiprocessing.Queue()
+        processes, queues = [], []
+        for _ in xrange(min(jobs, len(assets))):
+            tasks = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_synchronize_worker, args=(self.path, tasks, finished))
+            process.daemon = True
+            process.start()
+            processes.append(process)
+            queues.append(tasks)
+        # 已经发给每个子进程的Prefab
+        sent = [set() for _ in processes]
+        idle = range(len(processes))
+        # 序号 -> 正在同步它的子进程
+        running = {}
+        try:
+            while next_ < len(assets):
+                ready.sort()
+                while ready and idle:
+                    i = ready.pop(0)
+                    asset = assets[i]
+                    # 优先交给已经有最多referents的子进程
+                    w = max(idle, key=lambda x: len(sent[x].intersection(asset.referents)))
+                    idle.remove(w)
+                    # 不需要同步的Prefab，只要存在就可以(见Asset.synchronize_all_instances)
+                    referents = [(x.relative_path, x.file.uuid, x.__class__, dump(x) if x.need_synchronize else None)
+                                 for x in asset.referents if x not in sent[w]]
+                    sent[w].update(asset.referents)
+                    queues[w].put((i, dump(asset), referents))
+                    running[i] = w
+
+                while True:
+                    try:
+                        result = finished.get(timeout=1)
+                        break
+                    except Queue.Empty:
+                        # 子进程意外退出时，它的任务永远不会完成
+                        if not all(process.is_alive() for process in processes):
+                            raise Exception('Synchronize failed: worker process exited unexpectedly')
+                i, data, ctx, output, error = pickle.loads(result)
+                idle.append(running.pop(i))
+                asset = assets[i]
+                if error:
+                    trace, message = error
+                    sys.stdout.write(output)
+                    sys.stderr.write(trace)
+                    raise Exception('Synchronize failed: %s %s' % (asset.relative_path, message))
+
+                loads_asset(self, data, asset)
+                asset.synchronized = True
+                dumped[asset] = data
+                results[i] = (pickle.loads(ctx), output)
+                for referer in asset.referers:
+                    j = indexes.get(referer)
+                    if j is not None:
+                        waiting[j].discard(asset)
+                        if not waiting[j]:
+                            ready.append(j)
+
+                while next_ in results:
+                    ctx, output = results.pop(next_)
+                    sys.stdout.write(output)
+                    yield assets[next_], ctx
+                    next_ += 1
+
+            for tasks in queues:
+                tasks.put(None)
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            # 出错时队列中可能还有没有发出的任务，不需要等待
+            for tasks in queues:
+                tasks.cancel_join_thread()
+
+    def get_prefab_by_file_id(self, file_id):
+        """
+        :param str file_id:
+        :rtype: Prefab|None
+        """
+        prefab = self.registry.get_by_file_id(file_id)
+        if prefab is None:
+            # lazy加载的Prefab，构建Node树之后才能加入索引
+            for asset in list(self.iterate_assets()):
+                if isinstance(asset, Prefab) and not self.registry.has_file_id(asset):
+                    if asset.root.prefab_info.file_id == file_id:
+                        return asset
+        return prefab
+
+    def get_asset_by_uuid(self, uuid_):
+        """
+        :param str uuid_:
+        :rtype: Prefab|SceneAsset|None
+        """
+        return self.registry.get_by_uuid(uuid_)
+
+    def get_asset_by_path(self, path):
+        """
+        :param str path: relative to assets
+        :rtype: Asset
+        """
+        return self.registry.get_by_path(path)
+
+    def get_prefab_by_path(self, path):
+        """
+        :param str path: relative to assets
+        :rtype: Prefab
+        """
+        asset = self.get_asset_by_path(path)
+        assert isinstance(asset, Prefab)
+        return asset
+
+    def _sort_assets(self):
+        """
+        对所有Asset按照依赖关系排序。如果A依赖B，B.order < A.order
+        """
+        # 查找每个Asset引用到的其他Asset，形成森林
+        for asset in self.iterate_assets():
+            missing = self._link_asset(asset)
+            if missing:
+                raise Exception('Prefab not found: %s (referenced by %s)' % (missing[0], asset.relative_path))
+        self._compute_depths()
+
+    def _link_asset(self, asset):
+        """
+        :param Asset asset:
+        :return: 找不到的Prefab的uuid
+        :rtype: list[str]
+        """
+        missing = []
+        for uuid_ in asset.get_referent_uuids():
+            prefab = self.get_asset_by_uuid(uuid_)
+            if prefab is None:
+                missing.append(uuid_)
+                continue
+            asset.referents.add(prefab)
+            prefab.referers.add(asset)
+        return missing
+
+    def _unlink_asset(self, asset):
+        """
+        :param Asset asset:
+        """
+        for prefab in asset.referents:
+            prefab.referers.discard(asset)
+        asset.referents = set()
+
+    def _compute_depths(self):
+        """
+        按照拓扑顺序(Kahn算法)计算每个Asset的depth，即从没有被引用的Asset开始的最长路径，O(V+E)。
+        同时得到同步的顺序(见sorted_assets)。
+        """
+        # 所有的树根，depth都为0；所有引用到它的Asset都处理过之后，depth才确定
+        assets = list(self.iterate_assets())
+        for asset in assets:
+            asset.depth = 0
+        referers = {asset: len(asset.referers) for asset in assets}
+        queue = [asset for asset in assets if not asset.referers]
+        for asset in queue:  # 遍历的同时在末尾添加
+            for referent in asset.referents:
+                referent.depth = max(referent.depth, asset.depth + 1)
+                referers[referent] -= 1
+                if referers[referent] == 0:
+                    queue.append(referent)
+
+        if len(queue) < len(assets):
+            cycles = find_cycles([asset for asset in assets if referers[asset] > 0])
+            raise Exception('cyclic reference: %s' % ', '.join(
+                ' -> '.join(asset.relative_path for asset in cycle) for cycle in cycles))
+
+        # depth大的在前(被引用的先同步)，depth相同时保持原来的顺序
+        levels = [[] for _ in xrange(max(asset.depth for asset in assets) + 1 if assets else 0)]
+        for asset in assets:
+            levels[asset.depth].append(asset)
+        self.sorted_assets = [asset for level in reversed(levels) for asset in level]
+        # 位的序号跟随排序，下次用到时重建(见Reachability)
+        self._reachability = None
+
+    @property
+    def reachability(self):
+        """
+        Asset之间的传递依赖关系，排序之后第一次用到时构建
+        :rtype: Reachability
+        """
+        if self._reachability is None:
+            self._reachability = Reachability(self.sorted_assets)
+        return self._reachability
+
+    @property
+    def ignore_rules(self):
+        """
+        ignore_components等设置编译成的查询表，第一次用到时构建。直接修改这些设置之后，需要重置_ignore_rules。
+        :rtype: IgnoreRules
+        """
+        if self._ignore_rules is None:
+            self._ignore_rules = IgnoreRules(self)
+        return self._ignore_rules
+
+    def reload_assets(self, relative_paths):
+        """
+        lazy加载之后，重新加载修改过的Asset(见ProjectIndex.update)，只更新它们的引用关系。
+        Node树在下次用到时才重新构建。
+        :param collections.Iterable[str] relative_paths: 新增/修改/删除的文件(relative to assets)
+        :return: 新增/修改的Asset
+        :rtype: list[Asset]
+        """
+        uuids = {path: (uuid_, instances) for path, uuid_, instances in self.index.iterate_assets()}
+
+        reloaded = []
+        for relative_path in relative_paths:
+            relative_path = relative_path.replace('\\', '/')
+            asset = self.get_asset_by_path(relative_path)
+            if asset:
+                self._unlink_asset(asset)
+                self.registry.remove(asset)
+
+            if relative_path not in uuids:
+                # 已删除
+                if asset:
+                    for referer in asset.referers:
+                        referer.referents.discard(asset)
+                continue
+
+            uuid_, instances = uuids[relative_path]
+            if not asset or asset.__class__ is not get_asset_class(relative_path):
+                asset = get_asset_class(relative_path)(self)
+            asset.file = FileInput(self, relative_path, uuid_)
+            asset._referent_uuids = [prefab_uuid for _, prefab_uuid in instances]
+            asset.root = None
+            self._add_asset(asset)
+            reloaded.append(asset)
+
+        for asset in reloaded:
+            for uuid_ in self._link_asset(asset):
+                print 'Prefab not found: %s (referenced by %s)' % (uuid_, asset.relative_path)
+        # 新增的Prefab可能被其他Asset引用
+        for asset in self.iterate_assets():
+            if len(asset.referents) != len(set(asset.get_referent_uuids())):
+                self._unlink_asset(asset)
+                self._link_asset(asset)
+        self._compute_depths()
+        self.index.update_depths(self.iterate_assets())
+        return reloaded
+
+    def dump_referents(self):
+        for asset in self.iterate_assets():
+            print asset.relative_path
+            for ref in asset.referents:
+                print '   ', ref.relative_path
+
+    def dump_referers(self):
+        for asset in self.iterate_assets():
+            print asset.relative_path
+            for ref in asset.referers:
+                print '   ', ref.relative_path
+
+
+class Backup(object):
+    def __init__(self, project):
+        self.project = project
+        # noinspection SpellCheckingInspection
+        path = os.path.join(project.path, 'ccc_helper_backup', datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S'))
+        # 同一秒内多次同步(如通过daemon)
+        self.path, i = path, 1
+        while os.path.exists(self.path):
+            self.path = '%s-%s' % (path, i)
+            i += 1
+        os.makedirs(self.path)
+        self.log = open(os.path.join(self.path, 'logs.txt'), 'w')
+
+    def backup_asset(self, asset):
+        """
+        :param Asset asset:
+        """
+        dst_path = os.path.join(self.path, asset.file.relative_path)
+        dst_folder = os.path.split(dst_path)[0]
+        if not os.path.exists(dst_folder):
+            os.makedirs(dst_folder)
+        shutil.copy(asset.path, dst_path)
+
+
+class ComponentRegistry(object):
+    """
+    自定义组件的id -> 名字，有两个来源:
+        library/bundle.project.js: cc._RFpush(module, '4c3c5p1IVNIn7SN0Moet2KO', 'KdPrefab');
+        assets/**/*.js.meta: id为压缩后的uuid(见compress_uuid)，名字为脚本的文件名。
+                             没有bundle.project.js，或者ccc还没有重新生成它时(如新增的脚本)也能找到。
+    两者都有时以bundle.project.js为准。
+    use_cache时保存在<project_root>/library/ccc_helper/components.json，
+    bundle.project.js和.meta的size, mtime都没有变化时，不需要重新读取。
+    """
+
+    def __init__(self, project, use_cache):
+        """
+        :param Project project:
+        :param bool use_cache:
+        """
+        self.project = project
+        self.path = os.path.join(project.path, CACHE_PATH, 'components.json') if use_cache else None
+
+    def load(self):
+        """
+        :return: id -> name
+        :rtype: dict[str, str]
+        """
+        cached = self._load_cache()
+
+        bundle_path = os.path.join(self.project.path, 'library', 'bundle.project.js')
+        stat = file_stat(bundle_path)
+        bundle = cached.get('bundle')
+        if stat is None:
+            bundle = None
+        elif not bundle or bundle['stat'] != list(stat):
+            bundle = {'stat': list(stat), 'components': read_bundle_components(bundle_path)}
+
+        scripts = {}
+        known = cached.get('scripts') or {}
+        for relative_path in iterate_script_paths(self.project.path):
+            meta_path = os.path.join(self.project.path, ASSETS_PATH, relative_path + '.meta')
+            stat = file_stat(meta_path)
+            if stat is None:  # ccc还没有生成.meta
+                continue
+            script = known.get(relative_path)
+            if not script or script[:2] != list(stat):
+                script = list(stat) + [json.load(open(meta_path))['uuid']]
+            scripts[relative_path] = script
+
+        data = {'version': INDEX_VERSION, 'bundle': bundle, 'scripts': scripts}
+        if self.path and data != cached:
+            self._save_cache(data)
+
+        def to_str(val):
+            return val.encode('utf-8') if isinstance(val, unicode) else val
+
+        names = {}
+        for relative_path, (_, _, uuid_) in scripts.iteritems():
+            name = os.path.splitext(os.path.basename(relative_path))[0]
+            names[to_str(compress_uuid(uuid_))] = to_str(name)
+        for id_, name in (bundle['components'] if bundle else []):
+            names[to_str(id_)] = to_str(name)
+        return names
+
+    def _load_cache(self):
+        """
+        :rtype: dict
+        """
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        # noinspection PyBroadException
+        try:
+            cached = json.load(open(self.path))
+        except Exception, e:
+            print 'Invalid cache of components: %r' % e
+            return {}
+        return cached if cached.get('version') == INDEX_VERSION else {}
+
+    def _save_cache(self, data):
+        folder = os.path.dirname(self.path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        if os.path.exists(self.path):  # windows下rename不会覆盖
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
+
+
+class AssetCache(object):
+    """
+    已解析(并校验过)的Asset的磁盘缓存，位于<project_root>/library/ccc_helper/assets。
+    每个Asset一个文件，文件内容为header和Asset两个pickle对象。
+    header记录了Asset文件和.meta的size, mtime, sha1，以及ccc_helper.yaml的指纹和自定义组件的名字(的sha1)，
+    任何一个不一致时缓存失效。
+    """
+
+    def __init__(self, project):
+        """
+        :param Project project:
+        """
+        self.project = project
+        self.path = os.path.join(project.path, CACHE_PATH, 'assets')
+        self._settings = None
+
+    @property
+    def settings(self):
+        """
+        ccc_helper.yaml的内容和自定义组件的名字(启动后只计算一次)。只改变了修改时间(checkout, touch)时，缓存仍然有效
+        :rtype: tuple
+        """
+        if self._settings is None:
+            if not self.project._component_id_to_names:  # 还没有加载项目
+                self.project._load_component_names()
+            components = repr(sorted(self.project._component_id_to_names.iteritems()))
+            yaml_path = os.path.join(self.project.path, 'ccc_helper.yaml')
+            self._settings = (file_sha1(yaml_path) if os.path.exists(yaml_path) else None,
+                              hashlib.sha1(components).hexdigest())
+        return self._settings
+
+    def _entry_path(self, relative_path):
+        if isinstance(relative_path, unicode):
+            relative_path = relative_path.encode('utf-8')
+        return os.path.join(self.path, hashlib.sha1(relative_path).hexdigest() + '.pickle')
+
+    def _create_header(self, relative_path):
+        path = os.path.join(self.project.path, ASSETS_PATH, relative_path)
+        return {
+            'version': CACHE_VERSION,
+            'path': relative_path,
+            'file': file_fingerprint(path),
+            'meta': file_fingerprint(path + '.meta'),
+            'settings': self.settings,
+        }
+
+    def load(self, relative_path, asset=None):
+        """
+        :param str relative_path: relative to assets
+        :param Asset asset: 加载到已有的Asset(stub)中
+        :rtype: Asset|None
+        """
+        relative_path = relative_path.replace('\\', '/')
+        entry_path = self._entry_path(relative_path)
+        if not os.path.exists(entry_path):
+            return None
+
+        path = os.path.join(self.project.path, ASSETS_PATH, relative_path)
+        # noinspection PyBroadException
+        try:
+            with open(entry_path, 'rb') as f:
+                header = pickle.load(f)
+                if header.get('version') != CACHE_VERSION or header.get('path') != relative_path \
+                        or header.get('settings') != self.settings:
+                    return None
+
+                # size和mtime都没变时，认为文件没有修改；否则比较sha1
+                fresh = True
+                for key, file_path in (('file', path), ('meta', path + '.meta')):
+                    stat, sha1 = os.stat(file_path), header[key][2]
+                    if (stat.st_size, stat.st_mtime) != header[key][:2]:
+                        fresh = False
+                        if file_sha1(file_path) != sha1:
+                            return None
+                asset = load_asset(self.project, f, asset)
+        except Exception, e:
+            print 'Invalid cache of %s: %r' % (relative_path, e)
+            return None
+
+        if not fresh:  # 内容没变，但是mtime变了(比如git checkout)，更新header
+            self.save(asset)
+        return asset
+
+    def save(self, asset):
+        """
+        :param Asset asset:
+        """
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        entry_path = self._entry_path(asset.relative_path)
+        tmp_path = '%s.%s.tmp' % (entry_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(self._create_header(asset.relative_path), f, pickle.HIGHEST_PROTOCOL)
+                dump_asset(self.project, asset, f)
+            if os.path.exists(entry_path):  # windows下rename不会覆盖
+                os.remove(entry_path)
+            os.rename(tmp_path, entry_path)
+        except (RuntimeError, pickle.PicklingError), e:  # 层级太深时可能超过递归限制
+            print 'Could not cache %s: %s' % (asset.relative_path, e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+
+def dump_asset(project, asset, stream):
+    """
+    pickle Asset的类型和内容(不包括依赖关系)。
+    Project和Asset本身不会被pickle，加载时替换成当前的Project和指定的Asset。
+    :param Project project:
+    :param Asset asset:
+    :param file stream:
+    """
+    def persistent_id(obj):
+        if obj is project:
+            return 'project'
+        if obj is asset:
+            return 'asset'
+        return None
+
+    state = {k: v for k, v in get_state(asset).iteritems() if k not in Asset.GRAPH_ATTRIBUTES}
+    pickler = pickle.Pickler(stream, pickle.HIGHEST_PROTOCOL)
+    # 只对非内置类型的对象调用，比persistent_id快很多
+    pickler.inst_persistent_id = persistent_id
+    pickler.dump(asset.__class__)
+    pickler.dump(state)
+
+
+def load_asset(project, stream, asset=None):
+    """
+    :param Project project:
+    :param file stream:
+    :param Asset asset: 加载到已有的Asset中，为None时新建
+    :rtype: Asset
+    """
+    def persistent_load(pid):
+        if pid == 'project':
+            return project
+        if pid == 'asset':
+            return asset
+        raise pickle.UnpicklingError('unknown persistent id: %s' % pid)
+
+    unpickler = pickle.Unpickler(stream)
+    unpickler.persistent_load = persistent_load
+    class_ = unpickler.load()
+    if asset is None:
+        asset = class_(project)
+    assert isinstance(asset, class_)
+    for k, v in unpickler.load().iteritems():
+        setattr(asset, k, v)
+    # Node树已经替换，编译的模板失效
+    asset._template = None
+    return asset
+
+
+def get_state(obj):
+    """
+    :return: obj的所有属性，包括__slots__中的
+    :rtype: dict[str, *]
+    """
+    state = dict(getattr(obj, '__dict__', {}))
+    for class_ in type(obj).__mro__:
+        for name in class_.__dict__.get('__slots__', ()):
+            if hasattr(obj, name):
+                state[name] = getattr(obj, name)
+    return state
+
+
+def dumps_asset(project, asset):
+    """
+    :param Project project:
+    :param Asset asset:
+    :rtype: str
+    """
+    stream = StringIO()
+    dump_asset(project, asset, stream)
+    return stream.getvalue()
+
+
+def loads_asset(project, data, asset=None):
+    """
+    :param Project project:
+    :param str data:
+    :param Asset asset:
+    :rtype: Asset
+    """
+    return load_asset(project, StringIO(data), asset)
+
+
+def copy_node(project, node):
+    """
+    复制node的子树(深拷贝)。子树之外的Node(parent, root, 以及属性中引用到的)和Asset不会被复制，仍然指向原来的对象，
+    所以复制的开销只和子树的大小有关。复制的子树不会加入parent的children。
+    :param Project project:
+    :param Node node:
+    :rtype: Node
+    """
+    inside = {id(x) for x in node.walk()}
+    outside = []
+
+    def persistent_id(obj):
+        if obj is project:
+            return 'project'
+        if isinstance(obj, Asset) or (isinstance(obj, Node) and id(obj) not in inside):
+            outside.append(obj)
+            return len(outside) - 1
+        return None
+
+    def persistent_load(pid):
+        if pid == 'project':
+            return project
+        return outside[pid]
+
+    stream = StringIO()
+    pickler = pickle.Pickler(stream, pickle.HIGHEST_PROTOCOL)
+    pickler.inst_persistent_id = persistent_id
+    pickler.dump(node)
+    unpickler = pickle.Unpickler(StringIO(stream.getvalue()))
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
+
+
+def iter_json_array(stream, object_pairs_hook=None, chunk_size=1 << 16):
+    """
+    逐个解析json数组(Prefab/Scene文件)中的元素。每次只读入chunk_size字节，不需要把整个文件读入内存。
+    :param file stream: 以二进制方式打开，utf-8编码
+    :param object_pairs_hook:
+    :param int chunk_size:
+    :rtype: Iterator[*]
+    """
+    decoder = json.JSONDecoder(object_pairs_hook=object_pairs_hook)
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    whitespace = re.compile(r'[ \t\n\r]*')
+    buf, pos, eof = u'', 0, False
+    expect = '['  # '[', 'value', 'value or ]', ', or ]'
+    size = chunk_size
+
+    while True:
+        pos = whitespace.match(buf, pos).end()
+        if pos < len(buf):
+            c = buf[pos]
+            if expect == '[':
+                if c != '[':
+                    raise ValueError('json array expected at %s' % pos)
+                pos += 1
+                expect = 'value or ]'
+                continue
+            elif c == ']' and expect in ('value or ]', ', or ]'):
+                return
+            elif expect == ', or ]':
+                if c != ',':
+                    raise ValueError('"," or "]" expected at %s' % pos)
+                pos += 1
+                expect = 'value'
+                continue
+            else:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if eof:
+                        raise
+                    value, end = None, None
+
+                # 元素不完整(或者数字被截断)时，继续读取
+                if end is not None and (end < len(buf) or eof):
+                    pos, size = end, chunk_size
+                    expect = ', or ]'
+                    yield value
+                    continue
+        elif eof:
+            raise ValueError('unexpected end of json array')
+
+        chunk = stream.read(size)
+        if chunk:
+            buf = buf[pos:] + text_decoder.decode(chunk)
+            size *= 2  # 单个元素很大时，避免反复解析
+        else:
+            buf, eof = buf[pos:] + text_decoder.decode('', True), True
+        pos = 0
+
+
+def split_json_array(content):
+    """
+    ccc(以及FileOutput)保存的Prefab/Scene是indent为2的json数组，不需要解析就可以分出每个element:
+    element都是dict，各占若干行，它们之间是'  },\n  {'；element内部的行缩进更多，字符串中也不会有换行。
+    :param str content:
+    :return: 每个element去掉首尾'  {'和'  }'两行之后的内容；不是这种格式时返回None
+    :rtype: list[str]|None
+    """
+    head, separator, tail = '[\n  {\n', '\n  },\n  {\n', '\n  }\n]'
+    content = content.rstrip('\n')
+    if not content.startswith(head) or not content.endswith(tail) or len(content) < len(head) + len(tail):
+        return None
+    return content[len(head):-len(tail)].split(separator)
+
+
+def encode_element(element):
+    """
+    与json.dumps(elements, indent=2)中的一个element相同，去掉了行尾的空格，非ASCII字符不转义，以utf-8编码(和ccc保持一致)
+    :param dict element:
+    :rtype: str
+    """
+    content = json.dumps(element, indent=2, ensure_ascii=False).encode('utf-8')
+    return '\n'.join('  ' + line.rstrip() for line in content.split('\n'))
+
+
+def scan_asset_file(path, kd_prefab_types, content=None):
+    """
+    扫描Prefab/Scene文件中所有Instance Root，不构建Node树
+    :param str path:
+    :param set[str] kd_prefab_types: KdPrefab组件的__type__
+    :param str content: 已经读取的文件内容
+    :return: [(Instance Root相对于Asset的路径, 引用的Prefab的uuid)]
+    :rtype: list[(str, str)]
+    """
+    if content is None:
+        with open(path, 'rb') as f:
+            content = f.read()
+
+    # 大部分Prefab/Scene不包含其他Prefab，不需要解析json:
+    # Scene中没有KdPrefab组件；或Prefab中只有一个KdPrefab组件(Prefab Root本身，见R3)
+    count = sum(content.count(('"%s"' % type_).encode('utf-8')) for type_ in kd_prefab_types)
+    if count == 0 or (count == 1 and path.endswith('.prefab')):
+        return []
+
+    return scan_instance_roots(json.loads(content), kd_prefab_types)
+
+
+def scan_instance_roots(data, kd_prefab_types):
+    """
+    不构建Node树，直接从解析出的json中查找所有Instance Root(和Node.iterate_instance_roots一致)
+    :param list[dict] data: 解析出的Prefab/Scene文件
+    :param set[str] kd_prefab_types: KdPrefab组件的__type__
+    :return: [(Instance Root相对于Asset的路径, 引用的Prefab的uuid)]
+    :rtype: list[(str, str)]
+    """
+    root_ref = data[0].get('data') or data[0].get('scene')
+    result = []
+    stack = [(get_element_ref(root_ref), None)]
+    while stack:
+        index, path = stack.pop()
+        node = data[index]
+
+        if path is not None:
+            kd_prefab = None
+            for component_ref in node.get('_components') or []:
+                component = data[get_element_ref(component_ref)]
+                if component['__type__'] in kd_prefab_types:
+                    kd_prefab = component
+                    break
+
+            # 找到Instance Root后，不再遍历其子节点
+            if kd_prefab is not None:
+                prefab = kd_prefab.get('prefab')
+                if not prefab:
+                    raise Exception('KdPrefab.prefab is None: %s' % node.get('_name'))
+                result.append((path, prefab['__uuid__']))
+                continue
+
+        for child_ref in reversed(node.get('_children') or []):
+            child = data[get_element_ref(child_ref)]
+            name = child.get('_name')
+            stack.append((get_element_ref(child_ref), '%s/%s' % (path, name) if path is not None else name))
+    return result
+
+
+def get_asset_class(relative_path):
+    """
+    :param str relative_path:
+    :return: Prefab/SceneAsset，不是Prefab或Scene时返回None
+    """
+    ext = os.path.splitext(relative_path)[1]
+    if ext == '.prefab':
+        return Prefab
+    elif ext == '.fire':
+        return SceneAsset
+    return None
+
+
+# 子进程中使用的Project(见Project._load_assets_in_parallel)
+_worker_project = None
+""":type: Project"""
+
+
+def _init_load_worker(path, use_cache):
+    global _worker_project
+    os.chdir(path)
+    _worker_project = Project(path, use_cache)
+    _worker_project._load_setting()
+    _worker_project._load_component_names()
+
+
+def _load_asset_in_worker(relative_path):
+    """
+    :param str relative_path: relative to assets
+    :return: (relative_path, pickle后的Asset, (traceback, message))
+    """
+    # noinspection PyBroadException
+    try:
+        asset = _worker_project._read_asset(relative_path, get_asset_class(relative_path))
+        return relative_path, dumps_asset(_worker_project, asset), None
+    except Exception, e:
+        return relative_path, None, (traceback.format_exc(), str(e))
+
+
+def _synchronize_worker(path, tasks, results):
+    """
+    同步Asset的子进程(见Project._synchronize_in_parallel)，依次处理tasks中的任务，收到None时退出
+    :param str path: 项目的路径
+    :param multiprocessing.Queue tasks: 只发给这个子进程的任务
+    :param multiprocessing.Queue results: 所有子进程共用，pickle后的结果
+    """
+    _init_load_worker(path, False)
+    # 收到的Prefab一直保留，之后的任务中不会再发送
+    _worker_project.registry = AssetRegistry()
+    for task in iter(tasks.get, None):
+        result = _synchronize_asset_in_worker(task)
+        # Queue在后台线程中pickle，失败时只会丢弃结果；在这里pickle，无法pickle时也能传回错误
+        # noinspection PyBroadException
+        try:
+            result = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            result = pickle.dumps((task[0], None, None, '', (traceback.format_exc(), str(e))),
+                                  pickle.HIGHEST_PROTOCOL)
+        results.put(result)
+
+
+def _synchronize_asset_in_worker(task):
+    """
+    :param task: (序号, pickle后的Asset, [(引用到的Prefab的path, uuid, 类型, pickle后的Prefab或None)])，
+                 只包括之前没有发给这个子进程的Prefab
+    :return: (序号, pickle后的Asset, pickle后的CompareContext, 输出, (traceback, message))
+    """
+    i, data, referents = task
+    project = _worker_project
+    stdout, output = sys.stdout, _CapturedOutput()
+    sys.stdout = output
+    # noinspection PyBroadException
+    try:
+        for relative_path, uuid_, class_, referent_data in referents:
+            if referent_data is None:
+                referent = class_(project)
+                referent.file = FileInput(project, relative_path, uuid_)
+            else:
+                referent = loads_asset(project, referent_data)
+                referent.need_synchronize = True
+            referent.synchronized = True
+            project.registry.add(referent)
+
+        asset = loads_asset(project, data)
+        ctx = CompareContext()
+        ctx.push(asset.relative_path)
+        asset.synchronize_all_instances(ctx)
+        ctx.pop()
+        return i, dumps_asset(project, asset), pickle.dumps(ctx, pickle.HIGHEST_PROTOCOL), output.getvalue(), None
+    except Exception, e:
+        return i, None, None, output.getvalue(), (traceback.format_exc(), str(e))
+    finally:
+        sys.stdout = stdout
+
+
+class ProjectIndex(object):
+    """
+    项目索引，保存在<project_root>/library/ccc_helper/index.sqlite中，根据文件的mtime和sha1增量更新。
+    不需要加载项目，就可以查询uuid/path，以及Asset之间的引用关系。
+    tables:
+        assets: path -> uuid
+        hashes: path -> 文件和.meta的size, mtime, sha1
+        referents: path -> 直接引用的Prefab的uuid
+        depths: path -> depth(由Project排序后写入，见Project._load_and_sort_assets)
+        instances: 所有Instance Root的位置(path, node_path, prefab_uuid)
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS assets (path TEXT PRIMARY KEY, uuid TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS assets_uuid ON assets (uuid);
+        CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime REAL,
+                                           meta_size INTEGER, meta_mtime REAL, sha1 TEXT, meta_sha1 TEXT);
+        CREATE TABLE IF NOT EXISTS referents (path TEXT NOT NULL, prefab_uuid TEXT NOT NULL,
+                                              PRIMARY KEY (path, prefab_uuid));
+        CREATE INDEX IF NOT EXISTS referents_prefab_uuid ON referents (prefab_uuid);
+        CREATE TABLE IF NOT EXISTS depths (path TEXT PRIMARY KEY, depth INTEGER);
+        CREATE TABLE IF NOT EXISTS instances (path TEXT NOT NULL, node_path TEXT NOT NULL, prefab_uuid TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS instances_path ON instances (path);
+        CREATE INDEX IF NOT EXISTS instances_prefab_uuid ON instances (prefab_uuid);
+    """
+
+    TABLES = ('assets', 'hashes', 'referents', 'depths', 'instances')
+
+    def __init__(self, project):
+        """
+        :param Project project:
+        """
+        self.project = project
+        self.path = os.path.join(project.path, CACHE_PATH, 'index.sqlite')
+        self._conn = None
+        """:type: sqlite3.Connection"""
+
+    @property
+    def conn(self):
+        """
+        :rtype: sqlite3.Connection
+        """
+        if self._conn is None:
+            folder = os.path.dirname(self.path)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            self._conn = sqlite3.connect(self.path)
+            self._conn.text_factory = str
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def clear(self):
+        with self.conn:
+            for table in self.TABLES + ('settings',):
+                self.conn.execute('DELETE FROM %s' % table)
+
+    def _get_setting(self, key):
+        row = self.conn.execute('SELECT value FROM settings WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def update(self, relative_paths=None):
+        """
+        扫描所有size/mtime变化的文件，sha1也变化时，才重新扫描其中的Instance Root
+        :param collections.Iterable[str] relative_paths: 只检查这些文件(如inotify通知的)，默认检查所有文件
+        :return: (新增/修改/删除的文件(relative to assets), 错误数)
+        :rtype: (list[str], int)
+        """
+        # KdPrefab的类型变了，需要重新扫描所有文件
+        settings = {'version': str(INDEX_VERSION), 'kd_prefab_types': ','.join(sorted(self.project._kd_prefab_types))}
+        if any(self._get_setting(k) != v for k, v in settings.iteritems()):
+            self.clear()
+            with self.conn:
+                self.conn.executemany('INSERT INTO settings VALUES (?, ?)', settings.items())
+
+        known = {row[0]: row[1:] for row in self.conn.execute('SELECT * FROM hashes')}
+        if relative_paths is None:
+            relative_paths = iterate_asset_paths(self.project.path)
+        else:
+            relative_paths = {p.replace('\\', '/') for p in relative_paths}
+            known = {k: v for k, v in known.iteritems() if k in relative_paths}
+            relative_paths = [p for p in relative_paths if get_asset_class(p) and
+                              os.path.exists(os.path.join(self.project.path, ASSETS_PATH, p))]
+
+        changed, errors = [], 0
+        with self.conn:
+            for relative_path in relative_paths:
+                path = os.path.join(self.project.path, ASSETS_PATH, relative_path)
+                # noinspection PyBroadException
+                try:
+                    stat, meta_stat = os.stat(path), os.stat(path + '.meta')
+                    stats = (stat.st_size, stat.st_mtime, meta_stat.st_size, meta_stat.st_mtime)
+                    hashes = known.pop(relative_path, None)
+                    if hashes and tuple(hashes[:4]) == stats:
+                        continue
+
+                    content = open(path, 'rb').read()
+                    sha1, meta_sha1 = hashlib.sha1(content).hexdigest(), file_sha1(path + '.meta')
+                    if not hashes or tuple(hashes[4:]) != (sha1, meta_sha1):
+                        self._scan(relative_path, path, content)
+                        changed.append(relative_path)
+                    self.conn.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                      (relative_path,) + stats + (sha1, meta_sha1))
+                except Exception, e:
+                    traceback.print_exc()
+                    print 'Load Error:', relative_path, str(e)
+                    errors += 1
+                    self._remove(relative_path)
+
+            # 已删除的文件
+            for relative_path in known:
+                self._remove(relative_path)
+                changed.append(relative_path)
+        return changed, errors
+
+    def _scan(self, relative_path, path, content):
+        uuid_ = json.load(open(path + '.meta'))['uuid']
+        instances = scan_asset_file(path, self.project._kd_prefab_types, content)
+
+        self._remove(relative_path)
+        self.conn.execute('INSERT INTO assets VALUES (?, ?)', (relative_path, uuid_))
+        self.conn.executemany('INSERT OR IGNORE INTO referents VALUES (?, ?)',
+                              [(relative_path, prefab_uuid) for _, prefab_uuid in instances])
+        self.conn.executemany('INSERT INTO instances VALUES (?, ?, ?)',
+                              [(relative_path, node_path, prefab_uuid) for node_path, prefab_uuid in instances])
+
+    def _remove(self, relative_path):
+        for table in self.TABLES:
+            self.conn.execute('DELETE FROM %s WHERE path = ?' % table, (relative_path,))
+
+    def update_depths(self, assets):
+        """
+        :param collections.Iterable[Asset] assets: 已经排好序的Asset
         """
-        assets = prefab.search_referers()
-        assets.insert(0, prefab)
-        self._synchronized_assets(assets, dry_run, 'synchronize %s' % prefab.relative_path)
+        with self.conn:
+            self.conn.execute('DELETE FROM depths')
+            self.conn.executemany('INSERT INTO depths VALUES (?, ?)',
+                                  [(asset.relative_path, asset.depth) for asset in assets])
 
-    def _synchronized_assets(self, assets, dry_run, message):
+    def iterate_assets(self):
         """
-        :param list[Asset] assets: 必须排好序
-        :param bool dry_run:
+        :return: [(path, uuid, [(node_path, prefab_uuid)])]
+        :rtype: collections.Iterable[(str, str, list[(str, str)])]
         """
-        for asset in self.iterate_assets():
-            asset.synchronized = asset.need_synchronize = False
-        for asset in assets:
-            asset.need_synchronize = True
-
-        # 备份
-        backup = Backup(self)
-        backup.log.write('%s\n' % message)
+        instances = {}
+        for path, node_path, prefab_uuid in self.conn.execute('SELECT * FROM instances ORDER BY rowid'):
+            instances.setdefault(path, []).append((node_path, prefab_uuid))
 
-        files = 0
-        for asset in assets:
-            ctx = CompareContext()
-            ctx.push(asset.relative_path)
-            asset.synchronize_all_instances(ctx)
-            ctx.pop()
-            ctx.dump(backup.log)
+        for path, uuid_ in self.conn.execute('SELECT path, uuid FROM assets'):
+            yield path, uuid_, instances.get(path, [])
 
-            if not dry_run and ctx.has_changed():
-                backup.backup_asset(asset)
-                FileOutput(self, asset.file.relative_path).save(asset)
-                files += 1
+    def get_path(self, uuid_):
+        """
+        :param str uuid_:
+        :return: relative to assets
+        :rtype: str|None
+        """
+        row = self.conn.execute('SELECT path FROM assets WHERE uuid = ?', (uuid_,)).fetchone()
+        return row[0] if row else None
 
-        print 'Modified %s files. For more information, check "%s"' % (files, backup.path)
+    def get_uuid(self, path):
+        """
+        :param str path: relative to assets
+        :rtype: str|None
+        """
+        row = self.conn.execute('SELECT uuid FROM assets WHERE path = ?', (path.replace('\\', '/'),)).fetchone()
+        return row[0] if row else None
 
-    def get_prefab_by_file_id(self, file_id):
+    def get_depth(self, path):
         """
-        :param str file_id:
-        :rtype:
+        :param str path: relative to assets
+        :rtype: int|None
         """
-        for asset in self.iterate_assets():
-            if isinstance(asset, Prefab):
-                if asset.get_file_id() == file_id:
-                    return asset
+        row = self.conn.execute('SELECT depth FROM depths WHERE path = ?', (path.replace('\\', '/'),)).fetchone()
+        return row[0] if row else None
 
-    def get_asset_by_uuid(self, uuid_):
+    def get_referents(self, path):
         """
-        :param str uuid_:
-        :rtype: Prefab|SceneAsset|None
+        直接引用到的Prefab
+        :param str path: relative to assets
+        :rtype: list[str]
         """
-        return self._uuid_to_assets.get(uuid_)
+        return [row[0] for row in self.conn.execute(
+            'SELECT assets.path FROM referents JOIN assets ON referents.prefab_uuid = assets.uuid '
+            'WHERE referents.path = ?', (path.replace('\\', '/'),))]
 
-    def get_asset_by_path(self, path):
+    def get_referers(self, path):
         """
+        直接引用到path的Prefab/Scene
         :param str path: relative to assets
-        :rtype: Asset
+        :rtype: list[str]
         """
-        path = path.replace('\\', '/')
-        return self._path_to_assets.get(path)
+        return [row[0] for row in self.conn.execute(
+            'SELECT referents.path FROM referents JOIN assets ON referents.prefab_uuid = assets.uuid '
+            'WHERE assets.path = ?', (path.replace('\\', '/'),))]
 
-    def get_prefab_by_path(self, path):
+    def search_referers(self, path):
         """
+        同Asset.search_referers，包含直接/间接引用的，depth大的在前
         :param str path: relative to assets
-        :rtype: Prefab
+        :rtype: list[str]
         """
-        asset = self.get_asset_by_path(path)
-        assert isinstance(asset, Prefab)
-        return asset
+        paths, result = {path.replace('\\', '/')}, set()
+        while paths:
+            referers = set()
+            for p in paths:
+                referers.update(self.get_referers(p))
+            paths = referers - result
+            result.update(referers)
 
-    def _sort_assets(self):
+        result = list(result)
+        depths = {p: self.get_depth(p) for p in result}
+        result.sort(key=lambda x: depths[x], reverse=True)
+        return result
+
+    def get_instances(self, prefab_path):
         """
-        对所有Asset按照依赖关系排序。如果A依赖B，B.order < A.order
+        Prefab的所有实例(不包括嵌套在其他Prefab实例中的)
+        :param str prefab_path: relative to assets
+        :return: [(path, node_path)]
+        :rtype: list[(str, str)]
         """
-        # # 初始化
-        # for asset in self.iterate_assets():
-        #     asset.referents = []
-        #     asset.referers = []
-        #     asset.depth = 0
+        return self.conn.execute(
+            'SELECT instances.path, instances.node_path FROM instances '
+            'JOIN assets ON instances.prefab_uuid = assets.uuid WHERE assets.path = ? ORDER BY instances.rowid',
+            (prefab_path.replace('\\', '/'),)).fetchall()
 
-        # 查找每个Asset引用到的其他Asset，形成森林
-        for asset in self.iterate_assets():
-            for node in asset.root.iterate_instance_roots(False):
-                prefab = self.get_asset_by_uuid(node.get_prefab_uuid())
-                asset.referents.add(prefab)
-                prefab.referers.add(asset)
 
-        # BFS遍历，计算每个asset的depth
-        # 所有的树根，depth都为0
-        assets = {asset for asset in self.iterate_assets() if not asset.referers}
-        depth = 0
-        while assets:
-            if depth > 100:
-                raise Exception('cyclic reference: %s' % list(assets)[0].relative_path)
+def iterate_asset_paths(project_path):
+    """
+    遍历所有Prefab/Scene
+    :param str project_path:
+    :return: relative to assets, 使用'/'分隔
+    :rtype: collections.Iterable[str]
+    """
+    assets_path = os.path.join(project_path, ASSETS_PATH)
+    for p, ds, fs in os.walk(assets_path):
+        for f in fs:
+            if get_asset_class(f) is not None:
+                yield os.path.relpath(os.path.join(p, f), assets_path).replace('\\', '/')
 
-            for asset in assets:
-                asset.depth = depth
 
-            assets = set(sum([list(asset.referents) for asset in assets], []))  # 被引用的
-            depth += 1
+def file_sha1(path):
+    """
+    :param str path:
+    :rtype: str
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
 
-        # 如果有循环引用，某些节点的depth可能为None（另一种可能是上面的循环不会结束）
-        for asset in self.iterate_assets():
-            if asset.depth is None:
-                raise Exception('cyclic reference: %s' % asset.relative_path)
 
-    def dump_referents(self):
-        for asset in self.iterate_assets():
-            print asset.relative_path
-            for ref in asset.referents:
-                print '   ', ref.relative_path
+def iterate_script_paths(project_path):
+    """
+    遍历所有脚本(见SCRIPT_EXTENSIONS)
+    :param str project_path:
+    :return: relative to assets, 使用'/'分隔
+    :rtype: collections.Iterable[str]
+    """
+    assets_path = os.path.join(project_path, ASSETS_PATH)
+    for p, ds, fs in os.walk(assets_path):
+        for f in fs:
+            if f.endswith(SCRIPT_EXTENSIONS):
+                yield os.path.relpath(os.path.join(p, f), assets_path).replace('\\', '/')
 
-    def dump_referers(self):
-        for asset in self.iterate_assets():
-            print asset.relative_path
-            for ref in asset.referers:
-                print '   ', ref.relative_path
 
+def get_component_sources_stat(project_path):
+    """
+    自定义组件名字的所有来源(见ComponentRegistry)的size, mtime，任何一个变化时，组件的名字都可能不同
+    :param str project_path:
+    :rtype: tuple
+    """
+    assets_path = os.path.join(project_path, ASSETS_PATH)
+    scripts = tuple(sorted((relative_path, file_stat(os.path.join(assets_path, relative_path + '.meta')))
+                           for relative_path in iterate_script_paths(project_path)))
+    return file_stat(os.path.join(project_path, 'library', 'bundle.project.js')), scripts
 
-class Backup(object):
-    def __init__(self, project):
-        self.project = project
-        # noinspection SpellCheckingInspection
-        self.path = os.path.join(project.path, 'ccc_helper_backup',
-                                 datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S'))
-        os.makedirs(self.path)
-        self.log = open(os.path.join(self.path, 'logs.txt'), 'w')
 
-    def backup_asset(self, asset):
-        """
-        :param Asset asset:
-        """
-        dst_path = os.path.join(self.path, asset.file.relative_path)
-        dst_folder = os.path.split(dst_path)[0]
-        if not os.path.exists(dst_folder):
-            os.makedirs(dst_folder)
-        shutil.copy(asset.path, dst_path)
+# noinspection SpellCheckingInspection
+def read_bundle_components(path):
+    """
+    :param str path: bundle.project.js
+    :return: [(id, name)]
+    :rtype: list[(str, str)]
+    """
+    bundle = open(path).read()
+    # cc._RFpush(module, '4c3c5p1IVNIn7SN0Moet2KO', 'KdPrefab');
+    return re.findall('cc\._RFpush\(\s*module\s*,\s*\'(.+?)\'\s*,\s*\'(.+?)\'\s*\);', bundle, re.M)
+
+
+def compress_uuid(uuid_):
+    """
+    同ccc的Editor.Utils.UuidUtils.compressUuid(自定义组件的__type__):
+    保留前5个十六进制字符，之后每3个十六进制字符(12 bits)编码为2个base64字符
+    :param str uuid_: 如'4c3c5a75-2153-489f-b48d-d0ca1eb7628e'
+    :return: 如'4c3c5p1IVNIn7SN0Moet2KO'
+    :rtype: str
+    """
+    hex_ = uuid_.replace('-', '')
+    result = [hex_[:5]]
+    for i in xrange(5, len(hex_), 3):
+        value = int(hex_[i:i + 3], 16)
+        result.append(BASE64_KEYS[value >> 6] + BASE64_KEYS[value & 0x3f])
+    return ''.join(result)
+
+
+def file_fingerprint(path):
+    """
+    :param str path:
+    :return: (size, mtime, sha1)，文件不存在时返回None
+    :rtype: tuple|None
+    """
+    stat = file_stat(path)
+    return stat and stat + (file_sha1(path),)
+
+
+def file_stat(path):
+    """
+    :param str path:
+    :return: (size, mtime)，文件不存在时返回None
+    :rtype: tuple|None
+    """
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+def find_cycles(assets):
+    """
+    查找循环引用(Tarjan算法，非递归)
+    :param list[Asset] assets: 所有可能在环上的Asset，只考虑它们之间的引用
+    :return: 每个强连通分量中的一个环，如[a, b, a]表示a引用b，b又引用a
+    :rtype: list[list[Asset]]
+    """
+    def sorted_referents(asset):
+        return sorted((x for x in asset.referents if x in candidates), key=lambda x: x.relative_path)
+
+    candidates = set(assets)
+    indexes, lowlinks, stack, on_stack, components = {}, {}, [], set(), []
+    for start in sorted(assets, key=lambda x: x.relative_path):
+        if start in indexes:
+            continue
+        indexes[start] = lowlinks[start] = len(indexes)
+        stack.append(start)
+        on_stack.add(start)
+        work = [(start, iter(sorted_referents(start)))]
+        while work:
+            asset, referents = work[-1]
+            for referent in referents:
+                if referent not in indexes:
+                    indexes[referent] = lowlinks[referent] = len(indexes)
+                    stack.append(referent)
+                    on_stack.add(referent)
+                    work.append((referent, iter(sorted_referents(referent))))
+                    break
+                if referent in on_stack:
+                    lowlinks[asset] = min(lowlinks[asset], indexes[referent])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlinks[parent] = min(lowlinks[parent], lowlinks[asset])
+                if lowlinks[asset] == indexes[asset]:
+                    component = set()
+                    while asset not in component:
+                        component.add(stack.pop())
+                    on_stack.difference_update(component)
+                    if len(component) > 1 or asset in asset.referents:
+                        components.append(component)
+
+    cycles = []
+    for component in components:
+        # 在分量内BFS，找到回到起点的最短路径
+        start = min(component, key=lambda x: x.relative_path)
+        parents = {start: None}
+        queue = [start]
+        for asset in queue:
+            referents = [x for x in sorted_referents(asset) if x in component]
+            if start in referents:
+                cycle = [start]
+                while asset is not None:
+                    cycle.append(asset)
+                    asset = parents[asset]
+                cycles.append(cycle[::-1])
+                break
+            for referent in referents:
+                if referent not in parents:
+                    parents[referent] = asset
+                    queue.append(referent)
+    cycles.sort(key=lambda x: x[0].relative_path)
+    return cycles
 
 
 def create_element_ref(index):
@@ -1813,6 +4084,25 @@ def synchronize_dict(element1, element2, dict1, dict2, ctx, ignores=set()):
     return dict1
 
 
+def synchronize_leaf(element1, element2, leaf1, leaf2, ctx, ignores=set()):
+    """
+    同synchronize_dict，但是不修改leaf1(可能是共享的，见is_leaf)
+    :param Element element1:
+    :param Element element2:
+    :param dict|None leaf1:
+    :param dict leaf2: prefab里的
+    :param CompareContext ctx:
+    :param set[str] ignores:
+    :return: 同步后的值(共享的)
+    :rtype: dict
+    """
+    if leaf1 is leaf2:
+        return leaf2
+    leaf1 = synchronize_dict(element1, element2, OrderedDict(leaf1) if leaf1 is not None else None, leaf2, ctx,
+                             ignores)
+    return element1.project.share_leaf(leaf1)
+
+
 def synchronize_list(element1, element2, list1, list2, ctx):
     """
     :param Element element1:
@@ -1870,7 +4160,14 @@ def synchronize_value(name, element1, element2, v1, v2, ctx):
                 v1 = Argument(v2.project, element1)
         v1.synchronize(v2, ctx)
         return v1
+    elif isinstance(v2, dict) and is_leaf(v2):
+        ctx.push(name)
+        v1 = synchronize_leaf(element1, element2, v1, v2, ctx)
+        ctx.pop()
+        return v1
     elif isinstance(v1, dict) or isinstance(v2, dict):
+        if isinstance(v1, dict) and is_leaf(v1):  # 共享的，不能修改(见synchronize_leaf)
+            v1 = OrderedDict(v1)
         ctx.push(name)
         v1 = synchronize_dict(element1, element2, v1, v2, ctx)
         ctx.pop()
@@ -1894,7 +4191,47 @@ def synchronize_value(name, element1, element2, v1, v2, ctx):
         if v1 != v2:
             ctx.change(name, v1, v2)
         assert is_primitive(v2)
-        return copy.deepcopy(v2)
+        return v2
+
+
+def fingerprint_dict(dict_, ignores=EMPTY_SET):
+    """
+    :param dict dict_:
+    :param collections.Set[str] ignores: 只考虑是否存在的属性
+    :return: dict_的规范形式(见fingerprint_value)
+    :rtype: tuple
+    """
+    return tuple((fingerprint_value(k), None if k in ignores else fingerprint_value(v)) for k, v in dict_.iteritems())
+
+
+def fingerprint_value(val):
+    """
+    计算哈希用的规范形式：同步时不会被修改的两个值(见synchronize_value)，规范形式才相同。
+    str和unicode保存的结果相同，不区分；int/float/bool保存的结果不同，需要区分。
+    :param * val:
+    :rtype: *
+    """
+    if val is None or isinstance(val, unicode):
+        return val
+    if isinstance(val, str):
+        return val.decode('utf-8')
+    if isinstance(val, bool):
+        return 'b', val
+    if isinstance(val, (int, long)):
+        return 'i', long(val)
+    if isinstance(val, float):
+        return 'f', val
+    if is_dict(val):
+        return ('d',) + fingerprint_dict(val)
+    if isinstance(val, list):
+        return ('l',) + tuple(fingerprint_value(v) for v in val)
+    if isinstance(val, Element):
+        return ('e',) + fingerprint_dict(val._data)
+    if isinstance(val, ComponentReference):
+        return 'c', fingerprint_value(val._relative_path), fingerprint_value(val._component_name)
+    if isinstance(val, NodeReference):
+        return 'n', fingerprint_value(val._relative_path)
+    raise Exception('invalid value: %s' % val)
 
 
 # def compare_value(v1, v2):
@@ -1922,7 +4259,7 @@ def load_value(file_, element, val):
         return load_ref(file_, element, val)
     elif isinstance(val, list):
         return load_list(file_, element, val)
-    elif isinstance(val, dict):
+    elif isinstance(val, dict) and not is_leaf(val):
         return load_dict(file_, element, val)
     else:
         check_value(val)
@@ -2005,7 +4342,7 @@ def save_value(file_, element, v):
         return save_list(file_, element, v)
     else:
         assert is_primitive(v), v
-        return copy.copy(v)
+        return v
 
 
 class CompareContext(object):
@@ -2086,6 +4423,390 @@ class CompareContext(object):
         return '%s' % self._diff
 
 
+class AssetWatcher(object):
+    """
+    监视assets中Prefab/Scene(及.meta)的修改。安装了pyinotify时使用inotify，否则定时检查所有文件的size/mtime。
+    """
+
+    def __init__(self, project, interval=1.0):
+        """
+        :param Project project: 需要有ProjectIndex(use_cache=True)
+        :param float interval: 轮询间隔(秒)
+        """
+        self.project = project
+        self.interval = interval
+        self._assets_path = os.path.join(project.path, ASSETS_PATH)
+        self._changed = set()
+        self._notifier = None
+
+        if pyinotify is not None:
+            manager = pyinotify.WatchManager()
+            mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE
+            manager.add_watch(self._assets_path, mask, rec=True, auto_add=True)
+            self._notifier = pyinotify.Notifier(manager, self._on_event, timeout=int(interval * 1000))
+
+    @property
+    def mode(self):
+        return 'inotify' if self._notifier else 'polling'
+
+    def _on_event(self, event):
+        path = event.pathname
+        if path.endswith('.meta'):
+            path = path[:-5]
+        if get_asset_class(path):
+            self._changed.add(os.path.relpath(path, self._assets_path).replace('\\', '/'))
+
+    def poll(self):
+        """
+        最多等待interval秒，更新ProjectIndex
+        :return: (新增/修改/删除的文件(relative to assets), 错误数)
+        :rtype: (list[str], int)
+        """
+        if self._notifier is None:
+            time.sleep(self.interval)
+            return self.project.index.update()
+
+        if self._notifier.check_events():
+            self._notifier.read_events()
+            self._notifier.process_events()
+        if not self._changed:
+            return [], 0
+
+        paths, self._changed = self._changed, set()
+        return self.project.index.update(paths)
+
+    def close(self):
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+
+
+def watch(project, interval=1.0):
+    """
+    文件修改之后，检查修改过的Prefab/Scene，以及引用到它们的Asset是否需要同步。Ctrl+C退出。
+    :param Project project: 已经lazy加载(见Project.load)
+    :param float interval:
+    """
+    watcher = AssetWatcher(project, interval)
+    print 'Watching %s (%s)' % (os.path.join(project.path, ASSETS_PATH), watcher.mode)
+    try:
+        while True:
+            changed, _ = watcher.poll()
+            if not changed:
+                continue
+
+            print '%s changed: %s' % (datetime.datetime.now().strftime('%H:%M:%S'), ', '.join(changed))
+            # noinspection PyBroadException
+            try:
+                assets = project.verify_changed_assets(changed)
+            except Exception:
+                traceback.print_exc()
+                continue
+
+            if assets:
+                print 'Need synchronize: %s' % ', '.join(asset.relative_path for asset in assets)
+            else:
+                print 'OK'
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+class ProjectDaemon(object):
+    """
+    常驻进程，持有lazy加载的Project，通过<project_root>/library/ccc_helper/daemon.sock提供服务，
+    避免每次调用ccc.py/ccc_graph.py都重新加载项目。
+    协议(类似JSON-RPC)：每行一个请求 {"id": 1, "method": "verify", "params": {"asset": "a.prefab"}}，
+    返回一行 {"id": 1, "result": {"output": "..."}, "error": null}。
+    每个请求之前，根据ProjectIndex重新加载修改过的Asset；ccc_helper.yaml或自定义组件的来源(bundle.project.js,
+    脚本的.meta，见ComponentRegistry)修改后，重新加载整个项目。
+    """
+
+    METHODS = ('verify', 'sync', 'dump_referers', 'dump_referents', 'graph', 'shutdown')
+
+    def __init__(self, project_path):
+        """
+        :param str project_path:
+        """
+        self.project_path = os.path.realpath(project_path)
+        self.socket_path = os.path.join(self.project_path, DAEMON_SOCKET_PATH)
+        self.project = None
+        """:type: Project"""
+        self._settings = None
+        self._stopped = False
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            client = DaemonClient.connect(self.project_path)
+            if client:
+                client.close()
+                raise Exception('Daemon is already running: %s' % self.socket_path)
+            os.remove(self.socket_path)  # 上次没有正常退出
+        folder = os.path.dirname(self.socket_path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        server = SocketServer.UnixStreamServer(self.socket_path, _DaemonRequestHandler, False)
+        server.ccc_daemon = self
+        try:
+            server.server_bind()
+            server.server_activate()
+            print 'Daemon listening on', self.socket_path
+            while not self._stopped:
+                server.handle_request()
+        finally:
+            server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def _refresh(self):
+        settings = (file_stat(os.path.join(self.project_path, 'ccc_helper.yaml')),
+                    get_component_sources_stat(self.project_path))
+        if self.project is None or settings != self._settings:
+            self.project = None
+            project = Project(self.project_path, use_cache=True)
+            project.load(lazy=True)
+            self.project, self._settings = project, settings
+            return
+
+        changed, _ = self.project.index.update()
+        if changed:
+            self.project.reload_assets(changed)
+
+    def handle(self, line):
+        """
+        :param str line: 一个请求
+        :return: 返回给客户端的数据
+        :rtype: dict
+        """
+        response = {'id': None, 'result': None, 'error': None}
+        stdout, output = sys.stdout, _CapturedOutput()
+        sys.stdout = output
+        # noinspection PyBroadException
+        try:
+            request = json.loads(line)
+            response['id'] = request.get('id')
+            method, params = request.get('method'), request.get('params') or {}
+            if method not in self.METHODS:
+                raise Exception('Unknown method: %s' % method)
+
+            result = {}
+            if method == 'shutdown':
+                self._stopped = True
+            else:
+                self._refresh()
+                path = params.get('asset')
+                if method == 'graph':
+                    result['assets'] = describe_assets(get_action_assets(self.project, path))
+                else:
+                    check, changed_paths = params.get('check', 0), params.get('changed')
+                    changed = run_action(self.project, method, path, check=check, changed=changed_paths)
+                    result['changed'] = [asset.relative_path for asset in changed]
+                    # 同步过的Node树都需要丢弃：dry run不会保存，没有记录修改的Asset也可能被修改过(如PrefabInfo)
+                    if method in ('verify', 'sync') and not check:
+                        for asset in get_synchronized_assets(self.project, path, changed_paths):
+                            if asset.materialized:
+                                asset.unload()
+            result['output'] = output.getvalue()
+            response['result'] = result
+        except Exception, e:
+            traceback.print_exc(file=sys.stderr)
+            response['error'] = {'message': str(e), 'output': output.getvalue()}
+        finally:
+            sys.stdout = stdout
+        return response
+
+
+class _DaemonRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            response = self.server.ccc_daemon.handle(line)
+            self.wfile.write(json.dumps(response) + '\n')
+
+
+class _CapturedOutput(object):
+    """
+    收集print的输出(str和unicode混合)，返回utf-8编码的str
+    """
+
+    def __init__(self):
+        self._buffer = StringIO()
+
+    def write(self, s):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        self._buffer.write(s)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return self._buffer.getvalue()
+
+
+class DaemonClient(object):
+    """
+    连接ProjectDaemon，见DaemonClient.connect
+    """
+
+    def __init__(self, sock):
+        """
+        :param socket.socket sock:
+        """
+        self._socket = sock
+        self._file = sock.makefile('rb')
+        self._id = 0
+
+    @classmethod
+    def connect(cls, project_path):
+        """
+        :param str project_path:
+        :return: daemon没有运行(或者不支持Unix domain socket)时返回None
+        :rtype: DaemonClient|None
+        """
+        path = os.path.join(os.path.realpath(project_path), DAEMON_SOCKET_PATH)
+        if not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+            return None
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except socket.error:
+            sock.close()
+            return None
+        return cls(sock)
+
+    def call(self, method, **params):
+        """
+        :param str method: 见ProjectDaemon.METHODS
+        :return: result，其中output为daemon中print的内容
+        :rtype: dict
+        """
+        self._id += 1
+        self._socket.sendall(json.dumps({'id': self._id, 'method': method, 'params': params}) + '\n')
+        line = self._file.readline()
+        if not line:
+            raise Exception('Daemon closed the connection')
+
+        response = json.loads(line)
+        if response['error']:
+            sys.stdout.write(response['error']['output'].encode('utf-8'))
+            raise Exception('Daemon error: %s' % response['error']['message'])
+        return response['result']
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+
+def get_action_assets(project, path=None):
+    """
+    :param Project project:
+    :param str path: relative to assets
+    :return: path及引用到它的Asset，path为None时返回所有Asset
+    :rtype: list[Asset]
+    """
+    if path is None:
+        return list(project.iterate_assets())
+
+    asset = project.get_asset_by_path(path)
+    if not asset:
+        raise Exception('Asset not found: %s' % path)
+    return [asset] + asset.search_referers()
+
+
+def get_synchronized_assets(project, path=None, changed=None):
+    """
+    verify/sync会同步的Asset(见run_action)，按照同步的顺序
+    :param Project project:
+    :param str path: 只处理一个Prefab(relative to assets)
+    :param list[str] changed: 只处理修改过的Prefab/Scene(见get_changed_paths)
+    :rtype: list[Asset]
+    """
+    if changed is not None:
+        return project.search_changed_assets(changed)
+    if path is None:
+        return project.sorted_assets
+    return get_action_assets(project, path)
+
+
+def run_action(project, action, path=None, jobs=1, check=0, changed=None):
+    """
+    :param Project project: 已经加载
+    :param str action: verify, sync, dump_referers, dump_referents
+    :param str path: 只处理一个Prefab(relative to assets)
+    :param int jobs: 同步Asset的进程数
+    :param int check: 大于0时，verify只检查，找到check个不一致的Instance就停止(见Project.check_instances)
+    :param list[str] changed: 不为None时，verify/sync只处理这些Prefab/Scene及引用到它们的Asset(见get_changed_paths)
+    :return: 需要同步(或已同步)的Asset
+    :rtype: list[Asset]
+    """
+    if action == 'verify' and check > 0:
+        assets = get_synchronized_assets(project, path, changed)
+        # 与synchronize_changed_assets相同，引用到的其他Prefab只作为同步的来源
+        sources = set().union(*(asset.referents for asset in assets)) if changed is not None else ()
+        differences = project.check_instances(assets, check, sources)
+        if not differences:
+            print 'All instances are synchronized'
+        # differences已经按照assets的顺序
+        return list(OrderedDict.fromkeys(asset for asset, _ in differences))
+    elif action in ('sync', 'verify'):
+        dry_run = action == 'verify'
+        if changed is not None:
+            return project.synchronize_changed_assets(changed, dry_run, jobs)
+        if path is None:
+            return project.synchronize_all_instances(dry_run, jobs)
+        prefab = project.get_asset_by_path(path)
+        if not prefab:
+            raise Exception('Asset not found: %s' % path)
+        assert isinstance(prefab, Prefab)
+        return project.synchronize_prefab(prefab, dry_run, jobs)
+    elif action == 'dump_referers':
+        dump_referers(get_action_assets(project, path))
+    elif action == 'dump_referents':
+        dump_referents(get_action_assets(project, path))
+    else:
+        raise Exception('Unknown action: %s' % action)
+    return []
+
+
+def get_changed_paths(project_path, rev):
+    """
+    用git查找rev之后新增/修改的Prefab/Scene，包括还没有提交的
+    :param str project_path: 可以是git仓库的子目录
+    :param str rev:
+    :return: relative to assets
+    :rtype: list[str]
+    """
+    def git(*args):
+        return subprocess.check_output(('git',) + args, cwd=project_path).split('\0')
+
+    paths = git('diff', '--name-only', '--relative', '-z', rev, '--', ASSETS_PATH) + \
+        git('ls-files', '--others', '--exclude-standard', '-z', '--', ASSETS_PATH)
+    result = []
+    for path in paths:
+        if path.endswith(('.prefab', '.fire')):
+            relative_path = os.path.relpath(path, ASSETS_PATH).replace('\\', '/')
+            if relative_path not in result:
+                result.append(relative_path)
+    return result
+
+
+def describe_assets(assets):
+    """
+    Asset之间的引用关系，可以序列化为JSON(见ccc_graph.py)
+    :param list[Asset] assets:
+    :rtype: list[dict]
+    """
+    return [{'path': asset.relative_path,
+             'name': asset.file.name,
+             'prefab': isinstance(asset, Prefab),
+             'referers': sorted(ref.relative_path for ref in asset.referers),
+             'referents': sorted(ref.relative_path for ref in asset.referents)}
+            for asset in assets]
+
+
 def dump_referers(assets):
     """
     :param list[Asset] assets:
@@ -2117,13 +4838,27 @@ def test2():
 def main():
     parser = optparse.OptionParser()
     parser.add_option('-p', '--project', dest='project', help='project path')
+    parser.add_option('--no-cache', dest='no_cache', default=False, action='store_true',
+                      help='do not use the cache in library/ccc_helper')
+    parser.add_option('--no-daemon', dest='no_daemon', default=False, action='store_true',
+                      help='do not use the running daemon, load the project in this process')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+                      help='number of processes used to load and synchronize assets')
+    parser.add_option('--check', dest='check', default=False, action='store_true',
+                      help='verify only: compare without modifying anything, exit 1 if any instance is out of sync')
+    parser.add_option('--max-diffs', dest='max_diffs', type='int', default=1,
+                      help='verify --check: stop after this many out-of-sync instances')
+    parser.add_option('--since', dest='since', metavar='REV',
+                      help='verify/sync only prefabs/scenes changed since the git revision, and their referers')
     usage = """
 python ccc.py [options] action
 actions:
     verify [prefab]
     sync [prefab]
-    dump_referers
-    dump_referents
+    dump_referers [prefab]
+    dump_referents [prefab]
+    watch
+    daemon
 
 e.g.:
     # synchronize all prefabs in project
@@ -2134,52 +4869,64 @@ e.g.:
     python ccc.py -p . verify
     # verify one prefab (and its referers)
     python ccc.py -p . verify a.prefab
+    # stop at the first out-of-sync instance, exit with 1 if there is any (for CI)
+    python ccc.py -p . --check verify
+    # verify prefabs/scenes changed since origin/master (and their referers)
+    python ccc.py -p . --since origin/master verify
+    # verify changed prefabs/scenes (and their referers) whenever they are saved
+    python ccc.py -p . watch
+    # keep the project loaded, other commands (and ccc_graph.py) will use it while it is running
+    python ccc.py -p . daemon
 """
 
     parser.set_usage(usage)
 
     option, args = parser.parse_args()
     action = args[0] if args else None
-    if action not in ('sync', 'verify', 'dump_referers', 'dump_referents'):
+    if action not in ('sync', 'verify', 'dump_referers', 'dump_referents', 'watch', 'daemon'):
         parser.print_help()
         return
 
-    project = Project(option.project)
-    project.load()
+    path = args[1] if len(args) > 1 else None
+    check = max(option.max_diffs, 1) if option.check and action == 'verify' else 0
+    changed = None
+    if option.since and action in ('sync', 'verify'):
+        changed = get_changed_paths(option.project, option.since)
+    if action == 'daemon':
+        ProjectDaemon(option.project).serve_forever()
+        return
 
-    asset = None
-    if len(args) > 1:
-        asset = project.get_asset_by_path(args[1])
-    
-    if action == 'sync':
-        if asset:
-            assert isinstance(asset, Prefab)
-            project.synchronize_prefab(asset, False)
-        else:
-            project.synchronize_all_instances(False)
-    elif action == 'verify':
-        if asset:
-            assert isinstance(asset, Prefab)
-            project.synchronize_prefab(asset, True)
-        else:
-            project.synchronize_all_instances(True)
-    elif action == 'dump_referers':
-        if asset:
-            assert isinstance(asset, Prefab)
-            # noinspection PyTypeChecker
-            dump_referers([asset] + asset.search_referers())
-        else:
-            dump_referers(list(project.iterate_assets()))
-    elif action == 'dump_referents':
-        if asset:
-            assert isinstance(asset, Prefab)
-            # noinspection PyTypeChecker
-            dump_referents([asset] + asset.search_referers())
-        else:
-            dump_referents(list(project.iterate_assets()))
+    # daemon已经加载了项目
+    client = None if option.no_daemon or action == 'watch' else DaemonClient.connect(option.project)
+    if client:
+        try:
+            result = client.call(action, asset=path, check=check, changed=changed)
+            sys.stdout.write(result['output'].encode('utf-8'))
+        finally:
+            client.close()
+        if check and result['changed']:
+            sys.exit(1)
+        return
+
+    # watch需要用ProjectIndex检测修改过的文件
+    project = Project(option.project, use_cache=not option.no_cache or action == 'watch')
+    if action in ('dump_referers', 'dump_referents'):
+        # 只需要引用关系
+        project.scan()
+    elif action == 'watch':
+        project.load(lazy=True)
+        watch(project)
+        return
     else:
-        parser.print_help()
+        # 只处理一个Prefab(或修改过的Prefab/Scene)时，用到的Asset才需要构建Node树
+        project.load(option.jobs, lazy=path is not None or changed is not None)
+
+    result = run_action(project, action, path, option.jobs, check, changed)
+    if check and result:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
-    main()
+    # 通过模块运行，保证缓存和子进程中pickle的类都是ccc.xxx，而不是__main__.xxx
+    import ccc
+    ccc.main()
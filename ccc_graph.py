@@ -18,7 +18,7 @@
 
 import optparse
 import os
-from ccc import Project, Prefab
+from ccc import Project, DaemonClient, describe_assets, get_action_assets
 import networkx as nx
 
 
@@ -45,28 +45,12 @@ except:
 option = None
 
 
-def create_project_graph(project):
+def create_graph(assets):
     """
-    :param Project project:
+    :param list[dict] assets: 见ccc.describe_assets
     :rtype: nx.MultiDiGraph
     """
     g = nx.MultiDiGraph()
-    assets = list(project.iterate_assets())
-    add_assets_to_graph(g, assets)
-    return g
-
-
-def create_asset_graph(asset):
-    """
-    :param Asset asset:
-    :rtype nx.DiGraph:
-    """
-    g = nx.DiGraph()
-    assets = [asset]
-    assets += asset.search_referers()
-    if isinstance(asset, Prefab):
-        assets += asset.search_referers()
-
     add_assets_to_graph(g, assets)
     return g
 
@@ -74,31 +58,31 @@ def create_asset_graph(asset):
 def add_assets_to_graph(g, assets):
     """
     :param nx.Graph g:
-    :param Sequence[Asset] assets:
+    :param list[dict] assets:
     """
     for asset in assets:
-        if not asset.referers and not asset.referents:
+        if not asset['referers'] and not asset['referents']:
             continue
 
         add_node(g, asset)
 
     for asset in assets:
-        if not asset.referers and not asset.referents:
+        if not asset['referers'] and not asset['referents']:
             continue
 
-        for ref in asset.referers:
-            g.add_edge(ref.relative_path, asset.relative_path)
+        for ref in asset['referers']:
+            g.add_edge(ref, asset['path'])
 
 
 def add_node(g, asset):
     """
     :param nx.Graph g:
-    :param Asset asset:
+    :param dict asset:
     """
-    if isinstance(asset, Prefab):
-        if not asset.referers:
+    if asset['prefab']:
+        if not asset['referers']:
             color = 'purple'
-        elif not asset.referents:
+        elif not asset['referents']:
             color = 'green'
         else:
             color = 'blue'
@@ -106,10 +90,10 @@ def add_node(g, asset):
         color = 'red'
 
     if option.long:
-        label = asset.relative_path
+        label = asset['path']
     else:
-        label = asset.file.name
-    g.add_node(asset.relative_path, label=label, color=color)
+        label = asset['name']
+    g.add_node(asset['path'], label=label, color=color)
 
 
 def create_image(g, path):
@@ -145,6 +129,10 @@ def main():
     parser.add_option('-o', '--output', dest='output', help='output file name')
     parser.add_option('-l', '--long', dest='long', default=False, action='store_true',
                       help='show long label (relative path to assets)')
+    parser.add_option('--no-cache', dest='no_cache', default=False, action='store_true',
+                      help='do not use the index in library/ccc_helper')
+    parser.add_option('--no-daemon', dest='no_daemon', default=False, action='store_true',
+                      help='do not use the running daemon (see "ccc.py daemon")')
 
     usage = """
 python ccc_graph.py [options] [asset]
@@ -163,24 +151,26 @@ e.g.:
         parser.print_help()
         return
 
-    project = Project(option.project)
-    project.load()
+    path = args[0] if args else None
+    client = None if option.no_daemon else DaemonClient.connect(option.project)
+    if client:
+        try:
+            assets = client.call('graph', asset=path)['assets']
+        finally:
+            client.close()
+    else:
+        project = Project(option.project, use_cache=not option.no_cache)
+        # 只需要引用关系，不需要构建Node树
+        project.scan()
+        assets = describe_assets(get_action_assets(project, path))
 
     output = option.output
-
-    if len(args) > 0:
-        asset = project.get_asset_by_path(args[1])
-        if not asset:
-            print 'Asset not found:', option.asset
-            return
-
-        if not output:
-            output = '%s.jpg' % asset.file.name
-        create_image(create_asset_graph(asset), output)
-    else:
-        if not output:
-            output = '%s.jpg' % project.name
-        create_image(create_project_graph(project), output)
+    if not output:
+        if path:
+            output = '%s.jpg' % assets[0]['name']
+        else:
+            output = '%s.jpg' % os.path.basename(os.path.realpath(option.project))
+    create_image(create_graph(assets), output)
 
 if __name__ == '__main__':
     main()
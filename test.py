@@ -16,8 +16,42 @@
 # You should have received a copy of the GNU General Public License
 # along with Structer.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import os
+import subprocess
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from cStringIO import StringIO
 from unittest import TestCase
-from ccc import Project, SceneAsset, CompareContext, Prefab
+import ccc
+from ccc import Project, SceneAsset, CompareContext, Prefab, FileOutput, iter_json_array
+
+
+def _exit_in_worker(task):
+    """替换ccc._synchronize_asset_in_worker，模拟子进程意外退出"""
+    os._exit(1)
+
+
+def _unpicklable_in_worker(task):
+    """替换ccc._synchronize_asset_in_worker，模拟子进程的结果无法传回"""
+    return lambda: task
+
+
+_synchronize_asset_in_worker = ccc._synchronize_asset_in_worker
+# 子进程收到的Prefab记录在这个文件中(见_logging_in_worker)
+_worker_log = None
+
+
+def _logging_in_worker(task):
+    """替换ccc._synchronize_asset_in_worker，记录每个子进程收到的Prefab"""
+    with open(_worker_log, 'a') as f:
+        for relative_path, uuid_, class_, data in task[2]:
+            f.write('%s %s\n' % (os.getpid(), relative_path))
+    return _synchronize_asset_in_worker(task)
 
 
 class TestCCC(TestCase):
@@ -31,7 +65,7 @@ class TestCCC(TestCase):
         """
         ctx = CompareContext()
 
-        for node in asset.root.iterate_instance_roots(False):
+        for node in asset.instance_roots:
             uuid_ = node.get_prefab_uuid()
             prefab = self.project.get_asset_by_uuid(uuid_)
             if not prefab:
@@ -101,6 +135,8 @@ class TestCCC(TestCase):
         self.project.ignore_components.clear()
         self.project.ignore_component_properties.clear()
         self.project.ignore_component_properties_if_empty.clear()
+        # 修改之后第一次同步时重新编译
+        self.project._ignore_rules = None
 
     def test_cr1_cr2_cr3(self):
         # cr1
@@ -133,3 +169,845 @@ class TestCCC(TestCase):
         s4 = self.project.get_asset_by_path('testcases/cr1_cr2_cr3/s4.fire')
         ctx1 = self.synchronize_asset_instances(s4)
         self.assert_(ctx1.has_changed())
+
+    def save_to_elements(self, asset):
+        """
+        :param Asset asset:
+        :rtype: list[dict]
+        """
+        file_ = FileOutput(asset.project, asset.relative_path)
+        asset.save(file_)
+        return file_.elements
+
+    def synchronize_all(self, project, jobs=1):
+        """
+        同步项目中所有的Asset，用于比较不同实现同步的结果
+        :param Project project:
+        :param int jobs:
+        :rtype: list[(str, str, str)]
+        :return: [(路径, CompareContext, 保存的elements)]
+        """
+        return [(asset.relative_path, str(ctx), json.dumps(self.save_to_elements(asset)))
+                for asset, ctx in project._synchronize(project.sorted_assets, jobs=jobs)]
+
+    def test_cache(self):
+        project = Project('test_project', use_cache=True)
+        project.cache.clear()
+        project.load()
+
+        cached = Project('test_project', use_cache=True)
+        for asset in project.iterate_assets():
+            self.assertIsNotNone(cached.cache.load(asset.relative_path))
+        cached.load()
+
+        for asset in project.iterate_assets():
+            other = cached.get_asset_by_uuid(asset.file.uuid)
+            self.assertIs(other.project, cached)
+            self.assertEqual(other.depth, asset.depth)
+            self.assertEqual(json.dumps(self.save_to_elements(other)), json.dumps(self.save_to_elements(asset)))
+
+        # 只修改了ccc_helper.yaml的修改时间(checkout, touch)，缓存仍然有效
+        path = tempfile.mkdtemp()
+        try:
+            project_path = os.path.join(path, 'test_project')
+            shutil.copytree('test_project', project_path, ignore=shutil.ignore_patterns('ccc_helper'))
+            Project(project_path, use_cache=True).load()
+            yaml_path = os.path.join(project_path, 'ccc_helper.yaml')
+            os.utime(yaml_path, (time.time() + 100, time.time() + 100))
+            cached = Project(project_path, use_cache=True)
+            for asset in project.iterate_assets():
+                self.assertIsNotNone(cached.cache.load(asset.relative_path))
+
+            with open(yaml_path, 'a') as f:
+                f.write('\n# changed\n')
+            cached = Project(project_path, use_cache=True)
+            self.assertIsNone(cached.cache.load(project.sorted_assets[0].relative_path))
+        finally:
+            shutil.rmtree(path)
+
+    def test_parallel_load(self):
+        project = Project('test_project')
+        project.load(jobs=2)
+
+        self.assertEqual(len(list(project.iterate_assets())), len(list(self.project.iterate_assets())))
+        for asset in self.project.iterate_assets():
+            other = project.get_asset_by_path(asset.relative_path)
+            self.assertIs(other.project, project)
+            self.assertEqual(other.depth, asset.depth)
+            self.assertEqual(json.dumps(self.save_to_elements(other)), json.dumps(self.save_to_elements(asset)))
+
+    def test_lazy_load(self):
+        project = Project('test_project')
+        project.load(lazy=True)
+
+        for asset in self.project.iterate_assets():
+            stub = project.get_asset_by_path(asset.relative_path)
+            self.assertFalse(stub.materialized)
+            self.assertEqual(stub.depth, asset.depth)
+            self.assertEqual({x.relative_path for x in stub.referents}, {x.relative_path for x in asset.referents})
+
+        # 只有用到的Asset才会构建Node树
+        p1 = project.get_asset_by_path('testcases/nested/p1.prefab')
+        assets = [p1] + p1.search_referers()
+        for asset in assets:
+            asset.need_synchronize = True
+        for asset in assets:
+            asset.synchronize_all_instances(CompareContext())
+        materialized = {asset.relative_path for asset in project.iterate_assets() if asset.materialized}
+        self.assertEqual(materialized, {asset.relative_path for asset in assets})
+
+        s1 = project.get_asset_by_path('testcases/ss1/s1.fire')
+        self.assertContextEqual(self.synchronize_asset_instances(s1),
+                                self.synchronize_asset_instances(self.project.get_asset_by_path(s1.relative_path)))
+
+    def test_iter_json_array(self):
+        for asset in self.project.iterate_assets():
+            content = open(asset.path, 'rb').read()
+            expected = json.loads(content, object_pairs_hook=OrderedDict)
+            for chunk_size in (1, 7, 1 << 16):
+                elements = list(iter_json_array(StringIO(content), OrderedDict, chunk_size))
+                self.assertEqual(json.dumps(elements), json.dumps(expected))
+
+        self.assertEqual(list(iter_json_array(StringIO(' [ ] '))), [])
+        self.assertEqual(list(iter_json_array(StringIO('[1, {"a": [2]}, 345]'), chunk_size=2)), [1, {'a': [2]}, 345])
+        self.assertRaises(ValueError, list, iter_json_array(StringIO('[1, {"a": [2]}')))
+        # utf-8字符被chunk截断
+        self.assertEqual(list(iter_json_array(StringIO('["\xe4\xb8\xad\xe6\x96\x87"]'), chunk_size=1)), [u'\u4e2d\u6587'])
+
+    def test_streaming_load(self):
+        threshold = ccc.STREAMING_THRESHOLD
+        ccc.STREAMING_THRESHOLD = 0
+        try:
+            project = Project('test_project')
+            project.load()
+        finally:
+            ccc.STREAMING_THRESHOLD = threshold
+
+        for asset in self.project.iterate_assets():
+            other = project.get_asset_by_path(asset.relative_path)
+            self.assertEqual(json.dumps(self.save_to_elements(other)), json.dumps(self.save_to_elements(asset)))
+
+    def test_scan(self):
+        project = Project('test_project')
+        project.scan()
+
+        for asset in self.project.iterate_assets():
+            stub = project.get_asset_by_path(asset.relative_path)
+            self.assertEqual(stub.depth, asset.depth)
+            self.assertEqual({x.relative_path for x in stub.referers}, {x.relative_path for x in asset.referers})
+            self.assertEqual(sorted(stub.get_referent_uuids()), sorted(asset.get_referent_uuids()))
+        self.assertFalse(any(asset.materialized for asset in project.iterate_assets()))
+
+    def test_index(self):
+        project = Project('test_project', use_cache=True)
+        project.index.clear()
+        project.scan()
+        for asset in self.project.iterate_assets():
+            stub = project.get_asset_by_uuid(asset.file.uuid)
+            self.assertEqual(stub.relative_path, asset.relative_path)
+            self.assertEqual(stub.depth, asset.depth)
+            self.assertEqual({x.relative_path for x in stub.referers}, {x.relative_path for x in asset.referers})
+
+        # 没有修改过的文件，不需要重新扫描
+        changed, errors = project.index.update()
+        self.assertEqual((changed, errors), ([], 0))
+
+        index = project.index
+        p1 = self.project.get_asset_by_path('testcases/nested/p1.prefab')
+        self.assertEqual(index.get_path(p1.file.uuid), p1.relative_path)
+        self.assertEqual(index.get_uuid(p1.relative_path), p1.file.uuid)
+        self.assertEqual(index.get_depth(p1.relative_path), p1.depth)
+        self.assertEqual(index.search_referers(p1.relative_path), [x.relative_path for x in p1.search_referers()])
+        self.assertEqual(index.get_referents(p1.relative_path), ['testcases/nested/p2.prefab'])
+        self.assertEqual(sorted(index.get_instances('testcases/nested/p2.prefab')),
+                         [(p1.relative_path, 'i2'), ('testcases/nested/s1.fire', 'i2')])
+        index.close()
+
+    def test_watch(self):
+        path = tempfile.mkdtemp()
+        try:
+            project_path = os.path.join(path, 'test_project')
+            shutil.copytree('test_project', project_path, ignore=shutil.ignore_patterns('ccc_helper'))
+            project = Project(project_path, use_cache=True)
+            project.load(lazy=True)
+            p2 = project.get_asset_by_path('testcases/nested/p2.prefab')
+
+            # 轮询方式检测修改
+            watcher = ccc.AssetWatcher(project, 0)
+            watcher.close()
+            with open(p2.path, 'ab') as f:
+                f.write('\n')
+            changed, errors = watcher.poll()
+            self.assertEqual((changed, errors), ([p2.relative_path], 0))
+
+            # 检查修改过的Prefab，以及引用到它的Asset
+            assets = project.verify_changed_assets(changed)
+            self.assertIs(project.get_asset_by_path(p2.relative_path), p2)
+            self.assertEqual(p2.depth, 2)
+            self.assertEqual({x.relative_path for x in p2.referers}, {'testcases/nested/p1.prefab',
+                                                                      'testcases/nested/s1.fire'})
+            self.assertFalse(any(asset.materialized for asset in [p2] + p2.search_referers()))
+
+            prefab = self.project.get_asset_by_path(p2.relative_path)
+            expected = [asset.relative_path for asset, ctx in
+                        self.project._synchronize([prefab] + prefab.search_referers()) if ctx.has_changed()]
+            self.assertEqual([asset.relative_path for asset in assets], expected)
+            project.index.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_daemon(self):
+        daemon = ccc.ProjectDaemon('test_project')
+        thread = threading.Thread(target=daemon.serve_forever)
+        thread.start()
+        backup = os.path.join('test_project', 'ccc_helper_backup')
+        has_backup = os.path.exists(backup)
+        client = None
+        try:
+            while client is None:
+                time.sleep(0.01)
+                client = ccc.DaemonClient.connect('test_project')
+
+            # 引用关系与直接加载的项目一致
+            assets = client.call('graph')['assets']
+            expected = ccc.describe_assets(list(self.project.iterate_assets()))
+            self.assertEqual(sorted(assets), sorted(json.loads(json.dumps(expected))))
+
+            p1 = self.project.get_asset_by_path('testcases/nested/p1.prefab')
+            changed = self.project.synchronize_prefab(p1, True)
+            result = client.call('verify', asset=p1.relative_path)
+            self.assertEqual(result['changed'], [asset.relative_path for asset in changed])
+            self.assertIn('synchronize testcases/nested/s1.fire', result['output'])
+            # 同步过的Node树都被丢弃，包括没有修改的
+            synchronized = ccc.get_synchronized_assets(daemon.project, p1.relative_path)
+            self.assertEqual(len(synchronized), 2)
+            self.assertFalse(any(asset.materialized for asset in synchronized))
+            client.call('verify')
+            self.assertFalse(any(asset.materialized for asset in daemon.project.iterate_assets()))
+
+            self.assertRaises(Exception, client.call, 'verify', asset='not_found.prefab')
+            self.assertRaises(Exception, client.call, 'unknown')
+        finally:
+            if client:
+                client.call('shutdown')
+                client.close()
+            thread.join()
+            if not has_backup:
+                shutil.rmtree(backup, True)
+        self.assertFalse(os.path.exists(daemon.socket_path))
+
+    def test_slots(self):
+        s1 = self.project.get_asset_by_path('testcases/nested/s1.fire')
+        for node in s1.root.walk():
+            self.assertFalse(hasattr(node, '__dict__'))
+            for element in list(node.components) + [node.prefab_info]:
+                self.assertFalse(hasattr(element, '__dict__'))
+            if not node.children:
+                self.assertIs(node.children, ())
+            self.assertIs(node._ignore_properties, ccc.EMPTY_SET)
+
+    def test_shared_leaves(self):
+        def iterate_leaves():
+            for asset in self.project.iterate_assets():
+                for node in asset.root.walk():
+                    for element in [node] + list(node.components):
+                        for v in element._data.itervalues():
+                            if isinstance(v, dict) and ccc.is_leaf(v):
+                                yield v
+                    yield node.position
+                    yield node.size
+
+        # 相同的值是同一个对象，property名也是共享的
+        leaves = {}
+        for leaf in iterate_leaves():
+            self.assertIs(leaves.setdefault(json.dumps(leaf), leaf), leaf)
+        names = {}
+        for asset in self.project.iterate_assets():
+            for node in asset.root.walk():
+                for k in node._data:
+                    self.assertIs(names.setdefault(k, k), k)
+
+        # 同步时只会替换，不会修改共享的值
+        self.synchronize_all(self.project)
+        for content, leaf in leaves.iteritems():
+            self.assertEqual(json.dumps(leaf), content)
+
+        # Prefab中同名的property不是leaf时，Instance中共享的leaf也不能修改
+        leaf = self.project.share_leaf(OrderedDict([('__uuid__', 'a')]))
+        component = ccc.Component(self.project, None)
+        component._data = OrderedDict([('_N$file', leaf), ('_N$font', leaf)])
+        other = ccc.Component(self.project, None)
+        other._data = OrderedDict([('_N$file', OrderedDict([('__uuid__', 'b'), ('_N$extra', [1])])),
+                                   ('_N$font', leaf)])
+        ctx = CompareContext()
+        ccc.synchronize_dict(component, other, component._data, other._data, ctx)
+        self.assertTrue(ctx.has_changed())
+        self.assertEqual(component._data['_N$file'], other._data['_N$file'])
+        self.assertEqual(leaf, {'__uuid__': 'a'})
+        self.assertIs(component._data['_N$font'], leaf)
+
+    def test_name_index(self):
+        # 同步会增删子节点和组件，索引需要保持一致
+        self.synchronize_all(self.project)
+
+        for asset in self.project.iterate_assets():
+            for node in asset.root.walk():
+                for child in node.children:
+                    self.assertIs(node.get_child_by_name(child.name), child)
+                for component in node.components:
+                    self.assertIs(node.get_component(component.name), component)
+                    self.assertEqual(component.name, self.project.get_component_name(component.type))
+                self.assertIsNone(node.get_child_by_name('(not found)'))
+                self.assertEqual(len(node._child_index or node.children), len(node.children))
+                self.assertEqual(len(node._component_index or node.components), len(node.components))
+
+    def test_ancestry_cache(self):
+        # 同步之后，缓存的路径和Instance Root应该与逐层计算的结果一致
+        self.synchronize_all(self.project)
+
+        for asset in self.project.iterate_assets():
+            for node in asset.root.walk():
+                names, instance_root, parent = [], None, node
+                while parent.parent:
+                    names.insert(0, parent.name)
+                    if parent.get_prefab_uuid() is not None:
+                        instance_root = parent
+                    parent = parent.parent
+                self.assertIs(node.root, parent)
+                self.assertIs(node.instance_root, instance_root)
+                self.assertEqual(node.relative_path, '/'.join([asset.relative_path] + names))
+                self.assertEqual(node.relative_path_to_asset, '/'.join(names) or '.')
+                self.assertEqual(node.get_relative_path_to(asset.root), '/'.join(names) or '.')
+                self.assertEqual(asset.root.get_relative_path_to(node), '/'.join(['..'] * len(names)) or '.')
+                if node.parent:
+                    self.assertEqual(node.get_relative_path_to(node.parent), node.name)
+
+    def test_registry(self):
+        prefabs = [asset for asset in self.project.iterate_assets() if isinstance(asset, Prefab)]
+        for prefab in prefabs:
+            # p1和p2的fileId相同(复制的Prefab)
+            self.assertEqual(self.project.get_prefab_by_file_id(prefab.get_file_id()).get_file_id(),
+                             prefab.get_file_id())
+            self.assertIn(prefab, self.project.registry._by_file_id[prefab.get_file_id()])
+        self.assertIsNone(self.project.get_prefab_by_file_id('(not found)'))
+
+        # lazy加载的Prefab，查找fileId时才构建Node树
+        project = Project('test_project')
+        project.load(lazy=True)
+        self.assertEqual(len(project.registry), len(list(self.project.iterate_assets())))
+        for prefab in prefabs:
+            stub = project.get_prefab_by_file_id(prefab.get_file_id())
+            self.assertEqual(stub.get_file_id(), prefab.get_file_id())
+            self.assertTrue(project.registry.has_file_id(stub))
+
+        p1 = project.get_asset_by_path('testcases/nested/p1.prefab')
+        project.registry.remove(p1)
+        self.assertIsNone(project.get_asset_by_path(p1.relative_path))
+        self.assertIsNone(project.get_asset_by_uuid(p1.file.uuid))
+        self.assertFalse(project.registry.has_file_id(p1))
+        self.assertIsNot(project.registry.get_by_file_id(p1.get_file_id()), p1)
+        project.registry.add(p1)
+        self.assertIs(project.get_asset_by_path('testcases\\nested\\p1.prefab'), p1)
+        self.assertTrue(project.registry.has_file_id(p1))
+
+    def test_components(self):
+        self.assertEqual(ccc.compress_uuid('4c3c5a75-2153-489f-b48d-d0ca1eb7628e'), '4c3c5p1IVNIn7SN0Moet2KO')
+
+        # 没有bundle.project.js时，从脚本的.meta中得到组件的名字
+        path = tempfile.mkdtemp()
+        try:
+            shutil.copytree('test_project', os.path.join(path, 'test_project'),
+                            ignore=shutil.ignore_patterns('bundle.project.js', 'ccc_helper'))
+            project = Project(os.path.join(path, 'test_project'), use_cache=True)
+            project.load(lazy=True)
+            self.assertEqual(project._component_id_to_names, self.project._component_id_to_names)
+            self.assertEqual(project._kd_prefab_types, self.project._kd_prefab_types)
+            for asset in self.project.iterate_assets():
+                other = project.get_asset_by_path(asset.relative_path)
+                self.assertEqual(json.dumps(self.save_to_elements(other)), json.dumps(self.save_to_elements(asset)))
+
+            # 没有修改过的.meta，不需要重新读取
+            registry = project.components
+            cached = os.path.getmtime(registry.path)
+            self.assertEqual(registry.load(), project._component_id_to_names)
+            self.assertEqual(os.path.getmtime(registry.path), cached)
+
+            # 新增脚本后，组件的来源发生变化(见ProjectDaemon._refresh)
+            stat = ccc.get_component_sources_stat(project.path)
+            self.assertEqual(ccc.get_component_sources_stat(project.path), stat)
+            script_path = os.path.join(project.path, 'assets', 'NewComponent.js')
+            open(script_path, 'w').close()
+            with open(script_path + '.meta', 'w') as f:
+                json.dump({'uuid': '4c3c5a75-2153-489f-b48d-d0ca1eb7628f'}, f)
+            self.assertNotEqual(ccc.get_component_sources_stat(project.path), stat)
+            self.assertIn('NewComponent', registry.load().values())
+        finally:
+            shutil.rmtree(path)
+
+    def test_walk(self):
+        def walk(node, post_order):
+            result = [] if post_order else [node]
+            for child in node.children:
+                result += walk(child, post_order)
+            return result + [node] if post_order else result
+
+        def instance_roots(node, including_self):
+            if including_self and node.get_prefab_uuid() is not None:
+                return [node]
+            return sum([instance_roots(child, True) for child in node.children], [])
+
+        for asset in self.project.iterate_assets():
+            root = asset.root
+            self.assertEqual(list(root.walk()), walk(root, False))
+            self.assertEqual(list(root.walk(True)), walk(root, True))
+            self.assertEqual(asset.instance_roots, instance_roots(root, False))
+            self.assertEqual(list(root.iterate_instance_roots(True)), instance_roots(root, True))
+            self.assertEqual(list(root.iterate_nodes_with_component('KdPrefab')),
+                             [node for node in walk(root, False) if node.get_component('KdPrefab')])
+            # 不遍历实例的内部
+            pruned = [node for node in walk(root, False) if node.instance_root in (None, node)]
+            self.assertEqual(list(root.walk(prune=lambda x: x.instance_root is x)), pruned)
+
+        # 不受递归深度的限制
+        root = node = ccc.Node(self.project, None)
+        for i in xrange(5000):
+            child = ccc.Node(self.project, node)
+            node.add_child(child)
+            node = child
+        self.assertEqual(len(list(root.walk())), 5001)
+        self.assertEqual(list(root.walk(True))[0], node)
+        self.assertEqual(list(root.iterate_instance_roots(False)), [])
+
+    def test_sort_assets(self):
+        assets = self.project.sorted_assets
+        self.assertEqual(sorted(assets), sorted(self.project.iterate_assets()))
+        for i, asset in enumerate(assets):
+            self.assertEqual(asset.depth, max([x.depth + 1 for x in asset.referers] or [0]))
+            for referent in asset.referents:
+                self.assertLess(assets.index(referent), i)
+
+        # 循环引用时，给出环上的所有Asset
+        p1 = self.project.get_asset_by_path('testcases/nested/p1.prefab')
+        p2 = self.project.get_asset_by_path('testcases/nested/p2.prefab')
+        p2.referents.add(p1)
+        p1.referers.add(p2)
+        a = self.project.get_asset_by_path('aa.prefab')
+        a.referents.add(a)
+        a.referers.add(a)
+        with self.assertRaises(Exception) as cm:
+            self.project._compute_depths()
+        self.assertEqual(str(cm.exception), 'cyclic reference: aa.prefab -> aa.prefab, '
+                                            'testcases/nested/p1.prefab -> testcases/nested/p2.prefab -> '
+                                            'testcases/nested/p1.prefab')
+
+    def test_reachability(self):
+        def search(asset, attribute):
+            assets, result = {asset}, set()
+            while assets:
+                assets = {x for a in assets for x in getattr(a, attribute)} - result
+                result.update(assets)
+            return result
+
+        assets = self.project.sorted_assets
+        for asset in assets:
+            referers = asset.search_referers()
+            self.assertEqual(set(referers), search(asset, 'referers'))
+            self.assertEqual(referers, sorted(referers, key=assets.index))
+            if isinstance(asset, SceneAsset):
+                self.assertEqual(asset.search_referents(), sorted(search(asset, 'referents'), key=assets.index))
+            for other in assets:
+                self.assertEqual(asset.depends_on(other), other in search(asset, 'referents'))
+
+    def test_parallel_synchronize(self):
+        def synchronize(jobs, lazy):
+            project = Project('test_project')
+            project.load(lazy=lazy)
+            return self.synchronize_all(project, jobs)
+
+        # 与依次同步的结果(包括CompareContext和保存的文件)完全一致
+        expected = synchronize(1, False)
+        self.assertEqual(synchronize(2, False), expected)
+        self.assertEqual(synchronize(3, True), expected)
+
+        # 每个Prefab最多发给每个子进程一次(多个Scene引用到相同的Prefab)
+        global _worker_log
+        path = tempfile.mkdtemp()
+        _worker_log = os.path.join(path, 'referents.log')
+        try:
+            project_path = os.path.join(path, 'test_project')
+            shutil.copytree('test_project', project_path, ignore=shutil.ignore_patterns('ccc_helper*'))
+            scene_path = os.path.join(project_path, 'assets', 'testcases', 'nested', 's1.fire')
+            for i in xrange(4):
+                shutil.copy(scene_path, '%s.%s.fire' % (scene_path, i))
+                with open('%s.%s.fire.meta' % (scene_path, i), 'w') as f:
+                    json.dump({'ver': '1.0.0', 'uuid': str(uuid.uuid4()), 'subMetas': {}}, f)
+            project = Project(project_path)
+            project.load()
+            expected = self.synchronize_all(project)
+            ccc._synchronize_asset_in_worker = _logging_in_worker
+            project = Project(project_path)
+            project.load()
+            self.assertEqual(self.synchronize_all(project, 2), expected)
+            with open(_worker_log) as f:
+                received = f.read().splitlines()
+            self.assertTrue(received)
+            self.assertEqual(len(set(received)), len(received))
+        finally:
+            ccc._synchronize_asset_in_worker = _synchronize_asset_in_worker
+            shutil.rmtree(path)
+
+        # 子进程失败时抛出异常，而不是一直等待
+        try:
+            ccc._synchronize_asset_in_worker = _exit_in_worker
+            self.assertRaisesRegexp(Exception, 'exited unexpectedly', synchronize, 2, False)
+            ccc._synchronize_asset_in_worker = _unpicklable_in_worker
+            self.assertRaisesRegexp(Exception, 'Synchronize failed: .*pickle', synchronize, 2, False)
+        finally:
+            ccc._synchronize_asset_in_worker = _synchronize_asset_in_worker
+
+    def test_fingerprint(self):
+        # 跳过已经一致的子树，结果与逐个比较完全一致
+        is_synchronized_with = ccc.Node._is_synchronized_with
+        ccc.Node._is_synchronized_with = lambda *args: False
+        try:
+            expected = self.synchronize_all(self.project)
+        finally:
+            ccc.Node._is_synchronized_with = is_synchronized_with
+        project = Project('test_project')
+        project.load()
+        self.assertEqual(self.synchronize_all(project), expected)
+
+        # 同步之后重新计算哈希，再次同步时没有修改，且可以跳过Instance
+        skipped = []
+        for asset in project.iterate_assets():
+            for node in asset.root.walk():
+                if node._fingerprint is not None:
+                    self.assertEqual(node._fingerprint, node._compute_fingerprint(False))
+            for node in asset.instance_roots:
+                prefab = project.get_asset_by_uuid(node.get_prefab_uuid())
+                strategies = {x.get_component('KdPrefab').get_property('strategy') for x in (node, prefab.root)}
+                # SS1: 不同步的Instance，在比较哈希之前就跳过了
+                if ccc.KdPrefabStrategy.NEVER not in strategies and node._is_synchronized_with(prefab.root, True):
+                    skipped.append(node)
+        self.assertTrue(skipped)
+        compared = []
+
+        def counting_is_synchronized_with(node, other, is_instance_root):
+            result = is_synchronized_with(node, other, is_instance_root)
+            compared.append((node, result))
+            return result
+
+        ccc.Node._is_synchronized_with = counting_is_synchronized_with
+        try:
+            for asset, ctx in project._synchronize(project.sorted_assets):
+                self.assertFalse(ctx.has_changed())
+        finally:
+            ccc.Node._is_synchronized_with = is_synchronized_with
+        # 一致的Instance都在根节点跳过；不一致的Instance中，一致的子树也会跳过；跳过的子树不会再比较
+        matched = {node for node, result in compared if result}
+        self.assertTrue(set(skipped) < matched)
+        self.assertEqual(len({node for node, result in compared}), len(compared))
+        for node, result in compared:
+            parent = node.parent
+            while parent is not None:
+                self.assertNotIn(parent, matched)
+                parent = parent.parent
+
+        # 子节点重名时不能跳过
+        node = skipped[0]
+        node.add_child(ccc.Node(project, node))
+        node.add_child(ccc.Node(project, node))
+        node._fingerprint = None
+        self.assertIsNone(node.get_fingerprint()[0])
+
+    def test_template(self):
+        # 不使用模板(每个Instance临时编译)时，结果完全一致
+        template = ccc.Asset.template
+        ccc.Asset.template = property(lambda asset: None)
+        try:
+            expected = self.synchronize_all(self.project)
+        finally:
+            ccc.Asset.template = template
+
+        # 每个作为来源的Prefab只编译一次
+        compiled = []
+        init = ccc.NodeTemplate.__init__
+
+        def counting_init(template_, node):
+            if node.parent is None:
+                compiled.append(node.root_element)
+            init(template_, node)
+
+        ccc.NodeTemplate.__init__ = counting_init
+        try:
+            project = Project('test_project')
+            project.load()
+            self.assertEqual(self.synchronize_all(project), expected)
+        finally:
+            ccc.NodeTemplate.__init__ = init
+        sources = {project.get_asset_by_uuid(node.get_prefab_uuid())
+                   for asset in project.sorted_assets for node in asset.instance_roots}
+        self.assertEqual(sorted(compiled), sorted(sources))
+        for prefab in compiled:
+            self.assertIsInstance(prefab, Prefab)
+            self.assertIs(prefab.template.node, prefab.root)
+
+        # 自己同步或者重新加载之后，需要重新编译
+        prefab = compiled[0]
+        template = prefab.template
+        self.assertIs(prefab.template, template)
+        prefab.synchronized = False
+        prefab.synchronize_all_instances(CompareContext())
+        self.assertIsNot(prefab.template, template)
+        template = prefab.template
+        prefab.root = prefab.root
+        self.assertIsNot(prefab.template, template)
+
+        # 模板与Node树一一对应
+        stack = [prefab.template]
+        while stack:
+            template = stack.pop()
+            node = template.node
+            self.assertEqual([child.node for child in template.children], list(node.children))
+            for child in node.children:
+                self.assertIs(template.get_child(child.name).node, node.get_child_by_name(child.name))
+            for component in node.components:
+                self.assertIs(template.get_component(component.name), node.get_component(component.name))
+                self.assertIs(template.get_component_ignores(component),
+                              project.ignore_rules.get_source_ignores(component))
+            stack.extend(template.children)
+
+    def test_ignore_rules(self):
+        # 每次都重新编译(不共用任何缓存的结果)时，同步的结果完全一致
+        ignore_rules = ccc.Project.ignore_rules
+        ccc.Project.ignore_rules = property(lambda project: ccc.IgnoreRules(project))
+        try:
+            expected = self.synchronize_all(self.project)
+        finally:
+            ccc.Project.ignore_rules = ignore_rules
+        project = Project('test_project')
+        project.load()
+        button = project.get_asset_by_path('testcases/cr1_cr2_cr3/s3.fire').root.get_child_by_name('i3') \
+            .get_component('cc.Button')
+        click_events = list(button.get_property('clickEvents'))
+        self.assertEqual(self.synchronize_all(project), expected)
+
+        # CR3: p3.prefab中clickEvents为空，同步时忽略，保留Instance中的clickEvents
+        rules = project.ignore_rules
+        source = project.get_asset_by_path('testcases/cr1_cr2_cr3/p3.prefab').root.get_component('cc.Button')
+        self.assertIn('clickEvents', rules.get_source_ignores(source))
+        self.assertTrue(click_events)
+        self.assertEqual(button.get_property('clickEvents'), click_events)
+        source = project.get_asset_by_path('testcases/cr1_cr2_cr3/p4.prefab').root.get_component('cc.Button')
+        self.assertNotIn('clickEvents', rules.get_source_ignores(source))
+
+        self.assertIs(project.ignore_rules, rules)
+        for asset in project.iterate_assets():
+            for node in asset.root.walk():
+                for component in node.components:
+                    ignores = rules.get_source_ignores(component)
+                    self.assertIs(rules.get_source_ignores(component), ignores)
+                    self.assertTrue(project.ignore_component_properties.get(component.name, set()) <= ignores)
+                    if component.name == 'cc.Button':
+                        self.assertEqual('clickEvents' in ignores, not component.get_property('clickEvents'))
+
+        # 相同签名的结果共用，且不会修改内置的规则
+        node_ignores = ccc.NODE_IGNORE_PROPERTIES.copy()
+        ignores = rules.get_node_ignores(False, True, ccc.EMPTY_SET)
+        self.assertIsInstance(ignores, frozenset)
+        self.assertIn('_color', ignores)
+        self.assertIs(rules.get_node_ignores(False, True, ccc.EMPTY_SET), ignores)
+        self.assertEqual(ccc.NODE_IGNORE_PROPERTIES, node_ignores)
+        self.assertNotIn('_color', rules.get_node_ignores(False, False, ccc.EMPTY_SET))
+        self.assertIn('x', rules.get_node_ignores(True, False, frozenset(['x'])))
+
+        # SS9
+        self.assertEqual(rules.get_ignore_components(False, False), rules.ignore_components)
+        self.assertIn('cc.LabelOutline', rules.get_ignore_components(False, True))
+        self.assertNotIn('cc.LabelOutline', rules.get_ignore_components(True, False))
+        project.ignore_components.add('KdLabel')
+        project._ignore_rules = None
+        self.assertIn('cc.LabelOutline', project.ignore_rules.get_ignore_components(True, False))
+        self.assertNotIn('cc.LabelOutline', project.ignore_rules.get_ignore_components(False, True))
+
+    def test_check_instances(self):
+        differences = self.project.check_instances(self.project.sorted_assets, 100)
+        self.assertTrue(differences)
+
+        # 只比较，不修改Node树
+        project = Project('test_project')
+        project.load()
+        for asset in project.iterate_assets():
+            self.assertEqual(self.save_to_elements(self.project.get_asset_by_path(asset.relative_path)),
+                             self.save_to_elements(asset))
+
+        # 与完整同步的结果一致
+        expected = [asset.relative_path for asset, ctx in project._synchronize(project.sorted_assets)
+                    if ctx.has_changed()]
+        self.assertEqual([asset.relative_path for asset, _ in differences], expected)
+
+        # 只复制Instance的子树，子树之外的对象仍然是原来的
+        node = project.get_asset_by_path(differences[0][0].relative_path).root.get_relative_node(differences[0][1])
+        copied = ccc.copy_node(project, node)
+        self.assertIsNot(copied, node)
+        self.assertIs(copied.parent, node.parent)
+        self.assertIs(copied.root, node.root)
+        self.assertIs(copied.project, project)
+        self.assertEqual(copied.relative_path, node.relative_path)
+        self.assertNotIn(copied, node.parent.children)
+        for x, y in zip(copied.walk(), node.walk()):
+            self.assertIsNot(x, y)
+            self.assertEqual(x.relative_path, y.relative_path)
+            self.assertEqual([c.node for c in x.components], [x] * len(x.components))
+
+        # 同步副本时，不会清空原来的Node树中缓存的哈希
+        fingerprint = node.root.get_fingerprint()
+        prefab = project.get_asset_by_uuid(node.get_prefab_uuid())
+        copied._data['_opacity'] = 0
+        ctx = CompareContext()
+        copied.synchronize(prefab.root, ctx, True, prefab.template)
+        self.assertTrue(ctx.has_changed())
+        self.assertIs(node.root._fingerprint, fingerprint)
+        self.assertIsNotNone(node.parent._fingerprint)
+
+        # 找到指定数量的不一致就停止
+        self.assertEqual(self.project.check_instances(self.project.sorted_assets), differences[:1])
+        changed = ccc.run_action(self.project, 'verify', check=2)
+        self.assertEqual(changed, list(OrderedDict.fromkeys(asset for asset, _ in differences[:2])))
+
+        # 同步之后一致
+        for asset, ctx in self.project._synchronize(self.project.sorted_assets):
+            pass
+        self.assertEqual(self.project.check_instances(self.project.sorted_assets, 100), [])
+
+        # 只检查一个Prefab(或修改过的Asset)时，与verify的范围相同：其他Prefab的Instance不检查
+        path = tempfile.mkdtemp()
+        try:
+            project_path = os.path.join(path, 'test_project')
+            shutil.copytree('test_project', project_path, ignore=shutil.ignore_patterns('ccc_helper*'))
+            checked = Project(project_path)
+            checked.load()
+            for prefab in checked.sorted_assets:
+                if not isinstance(prefab, Prefab):
+                    continue
+                for kwargs in ({'path': prefab.relative_path}, {'changed': [prefab.relative_path]}):
+                    project = Project(project_path)
+                    project.load()
+                    expected = [asset.relative_path for asset in ccc.run_action(project, 'verify', **kwargs)]
+                    self.assertEqual([asset.relative_path for asset in
+                                      ccc.run_action(checked, 'verify', check=100, **kwargs)], expected)
+        finally:
+            shutil.rmtree(path)
+
+    def test_changed_paths(self):
+        path = tempfile.mkdtemp()
+        try:
+            project_path = os.path.join(path, 'test_project')
+            shutil.copytree('test_project', project_path, ignore=shutil.ignore_patterns('ccc_helper'))
+
+            def git(*args):
+                subprocess.check_output(('git', '-c', 'user.name=test', '-c', 'user.email=test@test') + args, cwd=path)
+
+            git('init', '-q')
+            git('add', '-A')
+            git('commit', '-q', '-m', 'init')
+            self.assertEqual(ccc.get_changed_paths(project_path, 'HEAD'), [])
+
+            # 修改的和未提交的新文件，不包括.meta
+            with open(os.path.join(project_path, 'assets', 'testcases', 'nested', 'p2.prefab'), 'a') as f:
+                f.write('\n')
+            open(os.path.join(project_path, 'assets', 'new.prefab.meta'), 'w').close()
+            open(os.path.join(project_path, 'assets', 'new.prefab'), 'w').close()
+            self.assertEqual(sorted(ccc.get_changed_paths(project_path, 'HEAD')),
+                             ['new.prefab', 'testcases/nested/p2.prefab'])
+            os.remove(os.path.join(project_path, 'assets', 'new.prefab.meta'))
+            os.remove(os.path.join(project_path, 'assets', 'new.prefab'))
+
+            # 只处理修改过的Asset及引用到它们的Asset
+            project = Project(project_path)
+            project.load(lazy=True)
+            changed = ccc.get_changed_paths(project_path, 'HEAD')
+            self.assertEqual([asset.relative_path for asset in project.search_changed_assets(changed)],
+                             ['testcases/nested/p2.prefab', 'testcases/nested/p1.prefab', 'testcases/nested/s1.fire'])
+            self.assertFalse(project.get_asset_by_path('testcases/ss1/s1.fire').materialized)
+
+            # 修改过的Scene引用到的Prefab作为同步的来源，结果与完整的同步一致
+            expected = [asset.relative_path for asset, ctx in self.project._synchronize(self.project.sorted_assets)
+                        if ctx.has_changed()]
+            self.assertIn('testcases/ss1/s1.fire', expected)
+            result = ccc.run_action(project, 'verify', changed=['testcases/ss1/s1.fire', 'deleted.prefab'])
+            self.assertEqual([asset.relative_path for asset in result], ['testcases/ss1/s1.fire'])
+        finally:
+            shutil.rmtree(path)
+
+    def test_minimal_save(self):
+        def encode_all(elements):
+            content = json.dumps(elements, indent=2, ensure_ascii=False).encode('utf-8')
+            return '\n'.join(line.rstrip() for line in content.split('\n'))
+
+        def save_unchanged(content):
+            with open(asset.file.path, 'wb') as f:
+                f.write(content)
+            project_ = Project(os.path.join(path, 'test_project'))
+            project_.load()
+            asset_ = project_.get_asset_by_path(asset.relative_path)
+            FileOutput(project_, asset_.relative_path).save(asset_)
+            with open(asset.file.path, 'rb') as f:
+                return f.read()
+
+        self.assertIsNone(ccc.split_json_array('[{"a": 1}]'))
+        self.assertEqual(ccc.split_json_array(encode_all([{'a': 1}, {'b': [1, {}]}]) + '\n'),
+                         ['    "a": 1', '    "b": [\n      1,\n      {}\n    ]'])
+
+        path = tempfile.mkdtemp()
+        try:
+            shutil.copytree('test_project', os.path.join(path, 'test_project'),
+                            ignore=shutil.ignore_patterns('ccc_helper'))
+            project = Project(os.path.join(path, 'test_project'))
+            project.load()
+            asset = project.get_asset_by_path('testcases/ss1/s1.fire')
+            with open(asset.file.path, 'rb') as f:
+                original = f.read()
+            # 非ASCII的名字，cocos creator保存为utf-8，之前的版本保存为\uXXXX
+            name = u'场景'
+            self.assertIn('"_name": "s1"', original)
+            raw = original.replace('"_name": "s1"', '"_name": "%s"' % name.encode('utf-8'))
+            escaped = original.replace('"_name": "s1"', '"_name": %s' % json.dumps(name))
+            self.assertNotEqual(raw, escaped)
+
+            encoded = []
+            encode_element = ccc.encode_element
+
+            def counting_encode_element(element):
+                encoded.append(element)
+                return encode_element(element)
+
+            ccc.encode_element = counting_encode_element
+            try:
+                # 没有修改时，原样写回
+                file_ = FileOutput(project, asset.relative_path)
+                file_.save(asset)
+                with open(asset.file.path, 'rb') as f:
+                    self.assertEqual(f.read(), original)
+                self.assertEqual(encoded, [])
+                self.assertEqual(save_unchanged(escaped), escaped)
+                self.assertEqual(save_unchanged(raw), raw)
+                self.assertEqual(encoded, [])
+
+                # 只重新编码修改过的element，结果与全部重新编码一致
+                project = Project(os.path.join(path, 'test_project'))
+                project.load()
+                for asset, ctx in project._synchronize(project.sorted_assets):
+                    if asset.relative_path == 'testcases/ss1/s1.fire':
+                        break
+                file_ = FileOutput(project, asset.relative_path)
+                file_.save(asset)
+                with open(asset.file.path, 'rb') as f:
+                    content = f.read()
+                self.assertEqual(content, encode_all(file_.elements))
+                self.assertIn('"_name": "%s"' % name.encode('utf-8'), content)
+                self.assertTrue(0 < len(encoded) < len(file_.elements))
+            finally:
+                ccc.encode_element = encode_element
+        finally:
+            shutil.rmtree(path)